@@ -0,0 +1,185 @@
+import asyncio
+import os
+import time
+from urllib.parse import quote
+
+import aiohttp
+
+from download_utils import PART_SUFFIX, DownloadError, expected_length, remove_quietly
+
+# Chunks are written synchronously from the event loop, so they are kept smaller
+# than the threaded downloader's to avoid stalling other transfers on a slow disk.
+CHUNK_SIZE = 1024 * 1024
+MAX_CONNECTIONS = 200
+PER_HOST_CONNECTIONS = 50
+KEEPALIVE_TIMEOUT = 60
+TOTAL_TIMEOUT = None
+READ_TIMEOUT = 60
+CONNECT_TIMEOUT = 30
+
+
+def build_url(base_url, path):
+    """Build the download URL the same way download_file does, encoding only the file name."""
+    file_name = os.path.basename(path)
+    encoded_path = os.path.join(os.path.dirname(path), quote(file_name))
+    return f"{base_url}/{encoded_path}"
+
+
+class AdaptiveRateLimiter:
+    """
+    Request pacing shared by all workers.
+
+    The rate is halved every time the endpoint throttles us (429/503) and creeps back
+    up with each successful request, so a run goes as fast as the endpoint allows.
+    """
+
+    def __init__(self, max_rate, min_rate=1):
+        self.max_rate = max_rate
+        self.min_rate = min_rate
+        self.rate = max_rate
+        self.next_slot = time.monotonic()
+
+    async def acquire(self):
+        now = time.monotonic()
+        slot = max(now, self.next_slot)
+        self.next_slot = slot + 1 / self.rate
+        if slot > now:
+            await asyncio.sleep(slot - now)
+
+    def throttle(self):
+        self.rate = max(self.min_rate, self.rate / 2)
+
+    def recover(self):
+        self.rate = min(self.max_rate, self.rate + 1)
+
+
+class TransferEngine:
+    """
+    Asyncio transfer engine sharing one pooled aiohttp connector.
+
+    All transfers reuse keep-alive connections from the same pool, limited to
+    max_connections in total and per_host per origin. Use it as an async context manager:
+
+        async with TransferEngine(per_host=100) as engine:
+            await engine.run(urls, lambda url: engine.download(url, dest_for(url)))
+    """
+
+    def __init__(self, max_connections=MAX_CONNECTIONS, per_host=PER_HOST_CONNECTIONS, chunk_size=CHUNK_SIZE,
+                 verify_ssl=True):
+        self.max_connections = max_connections
+        self.per_host = per_host
+        self.chunk_size = chunk_size
+        self.verify_ssl = verify_ssl
+        self.session = None
+
+    async def __aenter__(self):
+        # ssl=False skips certificate checks, like curl -k
+        ssl_options = {} if self.verify_ssl else {"ssl": False}
+        connector = aiohttp.TCPConnector(limit=self.max_connections, limit_per_host=self.per_host,
+                                         keepalive_timeout=KEEPALIVE_TIMEOUT, **ssl_options)
+        timeout = aiohttp.ClientTimeout(total=TOTAL_TIMEOUT, sock_connect=CONNECT_TIMEOUT, sock_read=READ_TIMEOUT)
+        self.session = aiohttp.ClientSession(connector=connector, timeout=timeout)
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.session.close()
+
+    async def download(self, url, dest_path):
+        """
+        Stream url into dest_path through a .part file, like download_utils.stream_download.
+
+        Returns the HTTP status code; nothing is written unless it is 200.
+        """
+        part_path = dest_path + PART_SUFFIX
+        async with self.session.get(url) as response:
+            if response.status != 200:
+                return response.status
+            expected = expected_length(response)
+            written = 0
+            try:
+                with open(part_path, 'wb') as file:
+                    async for chunk in response.content.iter_chunked(self.chunk_size):
+                        file.write(chunk)
+                        written += len(chunk)
+                if expected is not None and written != expected:
+                    raise DownloadError(f"Incomplete download of {url}: got {written} of {expected} bytes")
+            except BaseException:
+                remove_quietly(part_path)
+                raise
+        os.replace(part_path, dest_path)
+        return response.status
+
+    async def run(self, jobs, handler, concurrency=None, collect=False):
+        """
+        Run handler(job) for every job with at most `concurrency` in flight.
+
+        Jobs are pulled lazily through a bounded queue, so a huge (or generated) job
+        list never piles up as pending tasks. Nothing is kept per job unless collect is
+        set, in which case the handler results are returned in job order; otherwise
+        handlers record their own results and failures are printed.
+        """
+        concurrency = concurrency or self.max_connections
+        queue = asyncio.Queue(maxsize=concurrency * 2)
+        results = {}
+
+        async def worker():
+            while True:
+                item = await queue.get()
+                if item is None:
+                    queue.task_done()
+                    return
+                index, job = item
+                try:
+                    result = await handler(job)
+                except Exception as e:
+                    # Keep the other workers draining the queue, like gather(return_exceptions=True)
+                    result = e
+                    if not collect:
+                        print(f"Job {job} failed: {e!r}")
+                finally:
+                    queue.task_done()
+                if collect:
+                    results[index] = result
+
+        workers = [asyncio.create_task(worker()) for _ in range(concurrency)]
+        try:
+            for index, job in enumerate(jobs):
+                await queue.put((index, job))
+            for _ in workers:
+                await queue.put(None)
+            await asyncio.gather(*workers)
+        finally:
+            for task in workers:
+                task.cancel()
+        return [results[index] for index in sorted(results)] if collect else None
+
+
+async def download_paths(base_url, paths, download_dir, error_dir, concurrency, per_host):
+    download_errors_file = os.path.join(error_dir, "download_errors")
+
+    async with TransferEngine(max_connections=concurrency, per_host=per_host) as engine:
+
+        async def download_one(path):
+            file_name = os.path.basename(path)
+            download_path = os.path.join(download_dir, file_name)
+            try:
+                status_code = await engine.download(build_url(base_url, path), download_path)
+            except (aiohttp.ClientError, asyncio.TimeoutError, DownloadError) as e:
+                print(f"Request for {file_name} failed: {e}")
+                with open(download_errors_file, 'a') as err_file:
+                    err_file.write(f"Request for {file_name} failed: {e}\n")
+                return False
+            if status_code == 200:
+                print(f"Saved {file_name} to {download_path}")
+            else:
+                print(f"Failed to download: {file_name}, Status code: {status_code}")
+                with open(download_errors_file, 'a') as err_file:
+                    err_file.write(f"Failed to download: {file_name}, Status code: {status_code}\n")
+            return True
+
+        return await engine.run(paths, download_one, concurrency=concurrency, collect=True)
+
+
+def download_all(base_url, paths, download_dir, error_dir, concurrency=MAX_CONNECTIONS, per_host=PER_HOST_CONNECTIONS):
+    """Drop-in replacement for make_http_requests backed by the asyncio engine."""
+    return asyncio.run(download_paths(base_url, paths, download_dir, error_dir, concurrency, per_host))
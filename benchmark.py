@@ -0,0 +1,404 @@
+import argparse
+import asyncio
+import contextlib
+import hashlib
+import importlib.util
+import json
+import logging
+import os
+import re
+import resource
+import shutil
+import socket
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+import multiprocessing
+from http.server import SimpleHTTPRequestHandler, ThreadingHTTPServer
+
+import boto3
+import requests
+from botocore.config import Config
+
+from hls_validator import percentile
+
+SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
+STAGES = ("download", "mp4split", "upload", "check")
+BUCKET = "benchmark"
+BUCKET_PREFIX = "delivery/"
+ACCESS_KEY = "benchmark"
+SECRET_KEY = "benchmark"
+MB = 1024 * 1024
+# A stage slower than the baseline by more than this fraction of files/s is a regression
+TOLERANCE = 0.1
+
+FAKE_MP4SPLIT = """#!{python}
+import os
+import shutil
+import sys
+import time
+
+args = sys.argv[1:]
+output_path, input_path = args[args.index("-o") + 1], args[-1]
+size = os.path.getsize(input_path)
+rate = float(os.environ.get("FAKE_MP4SPLIT_MBPS") or 0) * 1024 * 1024
+time.sleep(float(os.environ.get("FAKE_MP4SPLIT_LATENCY") or 0) + (size / rate if rate else 0))
+shutil.copyfile(input_path, output_path)
+"""
+
+
+def load_script(file_name):
+    """Import one of the hyphenated scripts of this repo as a module."""
+    module_name = re.sub(r"\W", "_", file_name[:-len(".py")])
+    spec = importlib.util.spec_from_file_location(module_name, os.path.join(SCRIPT_DIR, file_name))
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def make_client(endpoint_url, max_pool_connections=50):
+    return boto3.client('s3', region_name="us-east-1", endpoint_url=endpoint_url, aws_access_key_id=ACCESS_KEY,
+                        aws_secret_access_key=SECRET_KEY,
+                        config=Config(max_pool_connections=max_pool_connections, s3={"addressing_style": "path"}))
+
+
+class OriginHandler(SimpleHTTPRequestHandler):
+    """Static files with single byte range support and an optional delay per request, standing in for NetStorage."""
+
+    latency = 0
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        if self.latency:
+            time.sleep(self.latency)
+        path = self.translate_path(self.path)
+        if not os.path.isfile(path):
+            self.send_error(404)
+            return
+        size = os.path.getsize(path)
+        start, end = 0, size - 1
+        match = re.match(r"bytes=(\d*)-(\d*)$", self.headers.get("Range", ""))
+        if match and match.group(1):
+            start = int(match.group(1))
+            end = min(int(match.group(2)), size - 1) if match.group(2) else size - 1
+            if start >= size:
+                self.send_response(416)
+                self.send_header("Content-Range", f"bytes */{size}")
+                self.send_header("Content-Length", "0")
+                self.end_headers()
+                return
+            self.send_response(206)
+            self.send_header("Content-Range", f"bytes {start}-{end}/{size}")
+        else:
+            self.send_response(200)
+        self.send_header("Content-Type", "video/mp4")
+        self.send_header("Content-Length", str(end - start + 1))
+        self.send_header("Accept-Ranges", "bytes")
+        self.send_header("ETag", f'"{int(os.path.getmtime(path))}-{size}"')
+        self.end_headers()
+        with open(path, 'rb') as file:
+            file.seek(start)
+            remaining = end - start + 1
+            while remaining > 0:
+                chunk = file.read(min(MB, remaining))
+                if not chunk:
+                    break
+                self.wfile.write(chunk)
+                remaining -= len(chunk)
+
+
+def start_origin(root, latency=0):
+    """Serve root over HTTP in a background thread. Returns (server, base_url)."""
+    handler = type("Handler", (OriginHandler,), {"latency": latency})
+    server = ThreadingHTTPServer(("127.0.0.1", free_port()),
+                                 lambda *args: handler(*args, directory=root))
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, f"http://127.0.0.1:{server.server_address[1]}"
+
+
+def make_fixtures(root, files, size_mb):
+    """Write files MP4 stand-ins of size_mb under root/delivery-like paths. Returns the listing entries."""
+    entries = []
+    block = os.urandom(MB)
+    for i in range(files):
+        path = f"bench/title{i // 4}/title{i // 4}_{400 * (i % 4 + 1)}k.mp4"
+        full_path = os.path.join(root, path)
+        os.makedirs(os.path.dirname(full_path), exist_ok=True)
+        md5 = hashlib.md5()
+        with open(full_path, 'wb') as file:
+            for part in range(size_mb):
+                # Vary every file so uploads aren't deduplicated anywhere
+                data = block[:-16] + hashlib.md5(f"{i}-{part}".encode()).digest()
+                file.write(data)
+                md5.update(data)
+        entries.append({"Path": path, "Name": os.path.basename(path), "Size": size_mb * MB,
+                        "Hashes": {"md5": md5.hexdigest()}, "IsDir": False})
+    return entries
+
+
+def write_fake_mp4split(bin_dir):
+    os.makedirs(bin_dir, exist_ok=True)
+    path = os.path.join(bin_dir, "mp4split")
+    with open(path, 'w') as file:
+        file.write(FAKE_MP4SPLIT.format(python=sys.executable))
+    os.chmod(path, 0o755)
+    return path
+
+
+def peak_rss_mb():
+    """Peak RSS of this process and of its largest child, in MB (ru_maxrss is in KB on Linux)."""
+    return (round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1),
+            round(resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / 1024, 1))
+
+
+def timed(func, latencies, lock):
+    """Wrap func so the wall time of every call is appended to latencies."""
+    def wrapper(*args, **kwargs):
+        started = time.monotonic()
+        try:
+            return func(*args, **kwargs)
+        finally:
+            with lock:
+                latencies.append(time.monotonic() - started)
+    return wrapper
+
+
+def bench_download(setup, workers, scratch):
+    """download_file of fix-mp4-upload-linode.py from the local origin, on the pooled session of make_http_requests."""
+    module = load_script("fix-mp4-upload-linode.py")
+    download_dir = os.path.join(scratch, "bad-mp4s")
+    os.makedirs(download_dir)
+    session = requests.Session()
+    adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=workers)
+    session.mount("http://", adapter)
+    latencies, lock = [], threading.Lock()
+    download = timed(module.download_file, latencies, lock)
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        list(executor.map(lambda entry: download(setup["base_url"], entry["Path"], download_dir, scratch,
+                                                 setup["segments"], session), setup["entries"]))
+    failed = sum(not os.path.exists(os.path.join(download_dir, entry["Name"])) for entry in setup["entries"])
+    return latencies, failed
+
+
+def bench_mp4split(setup, workers, scratch):
+    """run_mp4split of fix-mp4-upload-linode.py on the fixtures, with the fake mp4split on the PATH."""
+    module = load_script("fix-mp4-upload-linode.py")
+    input_dir = os.path.join(scratch, "bad-mp4s")
+    os.makedirs(input_dir)
+    for entry in setup["entries"]:
+        os.link(os.path.join(setup["origin_root"], entry["Path"]), os.path.join(input_dir, entry["Name"]))
+    module.run_mp4split(input_dir, os.path.join(scratch, "good-mp4s"), [entry["Name"] for entry in setup["entries"]],
+                        "benchmark.key", scratch, max_workers=workers)
+    with open(os.path.join(scratch, "mp4split_results.jsonl")) as file:
+        results = [json.loads(line) for line in file]
+    return [result["wall_time"] for result in results], sum(result["exit_code"] != 0 for result in results)
+
+
+def bench_upload(setup, workers, scratch):
+    """upload_with_boto3 of fix-mp4-upload-linode.py into the local S3 stand-in."""
+    from linode_uploader import LinodeUploader
+
+    module = load_script("fix-mp4-upload-linode.py")
+    client = make_client(setup["endpoint_url"], max_pool_connections=workers * 10)
+    uploader = LinodeUploader(setup["bucket"], client=client, bandwidth_limit=None, max_parallel_files=workers)
+    latencies, lock = [], threading.Lock()
+    uploader.upload_file = timed(uploader.upload_file, latencies, lock)
+    source_dir = os.path.join(scratch, "good-mp4s")
+    os.makedirs(source_dir)
+    for entry in setup["entries"]:
+        os.link(os.path.join(setup["origin_root"], entry["Path"]), os.path.join(source_dir, entry["Name"]))
+    failed = module.upload_with_boto3(uploader, source_dir, BUCKET_PREFIX, scratch,
+                                      [entry["Name"] for entry in setup["entries"]],
+                                      [entry["Path"] for entry in setup["entries"]])
+    return latencies, len(failed)
+
+
+def bench_check(setup, workers, scratch):
+    """check_url of check-linode-urls.py against the local S3 stand-in, through the shared TransferEngine."""
+    from async_transfer import AdaptiveRateLimiter, TransferEngine
+
+    module = load_script("check-linode-urls.py")
+    module.s3 = make_client(setup["endpoint_url"])
+    module.BUCKET_NAME = setup["bucket"]
+    entries = [dict(entry, Path=BUCKET_PREFIX + entry["Path"]) for entry in setup["entries"]]
+    latencies = []
+
+    async def run():
+        limiter = AdaptiveRateLimiter(module.MAX_REQUESTS_PER_SECOND, module.MIN_REQUESTS_PER_SECOND)
+        async with TransferEngine(max_connections=workers, per_host=workers) as engine:
+
+            async def check(entry):
+                started = time.monotonic()
+                result = await module.check_url(engine, limiter, entry)
+                latencies.append(time.monotonic() - started)
+                return result
+
+            return await engine.run(entries, check, concurrency=workers, collect=True)
+
+    results = asyncio.run(run())
+    return latencies, sum(not isinstance(result, dict) or not result["ok"] for result in results)
+
+
+def run_stage(stage, setup, workers, verbose=False):
+    """Run one stage in this (fresh) process and return its measurements."""
+    scratch = tempfile.mkdtemp(dir=setup["work_dir"])
+    stage_func = {"download": bench_download, "mp4split": bench_mp4split,
+                  "upload": bench_upload, "check": bench_check}[stage]
+    try:
+        with contextlib.ExitStack() as stack:
+            if not verbose:
+                devnull = stack.enter_context(open(os.devnull, 'w'))
+                stack.enter_context(contextlib.redirect_stdout(devnull))
+            started = time.monotonic()
+            latencies, failed = stage_func(setup, workers, scratch)
+            wall = time.monotonic() - started
+    finally:
+        os.chdir(setup["work_dir"])
+        shutil.rmtree(scratch, ignore_errors=True)
+    files = len(setup["entries"])
+    total_bytes = sum(entry["Size"] for entry in setup["entries"])
+    rss, children_rss = peak_rss_mb()
+    result = {"stage": stage, "workers": workers, "files": files, "failed": failed, "bytes": total_bytes,
+              "wall": round(wall, 3), "files_per_s": round(files / wall, 2), "mb_per_s": round(total_bytes / MB / wall, 2),
+              "peak_rss_mb": rss, "children_peak_rss_mb": children_rss}
+    for pct in (50, 90, 99):
+        value = percentile(latencies, pct)
+        result[f"latency_p{pct}"] = round(value, 4) if value is not None else None
+    return result
+
+
+def benchmark(setup, stages, worker_counts, verbose=False):
+    """
+    Yield the measurements of every stage at every worker count.
+
+    Each run gets a freshly spawned process, so its peak RSS isn't inflated by the
+    runs before it or by the servers running in this process.
+    """
+    context = multiprocessing.get_context("spawn")
+    for stage in stages:
+        for workers in worker_counts:
+            with ProcessPoolExecutor(max_workers=1, mp_context=context) as executor:
+                yield executor.submit(run_stage, stage, setup, workers, verbose).result()
+
+
+def compare(results, baseline_path, tolerance=TOLERANCE):
+    """Print files/s against a previous results file. Returns the (stage, workers) runs that regressed."""
+    baseline = {}
+    with open(baseline_path) as file:
+        for line in file:
+            record = json.loads(line)
+            baseline[(record["stage"], record["workers"])] = record
+    regressions = []
+    for result in results:
+        previous = baseline.get((result["stage"], result["workers"]))
+        if not previous:
+            continue
+        change = result["files_per_s"] / previous["files_per_s"] - 1
+        flag = "REGRESSION" if change < -tolerance else ""
+        print(f"{result['stage']:>9} x{result['workers']:<4} {previous['files_per_s']:>8} -> "
+              f"{result['files_per_s']:<8} files/s ({change:+.0%}) {flag}")
+        if flag:
+            regressions.append((result["stage"], result["workers"]))
+    return regressions
+
+
+def print_result(result):
+    print(f"{result['stage']:>9} x{result['workers']:<4} {result['files_per_s']:>8} files/s {result['mb_per_s']:>9} MB/s  "
+          f"p50 {result['latency_p50']}s p90 {result['latency_p90']}s p99 {result['latency_p99']}s  "
+          f"peak RSS {result['peak_rss_mb']} MB (children {result['children_peak_rss_mb']} MB)  failed {result['failed']}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Measure the download, mp4split, upload and check stages offline, "
+                                                 "against a local origin, a local S3 stand-in and a fake mp4split")
+    parser.add_argument("--stages", default=",".join(STAGES), help=f"Comma separated stages out of {','.join(STAGES)}")
+    parser.add_argument("--workers", default="4,16", help="Comma separated concurrency settings, every stage runs with each")
+    parser.add_argument("--files", type=int, default=20, help="Number of MP4 stand-ins")
+    parser.add_argument("--size-mb", type=int, default=8, help="Size of every MP4 stand-in")
+    parser.add_argument("--segments", type=int, default=1, help="Range requests per file for the download stage")
+    parser.add_argument("--origin-latency", type=float, default=0, help="Seconds the origin waits before every response")
+    parser.add_argument("--mp4split-latency", type=float, default=0.2, help="Seconds the fake mp4split takes per file")
+    parser.add_argument("--mp4split-mbps", type=float, default=0, help="MB/s the fake mp4split processes on top of its latency, 0 for no limit")
+    parser.add_argument("--endpoint-url", help="Existing S3 compatible endpoint to use instead of starting a moto server")
+    parser.add_argument("--work-dir", help="Directory for fixtures and scratch files, a temporary one by default")
+    parser.add_argument("--output", default="benchmark_results.jsonl", help="Measurements, one JSON line per stage and worker count")
+    parser.add_argument("--baseline", help="Earlier --output file to compare files/s against")
+    parser.add_argument("--tolerance", type=float, default=TOLERANCE, help="Drop in files/s reported as a regression")
+    parser.add_argument("--verbose", action="store_true", help="Keep the output of the scripts being measured")
+    args = parser.parse_args()
+
+    stages = [stage for stage in args.stages.split(",") if stage]
+    unknown = set(stages) - set(STAGES)
+    if unknown:
+        parser.error(f"Unknown stages: {', '.join(sorted(unknown))}")
+    worker_counts = [int(workers) for workers in args.workers.split(",")]
+    output_path = os.path.abspath(args.output)
+    baseline_path = os.path.abspath(args.baseline) if args.baseline else None
+    work_dir = os.path.abspath(args.work_dir) if args.work_dir else tempfile.mkdtemp(prefix="usp-benchmark-")
+    os.makedirs(work_dir, exist_ok=True)
+    os.chdir(work_dir)
+
+    origin_root = os.path.join(work_dir, "origin")
+    entries = make_fixtures(origin_root, args.files, args.size_mb)
+    origin, base_url = start_origin(origin_root, args.origin_latency)
+
+    moto_server = None
+    endpoint_url = args.endpoint_url
+    if not endpoint_url and {"upload", "check"} & set(stages):
+        # Imported here so the spawned stage processes, which re-import this module, don't pay for it
+        try:
+            from moto.server import ThreadedMotoServer
+        except ImportError:
+            sys.exit("The upload and check stages need moto (pip install 'moto[server]') or --endpoint-url")
+        port = free_port()
+        # Keep the per request access log of the moto server out of the report
+        logging.getLogger("werkzeug").setLevel(logging.ERROR)
+        moto_server = ThreadedMotoServer(ip_address="127.0.0.1", port=port, verbose=False)
+        moto_server.start()
+        endpoint_url = f"http://127.0.0.1:{port}"
+    if endpoint_url:
+        client = make_client(endpoint_url)
+        with contextlib.suppress(client.exceptions.BucketAlreadyOwnedByYou):
+            client.create_bucket(Bucket=BUCKET)
+        # The check stage needs the objects even when the upload stage isn't run
+        for entry in entries:
+            client.upload_file(os.path.join(origin_root, entry["Path"]), BUCKET, BUCKET_PREFIX + entry["Path"])
+
+    # Spawned stage processes inherit the environment: the fake mp4split goes first on the PATH
+    os.environ["PATH"] = os.path.dirname(write_fake_mp4split(os.path.join(work_dir, "bin"))) + os.pathsep + os.environ["PATH"]
+    os.environ["FAKE_MP4SPLIT_LATENCY"] = str(args.mp4split_latency)
+    os.environ["FAKE_MP4SPLIT_MBPS"] = str(args.mp4split_mbps)
+
+    setup = {"work_dir": work_dir, "origin_root": origin_root, "entries": entries, "base_url": base_url,
+             "segments": args.segments, "endpoint_url": endpoint_url, "bucket": BUCKET}
+    print(f"{args.files} files of {args.size_mb} MB, origin {base_url}, S3 {endpoint_url}, work dir {work_dir}")
+    results = []
+    try:
+        with open(output_path, 'w') as output:
+            for result in benchmark(setup, stages, worker_counts, args.verbose):
+                results.append(result)
+                output.write(json.dumps(result) + "\n")
+                print_result(result)
+    finally:
+        origin.shutdown()
+        if moto_server:
+            moto_server.stop()
+        if not args.work_dir:
+            shutil.rmtree(work_dir, ignore_errors=True)
+
+    if args.baseline:
+        regressions = compare(results, baseline_path, args.tolerance)
+        if regressions:
+            sys.exit(1)
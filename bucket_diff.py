@@ -0,0 +1,187 @@
+import argparse
+import csv
+import heapq
+import json
+import os
+import re
+import tempfile
+import unicodedata
+from operator import itemgetter
+
+from manifest_reader import iter_raw_entries
+
+# Entries sorted in memory before being spilled to a run file on disk
+RUN_SIZE = 500_000
+CSV_FIELDS = ['Path', 'Name', 'Size', 'ModTime', 'IsDir']
+
+
+def normalize_path(path, strip_prefix=""):
+    """Key used to match an object across listings: NFC, no duplicate or surrounding slashes."""
+    path = re.sub("/+", "/", unicodedata.normalize("NFC", path)).strip("/")
+    if strip_prefix and path.startswith(strip_prefix):
+        path = path[len(strip_prefix):].lstrip("/")
+    return path
+
+
+def iter_listing(listing):
+    """Yield the file entries of an rclone lsjson listing (.json/.jsonl) or a flattened CSV."""
+    if listing.endswith(".csv"):
+        with open(listing, newline='') as file:
+            entries = csv.DictReader(file)
+            for entry in entries:
+                if entry.get("IsDir") not in ("True", "true"):
+                    yield entry
+    else:
+        for entry in iter_raw_entries(listing):
+            if not entry.get("IsDir"):
+                yield entry
+
+
+def write_run(batch, tmp_dir):
+    batch.sort(key=itemgetter(0))
+    fd, run_path = tempfile.mkstemp(prefix="diff-run-", suffix=".jsonl", dir=tmp_dir)
+    with os.fdopen(fd, 'w') as file:
+        for key, entry in batch:
+            file.write(json.dumps([key, entry]) + "\n")
+    return run_path
+
+
+def read_run(run_path):
+    with open(run_path) as file:
+        for line in file:
+            key, entry = json.loads(line)
+            yield key, entry
+
+
+def sorted_entries(listing, tmp_dir, strip_prefix="", run_size=RUN_SIZE):
+    """
+    Yield (key, entry) for every file of a listing in key order, with bounded memory.
+
+    Listings with more than run_size entries are sorted in runs written to tmp_dir and
+    merged back lazily (external sort-merge). Duplicate keys keep the first entry.
+    """
+    runs = []
+    batch = []
+    try:
+        for entry in iter_listing(listing):
+            batch.append((normalize_path(entry["Path"], strip_prefix), entry))
+            if len(batch) >= run_size:
+                runs.append(write_run(batch, tmp_dir))
+                batch = []
+        if runs:
+            if batch:
+                runs.append(write_run(batch, tmp_dir))
+            merged = heapq.merge(*(read_run(run_path) for run_path in runs), key=itemgetter(0))
+        else:
+            merged = iter(sorted(batch, key=itemgetter(0)))
+        previous = None
+        for key, entry in merged:
+            if key != previous:
+                yield key, entry
+                previous = key
+    finally:
+        for run_path in runs:
+            os.remove(run_path)
+
+
+def same_object(source, target, compare_modtime=False):
+    if str(source.get("Size")) != str(target.get("Size")):
+        return False
+    # rclone ModTimes differ in sub-second precision between backends, compare to the second
+    if compare_modtime and str(source.get("ModTime", ""))[:19] != str(target.get("ModTime", ""))[:19]:
+        return False
+    return True
+
+
+def diff_listings(source, target, tmp_dir=None, strip_source_prefix="", strip_target_prefix="",
+                  compare_modtime=False, run_size=RUN_SIZE):
+    """
+    Merge-join two listings in one pass over their sorted keys.
+
+    Yields (status, source_entry, target_entry) where status is "missing" (only in source),
+    "changed" (in both but Size/ModTime differ) or "extra" (only in target).
+    """
+    source_entries = sorted_entries(source, tmp_dir, strip_source_prefix, run_size)
+    target_entries = sorted_entries(target, tmp_dir, strip_target_prefix, run_size)
+    source_item = next(source_entries, None)
+    target_item = next(target_entries, None)
+    while source_item or target_item:
+        if target_item is None or (source_item and source_item[0] < target_item[0]):
+            yield "missing", source_item[1], None
+            source_item = next(source_entries, None)
+        elif source_item is None or target_item[0] < source_item[0]:
+            yield "extra", None, target_item[1]
+            target_item = next(target_entries, None)
+        else:
+            if not same_object(source_item[1], target_item[1], compare_modtime):
+                yield "changed", source_item[1], target_item[1]
+            source_item = next(source_entries, None)
+            target_item = next(target_entries, None)
+
+
+class ListingWriter:
+    """Write entries as a JSON array (one entry per line, like rclone lsjson) or as CSV."""
+
+    def __init__(self, path):
+        self.path = path
+        self.count = 0
+        self.file = open(path, 'w', newline='')
+        if path.endswith(".csv"):
+            self.writer = csv.DictWriter(self.file, fieldnames=CSV_FIELDS, extrasaction='ignore')
+            self.writer.writeheader()
+        else:
+            self.writer = None
+            self.file.write("[\n")
+
+    def write(self, entry):
+        if self.writer:
+            self.writer.writerow(entry)
+        else:
+            self.file.write((",\n" if self.count else "") + json.dumps(entry))
+        self.count += 1
+
+    def close(self):
+        if not self.writer:
+            self.file.write("\n]\n")
+        self.file.close()
+
+
+def write_diff(source, target, missing_output, changed_output=None, extra_output=None, **options):
+    """Diff two listings and stream the results to listing files. Returns the counts per status."""
+    writers = {"missing": ListingWriter(missing_output)}
+    if changed_output:
+        writers["changed"] = ListingWriter(changed_output)
+    if extra_output:
+        writers["extra"] = ListingWriter(extra_output)
+    counts = {"missing": 0, "changed": 0, "extra": 0}
+    try:
+        for status, source_entry, target_entry in diff_listings(source, target, **options):
+            counts[status] += 1
+            if status in writers:
+                writers[status].write(source_entry if source_entry is not None else target_entry)
+    finally:
+        for writer in writers.values():
+            writer.close()
+    return counts
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Stream-diff a source and a destination listing by full path")
+    parser.add_argument("source", help="Source listing (rclone lsjson .json/.jsonl or flattened .csv)")
+    parser.add_argument("target", help="Destination listing in the same formats")
+    parser.add_argument("--missing-output", default="missing_files_linode.json", help="Entries missing from the target")
+    parser.add_argument("--changed-output", help="Source entries whose Size (or ModTime) differs in the target")
+    parser.add_argument("--extra-output", help="Entries only present in the target")
+    parser.add_argument("--strip-source-prefix", default="", help="Prefix removed from source paths before matching")
+    parser.add_argument("--strip-target-prefix", default="", help="Prefix removed from target paths before matching")
+    parser.add_argument("--compare-modtime", action="store_true", help="Also treat different ModTimes as changed")
+    parser.add_argument("--run-size", type=int, default=RUN_SIZE, help="Entries sorted in memory per run file")
+    parser.add_argument("--tmp-dir", help="Directory for the sort run files")
+    args = parser.parse_args()
+
+    counts = write_diff(args.source, args.target, args.missing_output, args.changed_output, args.extra_output,
+                        tmp_dir=args.tmp_dir, strip_source_prefix=args.strip_source_prefix,
+                        strip_target_prefix=args.strip_target_prefix, compare_modtime=args.compare_modtime,
+                        run_size=args.run_size)
+    for status, count in counts.items():
+        print(f"Number of {status} files: {count}")
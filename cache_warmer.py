@@ -0,0 +1,156 @@
+import argparse
+import asyncio
+import csv
+import json
+import re
+
+from async_transfer import AdaptiveRateLimiter, TransferEngine
+from hls_validator import fetch, iter_urls, playlist_uris, title_of
+
+CONCURRENCY = 50
+PER_HOST = 50
+MAX_REQUESTS_PER_SECOND = 200
+MIN_REQUESTS_PER_SECOND = 5
+# Segments fetched from the start of every variant
+SEGMENTS = 3
+
+
+def popularity_key(value):
+    """Title a popularity row refers to: a playback URL, or a title path such as dir/title."""
+    if "://" in value:
+        return title_of(value)
+    return "/" + re.sub(r"\.(ism|mp4)$", "", value.strip().strip("/"))
+
+
+def load_popularity(popularity_path):
+    """
+    {title: views} from a CSV of "title or URL, views" rows. A header row, or any row
+    whose second column isn't a number, is skipped.
+    """
+    views = {}
+    with open(popularity_path, newline='') as file:
+        for row in csv.reader(file):
+            if len(row) < 2 or not row[1].strip().replace(".", "", 1).isdigit():
+                continue
+            key = popularity_key(row[0])
+            views[key] = views.get(key, 0) + float(row[1])
+    return views
+
+
+def prioritize(urls, views):
+    """URLs ordered by the views of their title, most popular first; unknown titles keep their order at the end."""
+    return sorted(urls, key=lambda url: -views.get(title_of(url), 0))
+
+
+def cache_status(record):
+    """HIT or MISS from the X-Cache header of a request record (e.g. "TCP_MEM_HIT from ..."), None without one."""
+    for name, value in record.get("cache", {}).items():
+        if name.lower() == "x-cache" and value:
+            return "HIT" if "HIT" in value.split()[0] else "MISS"
+    return None
+
+
+async def paced_fetch(engine, limiter, url, kind, keep_body):
+    """fetch() at the limiter's rate, halving it when the edge or origin pushes back."""
+    await limiter.acquire()
+    record, body = await fetch(engine, url, kind, keep_body)
+    if record.get("status") in (429, 503):
+        limiter.throttle()
+    elif record.get("status") == 200:
+        limiter.recover()
+    record["cache_status"] = cache_status(record)
+    return record, body
+
+
+async def warm(engine, limiter, url, segments=SEGMENTS, confirm=False):
+    """
+    Pull the URL set of one title through the CDN: the master playlist, every variant
+    playlist and the first `segments` segments of each.
+
+    With confirm, the same URLs are requested again once the title is warm and the
+    X-Cache status of that second pass shows whether the edge now serves them.
+    """
+    requests = []
+    master, text = await paced_fetch(engine, limiter, url, "master", keep_body=True)
+    requests.append(master)
+    if master.get("status") == 200:
+        variants = playlist_uris(text, url)
+        results = await asyncio.gather(*(paced_fetch(engine, limiter, variant, "variant", keep_body=True)
+                                         for variant in variants))
+        segment_urls = []
+        for variant, variant_text in results:
+            requests.append(variant)
+            if variant.get("status") == 200:
+                segment_urls.extend(playlist_uris(variant_text, variant["url"])[:segments])
+        for segment, _ in await asyncio.gather(*(paced_fetch(engine, limiter, uri, "segment", keep_body=False)
+                                                 for uri in segment_urls)):
+            requests.append(segment)
+
+    record = {"url": url, "title": title_of(url), "ok": all(request.get("status") == 200 for request in requests),
+              "requests": requests, "hits": sum(request["cache_status"] == "HIT" for request in requests)}
+    if confirm and record["ok"]:
+        confirmed = await asyncio.gather(*(paced_fetch(engine, limiter, request["url"], request["kind"], keep_body=False)
+                                           for request in requests))
+        record["confirm"] = [request for request, _ in confirmed]
+        record["confirmed_hits"] = sum(request["cache_status"] == "HIT" for request in record["confirm"])
+    return record
+
+
+async def warm_all(urls, results_path, segments=SEGMENTS, confirm=False, concurrency=CONCURRENCY, per_host=PER_HOST,
+                   max_rate=MAX_REQUESTS_PER_SECOND, verify_ssl=False):
+    """
+    Warm every URL in order, at most `concurrency` titles at once and max_rate requests
+    per second overall, appending a JSON line per title to results_path. Returns the totals.
+    """
+    totals = {"titles": 0, "failed": 0, "requests": 0, "hits": 0, "confirmed": 0, "confirmed_hits": 0}
+    limiter = AdaptiveRateLimiter(max_rate, min(MIN_REQUESTS_PER_SECOND, max_rate))
+    async with TransferEngine(max_connections=concurrency * 4, per_host=per_host, verify_ssl=verify_ssl) as engine:
+        with open(results_path, 'w') as results:
+
+            async def warm_and_record(url):
+                record = await warm(engine, limiter, url, segments, confirm)
+                results.write(json.dumps(record) + "\n")
+                totals["titles"] += 1
+                totals["failed"] += not record["ok"]
+                totals["requests"] += len(record["requests"])
+                totals["hits"] += record["hits"]
+                if "confirm" in record:
+                    totals["confirmed"] += len(record["confirm"])
+                    totals["confirmed_hits"] += record["confirmed_hits"]
+                    status = f"{record['confirmed_hits']}/{len(record['confirm'])} hits after warming"
+                else:
+                    status = f"{record['hits']}/{len(record['requests'])} already cached"
+                print(f" {url} {'OK' if record['ok'] else 'FAILED'} {status}")
+                if totals["titles"] % 1000 == 0:
+                    results.flush()
+                    print(f"Warmed {totals['titles']} titles, {limiter.rate:.0f} req/s")
+
+            await engine.run(urls, warm_and_record, concurrency=concurrency)
+    return totals
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Warm the CDN cache with the playlists and first segments of every title")
+    parser.add_argument("urls", nargs="?", default="usp_urls.txt", help="File with one master.m3u8 URL per title, e.g. from url_list.py")
+    parser.add_argument("--popularity", help="CSV of title or URL, views; the most viewed titles are warmed first")
+    parser.add_argument("--top", type=int, help="Only warm this many titles, after prioritizing")
+    parser.add_argument("--segments", type=int, default=SEGMENTS, help="Segments warmed from the start of every variant")
+    parser.add_argument("--confirm", action="store_true", help="Request everything again and report the X-Cache hits")
+    parser.add_argument("--concurrency", type=int, default=CONCURRENCY, help="Titles warmed at once")
+    parser.add_argument("--per-host", type=int, default=PER_HOST, help="Connection limit per host")
+    parser.add_argument("--rate", type=float, default=MAX_REQUESTS_PER_SECOND, help="Maximum requests per second")
+    parser.add_argument("--results", default="warm_results.jsonl", help="Every request made, one JSON line per title")
+    parser.add_argument("--verify-ssl", action="store_true", help="Check certificates")
+    args = parser.parse_args()
+
+    urls = list(dict.fromkeys(iter_urls(args.urls)))
+    if args.popularity:
+        urls = prioritize(urls, load_popularity(args.popularity))
+    if args.top:
+        urls = urls[:args.top]
+    totals = asyncio.run(warm_all(urls, args.results, args.segments, args.confirm, args.concurrency, args.per_host,
+                                  args.rate, args.verify_ssl))
+    print(f"Warmed {totals['titles']} titles with {totals['requests']} requests, {totals['failed']} failed, "
+          f"{totals['hits']} already cached")
+    if args.confirm:
+        print(f"Confirmation pass: {totals['confirmed_hits']} of {totals['confirmed']} requests served from cache")
@@ -1,15 +1,27 @@
+import argparse
+import asyncio
 import json
-import requests
-from concurrent.futures import ThreadPoolExecutor
 import os
+
+import aiohttp
 import boto3
 
+from async_transfer import AdaptiveRateLimiter, TransferEngine
+from job_state import BUCKET_KEY_PREFIX, DEFAULT_DB_PATH, JobLedger
+from bucket_diff import ListingWriter
+from manifest_reader import iter_raw_entries
+
 # Constants
 JSON_FILE = 'all_files_linode.json'
 #JSON_FILE = 'test.json'
 LOG_FILE = 'error_log.json'
+RESULTS_FILE = 'verify_results.jsonl'
 BASE_URL = 'http://us-ord-1.linodeobjects.com'  # Add your base URL here
-MAX_WORKERS = 40  # You can adjust this number based on your server's capabilities and requirements
+MAX_WORKERS = 200  # Concurrent HEAD requests, all sharing one connection pool
+MAX_REQUESTS_PER_SECOND = 1000  # Upper bound, lowered automatically while the endpoint answers 429/503
+MIN_REQUESTS_PER_SECOND = 10
+MAX_RETRIES = 5
+LEDGER_BATCH = 1000  # Verified paths written to the ledger per transaction
 BUCKET_NAME = 'bucket-content-1'
 
 
@@ -21,8 +33,6 @@ SECRET_KEY = os.environ.get('S3_SECRET_KEY')
 session = boto3.Session(aws_access_key_id=ACCESS_KEY, aws_secret_access_key=SECRET_KEY, region_name=REGION)
 s3 = session.client('s3', region_name=REGION, endpoint_url=BASE_URL)  # if you have a custom endpoint
 
-# Use a session for connection pooling
-http_session = requests.Session()
 
 def generate_presigned_url(path):
     try:
@@ -30,55 +40,131 @@ def generate_presigned_url(path):
             'head_object',
             Params={'Bucket': BUCKET_NAME, 'Key': path},
             ExpiresIn=300,
-            HttpMethod='GET'
+            HttpMethod='HEAD'
         )
         return url
     except Exception as e:
         print(f"Error generating signed URL for path: {path}. Error: {str(e)}")
         return None
 
-def check_url(entry, errors):
-    signed_url = generate_presigned_url(entry["Path"])
-    if not signed_url:
-        return
 
-    try:
-        # Stream the content
-        with http_session.get(signed_url, stream=True) as response:
-            # Check the status without reading the content
-            if response.status_code == 200:
-                print(f"URL: {signed_url} - 200 OK Successful")
-                # Discard the content by streaming in small chunks
-                for _ in response.iter_content(chunk_size=8192):
-                    pass
-            elif response.status_code in (404, 429, 403, 501, 502, 503, 504):
-                errors.append(entry)
-                print(f"Error {response.status_code} for path: {entry['Path']}")
-            else:
-                errors.append(entry)
-                print(f"Unexpected status {response.status_code} for path: {entry['Path']}")
-    except Exception as e:
-        errors.append(entry)
-        print(f"Error for path: {entry['Path']}. Error: {str(e)}")
+def compare_with_listing(entry, headers):
+    """Return why the object doesn't match its listing entry, or None when it does."""
+    length = headers.get('Content-Length')
+    if entry.get('Size') is not None and length is not None and int(length) != int(entry['Size']):
+        return f"size {length} != {entry['Size']}"
+    md5 = (entry.get('Hashes') or {}).get('md5')
+    etag = headers.get('ETag', '').strip('"')
+    # Multipart ETags ("<hash>-<parts>") aren't an MD5 of the object and can't be compared
+    if md5 and etag and '-' not in etag and etag != md5:
+        return f"etag {etag} != md5 {md5}"
+    return None
 
 
-def main():
-    with open(JSON_FILE, 'r') as f:
-        data = json.load(f)
+async def check_url(engine, limiter, entry):
+    """HEAD one object and return a result record for it."""
+    path = entry["Path"]
+    for attempt in range(MAX_RETRIES + 1):
+        signed_url = generate_presigned_url(path)
+        if not signed_url:
+            return {"Path": path, "ok": False, "reason": "could not sign URL"}
+        await limiter.acquire()
+        try:
+            async with engine.session.head(signed_url) as response:
+                status = response.status
+                headers = response.headers
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            if attempt < MAX_RETRIES:
+                await asyncio.sleep(2 ** attempt)
+                continue
+            return {"Path": path, "ok": False, "reason": str(e)}
 
-    # Read pre-existing errors
-    try:
-        with open(LOG_FILE, 'r') as f:
-            errors = json.load(f)
-    except (FileNotFoundError, json.JSONDecodeError):
-        errors = []
+        if status in (429, 503) and attempt < MAX_RETRIES:
+            limiter.throttle()
+            retry_after = headers.get('Retry-After', '')
+            await asyncio.sleep(int(retry_after) if retry_after.isdigit() else 2 ** attempt)
+            continue
+        if status != 200:
+            return {"Path": path, "ok": False, "status": status, "reason": f"HTTP {status}"}
+
+        limiter.recover()
+        mismatch = compare_with_listing(entry, headers)
+        return {"Path": path, "ok": mismatch is None, "status": status, "reason": mismatch,
+                "ETag": headers.get('ETag'), "Content-Length": headers.get('Content-Length')}
+
+
+def iter_files(json_file):
+    for entry in iter_raw_entries(json_file):
+        if not entry.get("IsDir"):
+            yield entry
 
-    with ThreadPoolExecutor(max_workers=MAX_WORKERS) as executor:
-        executor.map(lambda entry: check_url(entry, errors), data)
 
-    # Write errors back to log file
-    with open(LOG_FILE, 'w') as f:
-        json.dump(errors, f, indent=4)
+async def verify(json_file, results_file, error_log, ledger):
+    """
+    HEAD every object of the listing, appending a result per object to results_file
+    and the listing entry of every failure to error_log. Objects found are recorded as
+    verified in the ledger. Returns the number of errors.
+    """
+    errors = 0
+    checked = 0
+    verified = []
+    limiter = AdaptiveRateLimiter(MAX_REQUESTS_PER_SECOND, MIN_REQUESTS_PER_SECOND)
+    loop = asyncio.get_running_loop()
+
+    async def flush_verified():
+        # One transaction per batch, off the event loop so in-flight requests keep going
+        batch = verified[:]
+        verified.clear()
+        if batch:
+            await loop.run_in_executor(None, ledger.mark_many, batch, "verified")
+
+    async with TransferEngine(max_connections=MAX_WORKERS, per_host=MAX_WORKERS) as engine:
+        with open(results_file, 'a') as results:
+
+            async def check_and_record(entry):
+                nonlocal checked, errors
+                result = await check_url(engine, limiter, entry)
+                results.write(json.dumps(result) + "\n")
+                checked += 1
+                if result["ok"]:
+                    verified.append(entry["Path"])
+                    if len(verified) >= LEDGER_BATCH:
+                        await flush_verified()
+                else:
+                    errors += 1
+                    error_log.write(entry)
+                    print(f"Error for path: {entry['Path']}. {result['reason']}")
+                if checked % 10000 == 0:
+                    results.flush()
+                    print(f"Checked {checked} objects, {errors} errors, {limiter.rate:.0f} req/s")
+
+            await engine.run(iter_files(json_file), check_and_record, concurrency=MAX_WORKERS)
+    await flush_verified()
+    return errors
+
+
+def main():
+    parser = argparse.ArgumentParser(description="HEAD every object of the Linode listing and record the verified ones")
+    parser.add_argument("--ledger", default=DEFAULT_DB_PATH, help="SQLite job ledger the verified objects are recorded in")
+    args = parser.parse_args()
+    # The listing holds bucket keys, the ledger tracks the NetStorage paths they were copied from
+    ledger = JobLedger(args.ledger, key_prefix=BUCKET_KEY_PREFIX)
+
+    # The new error log is streamed to disk: the errors of earlier runs first, then the new ones
+    error_log = ListingWriter(LOG_FILE + ".tmp")
+    try:
+        try:
+            for entry in iter_raw_entries(LOG_FILE):
+                error_log.write(entry)
+        except FileNotFoundError:
+            pass
+        except Exception as e:
+            print(f"Couldn't read the previous {LOG_FILE}, starting a new one. Reason: {e}")
+        errors = asyncio.run(verify(JSON_FILE, RESULTS_FILE, error_log, ledger))
+    finally:
+        error_log.close()
+    os.replace(LOG_FILE + ".tmp", LOG_FILE)
+    print(f"{errors} errors in this run, {error_log.count} in {LOG_FILE}")
 
 if __name__ == "__main__":
     main()
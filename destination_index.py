@@ -0,0 +1,215 @@
+import hashlib
+import math
+import os
+import sqlite3
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from job_state import DEFAULT_DB_PATH, file_md5
+from linode_uploader import COPY_TRANSFER_CONFIG, MB, TRANSFER_CONFIG
+
+# A listing younger than this is reused instead of paginating the prefix again
+LISTING_MAX_AGE = 24 * 60 * 60
+# Prefix shards paginated at once
+LIST_WORKERS = 16
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS destination_objects (
+    bucket TEXT NOT NULL,
+    key TEXT NOT NULL,
+    size INTEGER,
+    etag TEXT,
+    last_modified TEXT,
+    listed_at REAL,
+    PRIMARY KEY (bucket, key)
+);
+CREATE TABLE IF NOT EXISTS destination_listings (
+    bucket TEXT NOT NULL,
+    prefix TEXT NOT NULL,
+    listed_at REAL,
+    PRIMARY KEY (bucket, prefix)
+);
+"""
+
+
+def multipart_etag(path, part_size):
+    """The ETag S3 reports for a multipart upload of path in part_size parts: MD5 of the part MD5s, "-", part count."""
+    part_digests = []
+    with open(path, 'rb') as file:
+        for part in iter(lambda: file.read(part_size), b''):
+            part_digests.append(hashlib.md5(part).digest())
+    return f"{hashlib.md5(b''.join(part_digests)).hexdigest()}-{len(part_digests)}"
+
+
+def candidate_part_sizes(size, part_count):
+    """
+    Part sizes that split size into part_count parts: the ones the uploaders in this
+    repo and rclone use, then the smallest whole MiB size that fits.
+    """
+    candidates = [TRANSFER_CONFIG.multipart_chunksize, COPY_TRANSFER_CONFIG.multipart_chunksize] + \
+        [mb * MB for mb in (5, 8, 16, 32, 128)] + [math.ceil(size / part_count / MB) * MB]
+    return [part_size for part_size in dict.fromkeys(candidates) if math.ceil(size / part_size) == part_count]
+
+
+class DestinationIndex:
+    """
+    Local copy of the destination bucket listing, used to skip objects that are already there.
+
+    A prefix is listed once with ListObjectsV2 and kept in SQLite next to the job
+    ledger, so every upload can check for an identical object with a primary key lookup
+    instead of a HEAD request, and reruns only transfer what actually changed.
+    """
+
+    def __init__(self, client, bucket, db_path=DEFAULT_DB_PATH):
+        self.client = client
+        self.bucket = bucket
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(db_path, check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.executescript(SCHEMA)
+
+    def close(self):
+        self.conn.close()
+
+    def listed_at(self, prefix):
+        """When prefix, or a prefix containing it, was last listed completely."""
+        with self.lock:
+            row = self.conn.execute(
+                "SELECT MAX(listed_at) FROM destination_listings WHERE bucket = ? AND substr(?, 1, length(prefix)) = prefix",
+                (self.bucket, prefix)).fetchone()
+        return row[0]
+
+    def store_page(self, items, listed_at):
+        rows = [(self.bucket, item['Key'], item['Size'], item['ETag'].strip('"'),
+                 item['LastModified'].strftime("%Y-%m-%dT%H:%M:%S.%fZ"), listed_at) for item in items]
+        with self.lock, self.conn:
+            self.conn.executemany(
+                "INSERT OR REPLACE INTO destination_objects (bucket, key, size, etag, last_modified, listed_at) "
+                "VALUES (?, ?, ?, ?, ?, ?)", rows)
+        return len(rows)
+
+    def list_shard(self, prefix, listed_at, delimiter=None):
+        """
+        Store every object under prefix, or with a delimiter only the ones directly
+        under it. Returns (objects stored, common prefixes found).
+        """
+        count = 0
+        shards = []
+        paginator = self.client.get_paginator('list_objects_v2')
+        options = {"Delimiter": delimiter} if delimiter else {}
+        for page in paginator.paginate(Bucket=self.bucket, Prefix=prefix, **options):
+            count += self.store_page(page.get('Contents', []), listed_at)
+            shards.extend(common['Prefix'] for common in page.get('CommonPrefixes', []))
+        return count, shards
+
+    def mark_listed(self, prefixes, listed_at):
+        with self.lock, self.conn:
+            self.conn.executemany("INSERT OR REPLACE INTO destination_listings (bucket, prefix, listed_at) VALUES (?, ?, ?)",
+                                  [(self.bucket, prefix, listed_at) for prefix in prefixes])
+
+    def refresh(self, prefix="", max_age=LISTING_MAX_AGE, workers=LIST_WORKERS):
+        """
+        List prefix unless a listing younger than max_age is cached. Returns the number of objects stored.
+
+        The prefix is split into shards at its next "/" (e.g. one per title directory
+        under delivery/) which are paginated in parallel. Objects are upserted as pages
+        arrive and the ones that weren't seen again are deleted at the end, so the old
+        listing stays usable until the new one is complete. Refreshing a shard on its
+        own only touches the rows under it.
+        """
+        listed_at = self.listed_at(prefix)
+        if listed_at is not None and time.time() - listed_at < max_age:
+            return 0
+
+        started = time.time()
+        count, shards = self.list_shard(prefix, started, delimiter="/")
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            for shard_count, _ in executor.map(lambda shard: self.list_shard(shard, started), shards):
+                count += shard_count
+
+        with self.lock, self.conn:
+            self.conn.execute("DELETE FROM destination_objects WHERE bucket = ? AND substr(key, 1, ?) = ? "
+                              "AND listed_at < ?",
+                              (self.bucket, len(prefix), prefix, started))
+        self.mark_listed([prefix] + shards, started)
+        print(f"Listed {count} objects under {self.bucket}/{prefix} in {len(shards)} shards")
+        return count
+
+    def iter_entries(self, prefix="", strip_prefix="", batch_size=10000):
+        """Yield the listed objects under prefix as rclone lsjson entries, in key order."""
+        last = ""
+        while True:
+            with self.lock:
+                rows = self.conn.execute(
+                    "SELECT key, size, etag, last_modified FROM destination_objects "
+                    "WHERE bucket = ? AND substr(key, 1, ?) = ? AND key > ? ORDER BY key LIMIT ?",
+                    (self.bucket, len(prefix), prefix, last, batch_size)).fetchall()
+            if not rows:
+                return
+            for key, size, etag, last_modified in rows:
+                path = key[len(strip_prefix):] if strip_prefix and key.startswith(strip_prefix) else key
+                entry = {"Path": path, "Name": os.path.basename(key), "Size": size, "ModTime": last_modified,
+                         "IsDir": False}
+                if '-' not in etag:
+                    entry["Hashes"] = {"md5": etag}
+                yield entry
+            last = rows[-1][0]
+
+    def get(self, key):
+        """(size, etag) of the listed object, or None if it isn't in the bucket."""
+        with self.lock:
+            return self.conn.execute("SELECT size, etag FROM destination_objects WHERE bucket = ? AND key = ?",
+                                     (self.bucket, key)).fetchone()
+
+    def has_object(self, key, size, md5):
+        """
+        True if key is listed with this size and an ETag equal to md5.
+
+        Multipart ETags aren't the MD5 of the object, so those objects never match here;
+        use has_file once the source is local.
+        """
+        listed = self.get(key)
+        return listed is not None and listed[0] == size and listed[1] == md5
+
+    def has_file(self, key, local_path):
+        """True if key already holds exactly the contents of local_path."""
+        listed = self.get(key)
+        size = os.path.getsize(local_path)
+        if listed is None or listed[0] != size:
+            return False
+        etag = listed[1]
+        if '-' in etag:
+            part_count = int(etag.rpartition('-')[2])
+            return any(multipart_etag(local_path, part_size) == etag
+                       for part_size in candidate_part_sizes(size, part_count))
+        return file_md5(local_path) == etag
+
+
+if __name__ == "__main__":
+    import argparse
+
+    from bucket_diff import ListingWriter
+    from linode_uploader import make_s3_client
+
+    parser = argparse.ArgumentParser(description="Refresh the local listing of a bucket and export it as an rclone lsjson style listing")
+    parser.add_argument("bucket", help="Bucket to list")
+    parser.add_argument("--prefix", default="delivery/", help="Prefix to refresh, e.g. delivery/ or delivery/some-title/")
+    parser.add_argument("--max-age", type=int, default=LISTING_MAX_AGE, help="Seconds a cached listing stays valid, 0 to always list")
+    parser.add_argument("--workers", type=int, default=LIST_WORKERS, help="Prefix shards listed in parallel")
+    parser.add_argument("--db", default=DEFAULT_DB_PATH, help="SQLite database holding the listing")
+    parser.add_argument("--output", help="Write the listing to this .json or .csv file, e.g. all_files_linode.json (keep the "
+                                         "bucket keys, check-linode-urls.py uses them as they are)")
+    parser.add_argument("--strip-prefix", default="", help="Prefix removed from the exported paths, not for all_files_linode.json")
+    args = parser.parse_args()
+
+    index = DestinationIndex(make_s3_client(max_pool_connections=args.workers), args.bucket, db_path=args.db)
+    index.refresh(args.prefix, max_age=args.max_age, workers=args.workers)
+    if args.output:
+        writer = ListingWriter(args.output)
+        try:
+            for entry in index.iter_entries(args.prefix, args.strip_prefix):
+                writer.write(entry)
+        finally:
+            writer.close()
+        print(f"Wrote {writer.count} entries to {args.output}")
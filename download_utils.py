@@ -0,0 +1,242 @@
+import json
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+import requests
+
+# Size of each read from the socket. Only one chunk per transfer is held in memory,
+# so this is also the per-download memory ceiling regardless of the file size.
+CHUNK_SIZE = 8 * 1024 * 1024
+REQUEST_TIMEOUT = 60
+PART_SUFFIX = ".part"
+
+
+class DownloadError(requests.exceptions.RequestException):
+    """Raised when a download finished but the file on disk is not complete."""
+
+
+def expected_length(response):
+    """Return the Content-Length of the response, or None when it can't be trusted."""
+    length = response.headers.get("Content-Length")
+    # requests decodes compressed bodies on the fly, so the header won't match the bytes written
+    if length is None or response.headers.get("Content-Encoding"):
+        return None
+    return int(length)
+
+
+def remove_quietly(path):
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
+
+
+def stream_download(url, dest_path, session=None, chunk_size=CHUNK_SIZE, timeout=REQUEST_TIMEOUT):
+    """
+    Stream url into dest_path chunk by chunk.
+
+    The body is written to dest_path + ".part" and only renamed into place once the
+    whole file arrived and its size matches Content-Length, so a file at dest_path is
+    always complete. Returns the HTTP status code; nothing is written unless it is 200.
+    """
+    http = session or requests
+    part_path = dest_path + PART_SUFFIX
+    with http.get(url, stream=True, timeout=timeout) as response:
+        if response.status_code != 200:
+            return response.status_code
+        expected = expected_length(response)
+        written = 0
+        try:
+            with open(part_path, 'wb') as file:
+                for chunk in response.iter_content(chunk_size=chunk_size):
+                    file.write(chunk)
+                    written += len(chunk)
+            if expected is not None and written != expected:
+                raise DownloadError(f"Incomplete download of {url}: got {written} of {expected} bytes")
+        except BaseException:
+            remove_quietly(part_path)
+            raise
+    os.replace(part_path, dest_path)
+    return response.status_code
+
+
+# --- Resumable ranged downloads -------------------------------------------------
+
+JOURNAL_SUFFIX = ".part.json"
+# Files smaller than this are fetched as a single range even when segments > 1
+SEGMENT_THRESHOLD = 64 * 1024 * 1024
+# How many bytes a segment writes between journal flushes
+JOURNAL_FLUSH_BYTES = 64 * 1024 * 1024
+
+
+def merge_ranges(ranges):
+    """Merge overlapping or touching [start, end) ranges into a sorted list."""
+    merged = []
+    for start, end in sorted(ranges):
+        if merged and start <= merged[-1][1]:
+            merged[-1][1] = max(merged[-1][1], end)
+        else:
+            merged.append([start, end])
+    return merged
+
+
+def missing_ranges(completed, size):
+    """Return the [start, end) ranges of a file of the given size not covered by completed."""
+    missing = []
+    position = 0
+    for start, end in merge_ranges(completed):
+        if start > position:
+            missing.append([position, start])
+        position = max(position, end)
+    if position < size:
+        missing.append([position, size])
+    return missing
+
+
+def split_ranges(ranges, size, segments):
+    """Cut the missing ranges on segment boundaries so they can be fetched in parallel."""
+    if segments <= 1 or size < SEGMENT_THRESHOLD:
+        return ranges
+    step = -(-size // segments)
+    pieces = []
+    for start, end in ranges:
+        while start < end:
+            boundary = min(end, (start // step + 1) * step)
+            pieces.append([start, boundary])
+            start = boundary
+    return pieces
+
+
+class DownloadJournal:
+    """
+    Sidecar file recording which byte ranges of a .part file are already on disk.
+
+    The journal also stores the size and validator (ETag/Last-Modified) of the remote
+    object, so a .part file is only resumed when it belongs to the same version.
+    """
+
+    def __init__(self, path, url, size, validator):
+        self.path = path
+        self.url = url
+        self.size = size
+        self.validator = validator
+        self.completed = []
+        self.lock = threading.Lock()
+
+    @classmethod
+    def load(cls, path, url, size, validator):
+        journal = cls(path, url, size, validator)
+        try:
+            with open(path) as file:
+                data = json.load(file)
+        except (FileNotFoundError, json.JSONDecodeError):
+            return journal
+        if data.get("size") == size and data.get("validator") == validator:
+            journal.completed = merge_ranges(data.get("completed", []))
+        return journal
+
+    def add(self, start, end):
+        with self.lock:
+            self.completed = merge_ranges(self.completed + [[start, end]])
+
+    def save(self):
+        with self.lock:
+            data = {"url": self.url, "size": self.size, "validator": self.validator, "completed": self.completed}
+            tmp_path = self.path + ".tmp"
+            with open(tmp_path, 'w') as file:
+                json.dump(data, file)
+            os.replace(tmp_path, self.path)
+
+    def missing(self):
+        with self.lock:
+            return missing_ranges(self.completed, self.size)
+
+
+def probe(url, session, timeout=REQUEST_TIMEOUT):
+    """Return (status, size, validator, accepts_ranges) for url using a one-byte ranged GET."""
+    with session.get(url, headers={"Range": "bytes=0-0"}, stream=True, timeout=timeout) as response:
+        if response.status_code == 416:
+            # Empty objects can't satisfy any range, let the plain download handle them
+            return 200, None, None, False
+        if response.status_code != 206:
+            return response.status_code, None, None, False
+        # Content-Range: bytes 0-0/12345
+        total = response.headers.get("Content-Range", "").rpartition("/")[2]
+        size = int(total) if total.isdigit() else None
+        validator = response.headers.get("ETag") or response.headers.get("Last-Modified")
+        return 200, size, validator, size is not None
+
+
+def fetch_range(url, part_path, start, end, journal, session, chunk_size, timeout):
+    """Download bytes [start, end) of url into part_path at the same offset."""
+    headers = {"Range": f"bytes={start}-{end - 1}"}
+    if journal.validator:
+        headers["If-Range"] = journal.validator
+    with session.get(url, headers=headers, stream=True, timeout=timeout) as response:
+        if response.status_code != 206:
+            raise DownloadError(f"Range request for {url} returned {response.status_code}")
+        position = start
+        unflushed = 0
+        with open(part_path, 'r+b') as file:
+            file.seek(start)
+            for chunk in response.iter_content(chunk_size=chunk_size):
+                chunk = chunk[:end - position]
+                file.write(chunk)
+                journal.add(position, position + len(chunk))
+                position += len(chunk)
+                unflushed += len(chunk)
+                if unflushed >= JOURNAL_FLUSH_BYTES:
+                    file.flush()
+                    journal.save()
+                    unflushed = 0
+                if position >= end:
+                    break
+    if position < end:
+        raise DownloadError(f"Range {start}-{end - 1} of {url} ended early at {position}")
+
+
+def resumable_download(url, dest_path, session=None, segments=1, chunk_size=CHUNK_SIZE, timeout=REQUEST_TIMEOUT):
+    """
+    Download url into dest_path, resuming a previous partial download if there is one.
+
+    Progress is kept in dest_path + ".part" with a journal of the byte ranges already
+    written next to it. With segments > 1, large files are split into that many ranges
+    fetched in parallel. Servers without Range support fall back to stream_download.
+    Returns the HTTP status code like stream_download. Without a session, one is opened
+    for this download and closed when it ends.
+    """
+    if session is None:
+        with requests.Session() as session:
+            return resumable_download(url, dest_path, session, segments, chunk_size, timeout)
+    status_code, size, validator, accepts_ranges = probe(url, session, timeout)
+    if status_code != 200:
+        return status_code
+    if not accepts_ranges:
+        return stream_download(url, dest_path, session=session, chunk_size=chunk_size, timeout=timeout)
+
+    part_path = dest_path + PART_SUFFIX
+    journal = DownloadJournal.load(dest_path + JOURNAL_SUFFIX, url, size, validator)
+    if not journal.completed or not os.path.exists(part_path):
+        journal.completed = []
+        with open(part_path, 'wb') as file:
+            file.truncate(size)
+
+    pieces = split_ranges(journal.missing(), size, segments)
+    try:
+        if len(pieces) > 1 and segments > 1:
+            with ThreadPoolExecutor(max_workers=segments) as executor:
+                futures = [executor.submit(fetch_range, url, part_path, start, end, journal, session, chunk_size, timeout)
+                           for start, end in pieces]
+                for future in futures:
+                    future.result()
+        else:
+            for start, end in pieces:
+                fetch_range(url, part_path, start, end, journal, session, chunk_size, timeout)
+    finally:
+        journal.save()
+
+    if journal.missing():
+        raise DownloadError(f"Download of {url} is still incomplete")
+    os.replace(part_path, dest_path)
+    remove_quietly(journal.path)
+    return 200
@@ -1,13 +1,21 @@
-import pandas as pd
+import argparse
 import os
-import json
 import subprocess
-from xml.etree import ElementTree as ET
 import urllib.parse
-import re
-import requests
+import struct
 import logging
 import boto3
+from destination_index import DestinationIndex
+from download_utils import resumable_download
+import grouping
+from grouping import GroupIndex
+from ism_rewriter import rewrite_ism_file
+from ism_writer import relative_src, write_ism
+from job_state import DEFAULT_DB_PATH, JobLedger
+from linode_uploader import TRANSFER_CONFIG
+from mp4_boxes import Mp4ParseError
+from mp4_triage import COPY, CORRUPT, make_session, triage
+from work_cache import WorkCache, link_or_copy
 
 # Logging configuration
 logging.basicConfig(filename='process_logs.log', level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
@@ -20,6 +28,8 @@ LICENSE_KEY_PATH = "/home/admin/scripts/mp4s/usp-license.key"
 BASE_URL = "https://your-hostname.com/delivery/"
 UPLOAD_BUCKET_NAME = "your-bucket-usp-content-1"
 BASE_PATH = "base_path/"
+# Parallel range requests used for each large MP4 download, unless --segments says otherwise
+DOWNLOAD_SEGMENTS = 4
 
 # Create session to upload content to linode bucket your-bucket-usp-content-1
 upload_session = boto3.Session(
@@ -28,6 +38,18 @@ upload_session = boto3.Session(
 )
 upload_client = upload_session.client('s3', region_name='us-ord-1', endpoint_url='https://us-ord-1.linodeobjects.com')
 
+# Pooled session and --segments for every download, set in __main__ so connections to the origin are reused
+download_session = None
+download_segments = DOWNLOAD_SEGMENTS
+# One pooled session for every triage with --triage, so each rendition doesn't open new connections to the origin
+triage_session = None
+# Repackaged outputs keyed by source object, so nothing is downloaded or split twice
+work_cache = WorkCache()
+# Progress of every object, opened in __main__ so reruns skip groups that were already uploaded
+ledger = None
+# Listing of the upload bucket with --skip-identical, so objects it already holds byte for byte aren't sent again
+destination = None
+
 # Function to extract the S3 upload path from CSV data
 def extract_upload_path(csv_row):
     # Assuming that 'Path' in the CSV contains the full S3 path
@@ -46,41 +68,21 @@ def decode_and_reencode_filename(url):
     # Return the new URL with the directory and re-encoded filename
     return os.path.join(directory, encoded_filename)
 
-# Function to create the csv file from th json file
-def create_csv_from_json(json_file):
-    with open(json_file, 'r') as f:
-        data = json.load(f)
-        filtered_data = [entry for entry in data if entry.get("Name", "").endswith(".mp4")]
-        df = pd.json_normalize(filtered_data)
-        csv_path = "output.csv"
-        df.to_csv(csv_path, index=False)
-        return csv_path
-
 # function to download content from netstorage
 def download_from_akamai(file_key, local_path):
     encoded_file_key = decode_and_reencode_filename(file_key)
     full_url = BASE_URL + encoded_file_key
     try:
-        response = requests.get(full_url)
         print(f"Downloading file {full_url}")
-        if response.status_code == 200:
-            with open(local_path, 'wb') as file:
-                file.write(response.content)
+        status_code = resumable_download(full_url, local_path, session=download_session, segments=download_segments)
+        if status_code == 200:
             logging.info(f"Successfully downloaded {file_key} to {local_path}")
+            ledger.mark(file_key, "downloaded")
         else:
-            logging.error(f"Failed to download {file_key}. Status code: {response.status_code}")
+            logging.error(f"Failed to download {file_key}. Status code: {status_code}")
     except Exception as e:
         logging.error(f"Error downloading {file_key}. Reason: {e}")
 
-# Function to extract the mp4 filename
-def generate_ism_filename_from_mp4(mp4_filename):
-    # Use regex to match everything up to the last underscore
-    match = re.match(r"^(.*)_.*\.mp4$", mp4_filename)
-    if match:
-        base_name = match.group(1)
-        return f"{base_name}.ism"
-    return None
-
 # Function to repackage the mp4s that were donwloaded previously
 def run_mp4split(input_file_path, output_file_path, license_key_path):
     #print(input_file_path)
@@ -90,16 +92,26 @@ def run_mp4split(input_file_path, output_file_path, license_key_path):
         subprocess.run(mp4split_command, check=True)
         logging.info(f"mp4split successful for: {os.path.basename(input_file_path)}")
         print(f"mp4split successful for: {os.path.basename(input_file_path)}")
+        return True
     except subprocess.CalledProcessError as e:
         logging.error(f"mp4split failed for: {os.path.basename(input_file_path)}, Error: {e}")
+        return False
 
 # Function to generate the ism file using the mp4s stored in GOOD_MP4_DIR
 def generate_ism(mp4_local_paths):
     # Extract the ISM filename from the first MP4 name
-    ism_filename = generate_ism_filename_from_mp4(os.path.basename(mp4_local_paths[0]))
+    ism_filename = grouping.ism_filename(relative_src(mp4_local_paths[0]))
     if not ism_filename:
         logging.error(f"Couldn't generate ISM filename for {mp4_local_paths[0]}")
         return False
+
+    # Build the manifest from the moov boxes; mp4split is only needed when they can't be parsed
+    try:
+        write_ism(mp4_local_paths, os.path.join(ISM_OUTPUT_DIR, ism_filename))
+        return True
+    except (Mp4ParseError, OSError, struct.error) as e:
+        logging.info(f"Native ISM generation failed for {mp4_local_paths[0]}, using mp4split. Reason: {e}")
+
     cmd = [
         "mp4split",
         f"--license-key={LICENSE_KEY_PATH}",
@@ -114,37 +126,6 @@ def generate_ism(mp4_local_paths):
         logging.error(f"ISM generation failed for {mp4_local_paths[0]}")
         return False
 
-# Function to modify the generated ism file. The ism file will grab the path that is used from the output and will make it the path when the url is being called. This
-# To avoid this from happening the ism file has to be modified so it only includes the file name as a relative path. As long as the mp4s are stored in object store 
-# within the same directory this will work
-def modify_ism_to_relative_path(ism_filename):
-    ism_file_path = os.path.join(ISM_OUTPUT_DIR, ism_filename)
-    tree = ET.parse(ism_file_path)
-    root = tree.getroot()
-
-    # Remove the namespaces from the XML file
-    for elem in root.iter():
-        if not hasattr(elem.tag, 'find'): continue  # Skip if it's not an element (like a comment)
-        i = elem.tag.find('}')
-        if i >= 0:
-            elem.tag = elem.tag[i+1:]
-
-    for audio in root.findall(".//audio"):
-        src = audio.get('src')
-        if src:
-            # Decoding the URL to make it human-readable
-            decoded_src = urllib.parse.unquote(src)
-            audio.set('src', os.path.basename(decoded_src))
-
-    for video in root.findall(".//video"):
-        src = video.get('src')
-        if src:
-            # Decoding the URL to make it human-readable
-            decoded_src = urllib.parse.unquote(src)
-            video.set('src', os.path.basename(decoded_src))
-
-    tree.write(ism_file_path, xml_declaration=True)
-
 # Function to generate the ism upload path
 def generate_upload_path(mp4_path, ism_filename):
     dir_path = os.path.dirname(mp4_path)
@@ -153,12 +134,17 @@ def generate_upload_path(mp4_path, ism_filename):
 # Function to upload the mp4 files to linode
 def upload_mp4_to_linode_boto3(file_key, local_path):
     print(f"Trying to upload {file_key} {local_path}")
+    if destination and destination.has_file(file_key, local_path):
+        print(f"Skipping {file_key}, identical object already uploaded")
+        return True
     try:
         with open(local_path, 'rb') as file:
-            upload_client.upload_fileobj(file, UPLOAD_BUCKET_NAME, file_key, ExtraArgs={'ACL': 'authenticated-read'})
+            upload_client.upload_fileobj(file, UPLOAD_BUCKET_NAME, file_key, ExtraArgs={'ACL': 'authenticated-read'}, Config=TRANSFER_CONFIG)
         logging.info(f"Successfully uploaded {local_path} to {file_key}")
+        return True
     except Exception as e:
         logging.error(f"Error uploading {local_path}. Reason: {e}")
+        return False
 
 # Function to generate the mp4 upload path
 def generate_mp4_upload_path(local_file_path, s3_upload_path):
@@ -177,13 +163,18 @@ def upload_to_linode(file_key, local_path):
     #print(local_path)
     print(file_key)
     if os.path.exists(local_path):
+        if destination and destination.has_file(file_key, local_path):
+            print(f"Skipping {file_key}, identical object already uploaded")
+            return True
         try:
-            upload_client.upload_file(local_path, UPLOAD_BUCKET_NAME, file_key, ExtraArgs={'ACL': 'authenticated-read'})
+            upload_client.upload_file(local_path, UPLOAD_BUCKET_NAME, file_key, ExtraArgs={'ACL': 'authenticated-read'}, Config=TRANSFER_CONFIG)
             logging.info(f"Successfully uploaded {local_path} to {file_key}")
+            return True
         except Exception as e:
             logging.error(f"Error uploading {local_path}. Reason: {e}")
     else:
         logging.error(f"upload_to_linode_ File not found: {local_path}")
+    return False
 
 # Function to delete the mp4 files 
 def clean_directory(directory_path):
@@ -191,104 +182,150 @@ def clean_directory(directory_path):
     for filename in os.listdir(directory_path):
         os.remove(os.path.join(directory_path, filename))
 
-# Function to generate the key to group all files
-def get_key_from_mp4_path(path):
+# Function to check whether a rendition was already uploaded from the same source object
+def is_fixed(row):
+    """
+    True when this exact source object (same Path, Size and ModTime) was already
+    repackaged and uploaded, so it needs no download, mp4split or upload.
+    """
+    checksum = work_cache.checksum_of(row)
+    if checksum is None or not ledger.is_done(row['Path'], "uploaded"):
+        return False
+    return ledger.get(row['Path'])['output_checksum'] == checksum
+
+# Function to get the repackaged mp4, downloading and running mp4split only on a cache miss
+def prepare_rendition(row):
     """
-    Derive the key from the mp4 path by stripping everything after the last underscore
+    Return the cached path of the repackaged MP4 for a listing entry, or None on failure.
+
+    Each source object is downloaded and repackaged at most once; later calls for the
+    same Path, Size and ModTime return the stored output.
     """
-    return re.sub(r"_.*\.mp4$", "", path)
+    cached_path = work_cache.lookup(row)
+    if cached_path:
+        return cached_path
+
+    # Read the box headers first, so corrupt files aren't downloaded and fine ones skip mp4split
+    verdict = None
+    if triage_session:
+        verdict, reason = triage(BASE_URL + decode_and_reencode_filename(row['Path']), session=triage_session)
+        if verdict == CORRUPT:
+            logging.error(f"Corrupt file {row['Path']}: {reason}")
+            ledger.mark_failed(row['Path'], "triage", reason)
+            return None
+
+    local_path = os.path.join(MP4_DIR, os.path.basename(row['Path']))
+    if not os.path.exists(local_path):
+        download_from_akamai(row['Path'], local_path)
+    if not os.path.exists(local_path):
+        return None
+
+    output_path = work_cache.scratch_path(row)
+    if verdict == COPY:
+        logging.info(f"{row['Path']} is progressive, skipping mp4split")
+        os.replace(local_path, output_path)
+    elif not run_mp4split(local_path, output_path, LICENSE_KEY_PATH):
+        return None
+    else:
+        os.remove(local_path)
+    checksum, cached_path = work_cache.store(row, output_path)
+    ledger.mark(row['Path'], "repackaged", output_checksum=checksum)
+    return cached_path
+
+# Function to generate a presigned url for a rendition that is already in the bucket
+def uploaded_rendition_url(row):
+    key = generate_mp4_upload_path(row['Path'], extract_upload_path(row))
+    return upload_client.generate_presigned_url('get_object', Params={'Bucket': UPLOAD_BUCKET_NAME, 'Key': key}, ExpiresIn=3600)
 
 # Function to proces one key at a time
-def process_single_key_group(group_df, s3_upload_path):
+def process_single_key_group(group_entries):
     """
-    Process a group of rows from the CSV that share the same key.
+    Process the listing entries of one rendition group.
     """
-    # Create a list to store the downloaded MP4 files
-    mp4_local_paths = []
-
-    for _, row in group_df.iterrows():
-        local_path = os.path.join(MP4_DIR, os.path.basename(row['Path']))
-        
-        # Check if the MP4 file has already been downloaded
-        if not os.path.exists(local_path):
-            download_from_akamai(row['Path'], local_path)
-        
-        mp4_local_paths.append(local_path)
-
-    # Generate ISM filename once for the group
-    ism_filename = generate_ism_filename_from_mp4(os.path.basename(mp4_local_paths[0]))
-
-    # Run mp4split for each downloaded MP4 and move them to good-mp4s directory
-    for input_file_path in mp4_local_paths:
-        output_file_path = os.path.join(GOOD_MP4_DIR, os.path.basename(input_file_path))
-        run_mp4split(input_file_path, output_file_path, LICENSE_KEY_PATH)
-        # Add BASE_PATH to s3_upload_path
-        #mp4_linode_upload_path = os.path.join(BASE_PATH, s3_upload_path, output_file_path) 
-        
-
-        # Extract the file name from the local path
-        clean_file_name = os.path.basename(output_file_path)
+    # Locations the ISM is generated from: local files, or the uploaded objects for fixed renditions
+    mp4_locations = []
+    prepared_rows = []
+
+    for row in group_entries:
+        cached_path = work_cache.lookup(row)
+        if is_fixed(row) and not cached_path:
+            print(f"Skipping {row['Path']}, already fixed")
+            mp4_locations.append(uploaded_rendition_url(row))
+            continue
+
+        cached_path = cached_path or prepare_rendition(row)
+        if not cached_path:
+            logging.error(f"Couldn't prepare {row['Path']}, skipping group")
+            clean_directory(GOOD_MP4_DIR)
+            return
+        checksum = work_cache.checksum_of(row)
+        prepared_rows.append(row)
+
+        # The ISM refers to the renditions by file name, so expose the cached output under its own name
+        output_file_path = os.path.join(GOOD_MP4_DIR, os.path.basename(row['Path']))
+        link_or_copy(cached_path, output_file_path)
+        mp4_locations.append(output_file_path)
+
+        if is_fixed(row):
+            continue
         # Generate the correct upload path for Linode
-        linode_upload_path = generate_mp4_upload_path(output_file_path, s3_upload_path)
-        print(linode_upload_path) 
+        linode_upload_path = generate_mp4_upload_path(output_file_path, extract_upload_path(row))
+        print(linode_upload_path)
         # Upload the file
-        upload_mp4_to_linode_boto3(linode_upload_path, output_file_path)
-        
-    
+        if upload_mp4_to_linode_boto3(linode_upload_path, output_file_path):
+            ledger.mark(row['Path'], "uploaded", output_checksum=checksum)
 
     # Generate ISM after mp4split
-    generate_ism(mp4_local_paths)
-    if generate_ism:
-        # Get the correct ISM filename from the first downloaded MP4.
-        ism_filename = generate_ism_filename_from_mp4(os.path.basename(mp4_local_paths[0]))
-
-        # Ensure we have the filename, else skip the iteration.
-        if not ism_filename:
-            logging.error(f"Couldn't derive ISM filename for {mp4_local_paths[0]}")
-            return
+    if generate_ism(mp4_locations):
+        # Get the correct ISM filename from the first MP4 of the group.
+        first_mp4_path = group_entries[0]['Path']
+        ism_filename = grouping.ism_filename(first_mp4_path)
 
-        # Modify the ISM to set relative paths.
-        modify_ism_to_relative_path(ism_filename)
+        # Modify the ISM to set relative paths. The ism file will grab the path that is used from the output, so only the
+        # file name is kept. As long as the mp4s are stored in object store within the same directory this will work
+        rewrite_ism_file(os.path.join(ISM_OUTPUT_DIR, ism_filename))
 
         # 3. Upload the ISM file
-        first_mp4_path = group_df.iloc[0]['Path']  # Get the path of the first mp4 from the dataframe
         upload_path = generate_upload_path(first_mp4_path, ism_filename)  # Derive the upload path
-        upload_to_linode(upload_path, os.path.join(ISM_OUTPUT_DIR, ism_filename))
+        if upload_to_linode(upload_path, os.path.join(ISM_OUTPUT_DIR, ism_filename)):
+            ledger.mark(grouping.ism_path(grouping.group_key(first_mp4_path)), "uploaded")
 
-    # Cleanup. Remove the old mp4s.
-    clean_directory(MP4_DIR)
+    # Cleanup. Drop the outputs of renditions that made it to the bucket, the fingerprints stay recorded.
+    for row in prepared_rows:
+        if is_fixed(row):
+            work_cache.evict(work_cache.checksum_of(row))
+    clean_directory(GOOD_MP4_DIR)
 
 
 def main():
     json_file = "mising-mp4s.json"
-    csv_path = create_csv_from_json(json_file)
-
-    df = pd.read_csv(csv_path)
-
-    # Get unique keys from the paths
-    df['key'] = df['Path'].apply(get_key_from_mp4_path)
-    unique_keys = df['key'].unique()
-
-    for key in unique_keys:
-        group_df = df[df['key'] == key]
-
 
-        # 1. Download MP4 files from Akamai
-        mp4_local_paths = []
-        for _, row in group_df.iterrows():
-            # Update s3_upload_path for each row (mp4 file)
-            s3_upload_path = extract_upload_path(row)
-            local_path = os.path.join(MP4_DIR, os.path.basename(row['Path']))
-            download_from_akamai(row['Path'], local_path)
-            mp4_local_paths.append(local_path)
+    # Group the renditions of every title in a single pass over the listing
+    group_index = GroupIndex.from_listing(json_file)
+    if destination:
+        destination.refresh(BASE_PATH)
 
-        # 2. Run mp4split for each downloaded MP4 and move them to good-mp4s directory
-        for input_file_path in mp4_local_paths:
-            output_file_path = os.path.join(GOOD_MP4_DIR, os.path.basename(input_file_path))
-            run_mp4split(input_file_path, output_file_path, LICENSE_KEY_PATH)
+    for key, group_entries in group_index.items():
+        if ledger.is_done(grouping.ism_path(key), "uploaded") and all(is_fixed(row) for row in group_entries):
+            print(f"Skipping {key}, already uploaded")
+            continue
 
-        # 3. Process the group of MP4 files
-        process_single_key_group(group_df, s3_upload_path)
+        # Download, repackage and upload every rendition once, then generate and upload the ISM
+        process_single_key_group(group_entries)
 
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Repackage MP4s, generate their ISM and upload both to Linode")
+    parser.add_argument("--ledger", default=DEFAULT_DB_PATH, help="SQLite job ledger used to skip finished groups")
+    parser.add_argument("--segments", type=int, default=DOWNLOAD_SEGMENTS, help="Parallel range requests per large file")
+    parser.add_argument("--triage", action="store_true", help="Read the box headers first: skip corrupt files and copy progressive ones without mp4split")
+    parser.add_argument("--skip-identical", action="store_true", help="List the destination once and skip files it already holds with the same size and checksum")
+    args = parser.parse_args()
+
+    ledger = JobLedger(args.ledger)
+    download_segments = args.segments
+    download_session = make_session(pool_size=max(args.segments, 1))
+    if args.triage:
+        triage_session = make_session()
+    if args.skip_identical:
+        destination = DestinationIndex(upload_client, UPLOAD_BUCKET_NAME)
     main()
@@ -1,34 +1,22 @@
 import argparse
 import pandas as pd
-import json
 import os
 import requests
 import subprocess
-from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from concurrent.futures import ThreadPoolExecutor
 from urllib.parse import quote
 import gc
 import shutil
+from download_utils import remove_quietly, resumable_download
+from destination_index import DestinationIndex
+from job_state import DEFAULT_DB_PATH, JobLedger, file_md5, in_shard, parse_shard
+from linode_uploader import LinodeUploader
+from manifest_reader import iter_entries, write_csv_chunks
+from mp4_triage import COPY, CORRUPT, triage, triage_many
+from mp4split_scheduler import Mp4splitScheduler
+from pipeline import Pipeline, Stage
 
 
-def create_csv(json_file):
-    with open(json_file) as data:
-        json_data = json.load(data)
-        filtered_data = [entry for entry in json_data if entry.get("Name", "").endswith(".mp4")]
-        df = pd.json_normalize(filtered_data)
-        print("Printing JSON to CSV")
-        print(df)
-        df.to_csv("test_missing_flattened_output.csv", index=False)
-        del df
-        gc.collect()
-        return "test_missing_flattened_output.csv"
-
-def split_csv(input_csv, output_dir, chunk_size):
-    os.makedirs(output_dir, exist_ok=True)
-    for i, chunk in enumerate(pd.read_csv(input_csv, chunksize=chunk_size)):
-        chunk.to_csv(os.path.join(output_dir, f"output_{i}.csv"), index=False)
-        del chunk
-        gc.collect()
-
 def get_details_from_csv(csv_file):
     df = pd.read_csv(csv_file, usecols=["Name", "Path"])
     names, paths = df["Name"], df["Path"]
@@ -36,24 +24,23 @@ def get_details_from_csv(csv_file):
     gc.collect()
     return names, paths
 
-def download_file(base_url, path, download_dir, error_dir):
+def file_url(base_url, path):
+    encoded_path = os.path.join(os.path.dirname(path), quote(os.path.basename(path)))  # encoding only the file name
+    return f"{base_url}/{encoded_path}"
+
+def download_file(base_url, path, download_dir, error_dir, segments=1, session=None):
     download_errors_file = os.path.join(error_dir, "download_errors")
-    session = requests.Session()
     file_name = os.path.basename(path)
-    encoded_path = os.path.join(os.path.dirname(path), quote(file_name))  # encoding only the file name
-    full_url = f"{base_url}/{encoded_path}"
+    full_url = file_url(base_url, path)
+    download_path = os.path.join(download_dir, file_name)
     try:
-        response = session.get(full_url)
-        if response.status_code == 200:
-            print(f"Successfully downloaded: {file_name}")
-            download_path = os.path.join(download_dir, file_name)
-            with open(download_path, 'wb') as file:
-                file.write(response.content)
+        status_code = resumable_download(full_url, download_path, session=session, segments=segments)
+        if status_code == 200:
             print(f"Saved {file_name} to {download_path}")
         else:
-            print(f"Failed to download: {file_name}, Status code: {response.status_code}")
+            print(f"Failed to download: {file_name}, Status code: {status_code}")
             with open(download_errors_file, 'a') as err_file:
-                err_file.write(f"Failed to download: {file_name}, Status code: {response.status_code}\n")
+                err_file.write(f"Failed to download: {file_name}, Status code: {status_code}\n")
         return True
     except requests.exceptions.RequestException as e:
         print(f"Request for {file_name} failed: {e}")
@@ -61,9 +48,14 @@ def download_file(base_url, path, download_dir, error_dir):
             err_file.write(f"Request for {file_name} failed: {e}\n")
         return False
 
-def make_http_requests(base_url, paths, download_dir, error_dir, max_requests=10):
+def make_http_requests(base_url, paths, download_dir, error_dir, max_requests=10, segments=1):
+    # One pooled session for all workers so connections to the origin are reused
+    session = requests.Session()
+    adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=max_requests)
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
     with ThreadPoolExecutor(max_workers=max_requests) as executor:
-        results = list(executor.map(download_file, [base_url]*len(paths), paths, [download_dir]*len(paths), [error_dir]*len(paths)))
+        results = list(executor.map(download_file, [base_url]*len(paths), paths, [download_dir]*len(paths), [error_dir]*len(paths), [segments]*len(paths), [session]*len(paths)))
 
 
 
@@ -74,46 +66,214 @@ def run_mp4split_parallel(args):
         subprocess.run(mp4split_command, check=True)
         print(f"mp4split successful for: {os.path.basename(input_file_path)}")
         return True
-    except subprocess.CalledProcessError as e:
+    except (subprocess.CalledProcessError, OSError) as e:
         print(f"mp4split failed for: {os.path.basename(input_file_path)}, Error: {e}")
         return False
 
-def run_mp4split(input_dir, output_dir, names, license_key_path, error_dir, parallel_count=12):
+def run_mp4split(input_dir, output_dir, names, license_key_path, error_dir, max_workers=None):
     mp4split_errors_file = os.path.join(error_dir, "mp4split_errors")
-    os.makedirs(output_dir, exist_ok=True)
-
-    # Filter mp4 names
-    mp4_names = [name for name in names if name.endswith(".mp4")]
 
-    # Create arguments list for parallel execution
-    args_list = [(os.path.join(input_dir, name), os.path.join(output_dir, name), license_key_path) for name in mp4_names]
+    # Filter mp4 names, skipping the ones that failed to download
+    input_paths = [os.path.join(input_dir, name) for name in names if name.endswith(".mp4")]
+    input_paths = [path for path in input_paths if os.path.exists(path)]
 
-    # Run mp4split in parallel using ProcessPoolExecutor
-    with ProcessPoolExecutor(max_workers=parallel_count) as executor:
-        results = list(executor.map(run_mp4split_parallel, args_list))
+    # Launch the mp4split children directly, largest first, sized from the cores and disk throughput
+    scheduler = Mp4splitScheduler(license_key_path, output_dir, max_workers=max_workers,
+                                  results_path=os.path.join(error_dir, "mp4split_results.jsonl"))
+    results = scheduler.run(input_paths)
 
     # Check results and log any errors
-    for success, name in zip(results, mp4_names):
-        if not success:
+    for result in results:
+        if result["exit_code"] != 0:
             with open(mp4split_errors_file, 'a') as err_file:
-                err_file.write(f"mp4split failed for: {name}\n")
+                err_file.write(f"mp4split failed for: {result['file']}\n")
+
+
+def triage_files(base_url, pending, error_dir, ledger=None, workers=32):
+    """
+    Triage (name, path) pairs from their box headers before anything is downloaded.
 
+    Returns the pairs still worth downloading and the names of the ones that are fine
+    as they are and can skip mp4split. Corrupt files are logged and left out.
+    """
+    triage_errors_file = os.path.join(error_dir, "triage_corrupt")
+    verdicts = triage_many([file_url(base_url, path) for _, path in pending], workers=workers)
+    keep = []
+    copy_names = set()
+    for name, path in pending:
+        verdict, reason = verdicts[file_url(base_url, path)]
+        if verdict == CORRUPT:
+            print(f"Skipping corrupt file {path}: {reason}")
+            with open(triage_errors_file, 'a') as err_file:
+                err_file.write(f"Corrupt: {path}. {reason}\n")
+            if ledger:
+                ledger.mark_failed(path, "triage", reason)
+            continue
+        if verdict == COPY:
+            copy_names.add(name)
+        keep.append((name, path))
+    return keep, copy_names
+
+def move_unchanged(input_dir, output_dir, names):
+    """Move files that need no repackaging straight to the upload directory."""
+    os.makedirs(output_dir, exist_ok=True)
+    for name in names:
+        if os.path.exists(os.path.join(input_dir, name)):
+            os.replace(os.path.join(input_dir, name), os.path.join(output_dir, name))
+
+def upload_file_to_linode(source_file_path, path, linode_remote):
+    upload_path = os.path.dirname(path)
+    upload_command = ["rclone", "copy", "--progress", "--checksum", "--bwlimit", "175M", "--s3-acl", "authenticated-read", source_file_path, f"{linode_remote}{upload_path}"]
+    subprocess.run(upload_command, check=True)
+    print(f"Upload to Linode Object Storage successful for: {os.path.basename(source_file_path)} {upload_path} {linode_remote}")
 
 def upload_to_linode_object_storage(source_dir, linode_remote, error_dir, csv_file, names):
     linode_errors_file = os.path.join(error_dir, "linode_errors")
-    try:
+    failed = []
+    for name, path in zip(names, paths):
+        if name.endswith(".mp4"):
+            try:
+                upload_file_to_linode(os.path.join(source_dir, name), path, linode_remote)
+            except subprocess.CalledProcessError as e:
+                print(f"Upload to Linode Object Storage failed. Error: {e}")
+                with open(linode_errors_file, 'a') as err_file:
+                    err_file.write(f"Upload to Linode Object Storage failed for {path}. Error: {e}\n")
+                failed.append(path)
+    return failed
+
+def upload_key(bucket_prefix, path, name):
+    """Object key rclone would have written the file to when copying it into the path's directory."""
+    return os.path.join(bucket_prefix, os.path.dirname(path), name)
+
+def upload_with_boto3(uploader, source_dir, bucket_prefix, error_dir, names, paths):
+    linode_errors_file = os.path.join(error_dir, "linode_errors")
+    uploads = [(os.path.join(source_dir, name), upload_key(bucket_prefix, path, name))
+               for name, path in zip(names, paths) if name.endswith(".mp4")]
+    return uploader.upload_many(uploads, linode_errors_file)
+
+def iter_csv_entries(csv_file_paths):
+    """Yield (name, path) for every MP4 listed in the given CSV chunks."""
+    for csv_file_path in csv_file_paths:
+        names, paths = get_details_from_csv(csv_file_path)
         for name, path in zip(names, paths):
             if name.endswith(".mp4"):
-                source_file_path = os.path.join(source_dir, name)
-                remote_file_path = os.path.join(path)
-                upload_path = os.path.dirname(remote_file_path)
-                upload_command = ["rclone", "copy", "--progress", "--bwlimit", "175M", "--s3-acl", "authenticated-read", source_file_path, f"{linode_remote}{upload_path}"]
-                subprocess.run(upload_command, check=True)
-                print(f"Upload to Linode Object Storage successful for: {name} {upload_path} {linode_remote}")
-    except subprocess.CalledProcessError as e:
-        print(f"Upload to Linode Object Storage failed. Error: {e}")
-        with open(linode_errors_file, 'a') as err_file:
-            err_file.write(f"Upload to Linode Object Storage failed. Error: {e}\n")
+                yield name, path
+
+def iter_manifest_entries(json_file):
+    """Yield (name, path) for every MP4 in an rclone lsjson listing, parsed as a stream."""
+    for entry in iter_entries(json_file, suffix=".mp4"):
+        yield entry["Name"], entry["Path"]
+
+def iter_ledger_entries(ledger, shard=None):
+    """Yield (name, path) for every MP4 in the ledger that hasn't been uploaded yet."""
+    for path in ledger.pending("uploaded", shard=shard, suffix=".mp4"):
+        yield os.path.basename(path), path
+
+def skip_completed(entries, ledger, shard=None):
+    """Drop entries outside this shard or already uploaded according to the ledger."""
+    for name, path in entries:
+        if in_shard(path, shard) and not ledger.is_done(path, "uploaded"):
+            yield name, path
+
+def run_pipeline(base_url, entries, download_dir, output_dir, license_key_path, linode_remote, error_dir, args,
+                 uploader=None, bucket_prefix="", ledger=None):
+    """Download, repackage and upload every file as it becomes ready instead of per CSV chunk."""
+    os.makedirs(output_dir, exist_ok=True)
+    mp4split_errors_file = os.path.join(error_dir, "mp4split_errors")
+    linode_errors_file = os.path.join(error_dir, "linode_errors")
+    session = requests.Session()
+    adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=args.download_workers)
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+
+    def download(entry):
+        name, path = entry
+        download_file(base_url, path, download_dir, error_dir, segments=args.segments, session=session)
+        if not os.path.exists(os.path.join(download_dir, name)):
+            if ledger:
+                ledger.mark_failed(path, "download", "download failed")
+            return None
+        if ledger:
+            ledger.mark(path, "downloaded")
+        return entry
+
+    verdicts = {}
+
+    def triage_entry(entry):
+        name, path = entry
+        verdict, reason = triage(file_url(base_url, path), session)
+        if verdict == CORRUPT:
+            with open(os.path.join(error_dir, "triage_corrupt"), 'a') as err_file:
+                err_file.write(f"Corrupt: {path}. {reason}\n")
+            if ledger:
+                ledger.mark_failed(path, "triage", reason)
+            return None
+        verdicts[path] = verdict
+        return entry
+
+    def repackage(entry):
+        name, path = entry
+        input_file_path = os.path.join(download_dir, name)
+        if verdicts.get(path) == COPY:
+            os.replace(input_file_path, os.path.join(output_dir, name))
+            if ledger:
+                ledger.mark(path, "repackaged", output_checksum=file_md5(os.path.join(output_dir, name)))
+            return entry
+        try:
+            succeeded = run_mp4split_parallel((input_file_path, os.path.join(output_dir, name), license_key_path))
+        finally:
+            # The input counts against the free space gate however mp4split ended
+            remove_quietly(input_file_path)
+        if not succeeded:
+            remove_quietly(os.path.join(output_dir, name))
+            with open(mp4split_errors_file, 'a') as err_file:
+                err_file.write(f"mp4split failed for: {name}\n")
+            if ledger:
+                ledger.mark_failed(path, "repackage", "mp4split failed")
+            return None
+        if ledger:
+            ledger.mark(path, "repackaged", output_checksum=file_md5(os.path.join(output_dir, name)))
+        return entry
+
+    def upload(entry):
+        name, path = entry
+        source_file_path = os.path.join(output_dir, name)
+        try:
+            if uploader:
+                uploader.upload_file(source_file_path, upload_key(bucket_prefix, path, name))
+            else:
+                upload_file_to_linode(source_file_path, path, linode_remote)
+            if ledger:
+                ledger.mark(path, "uploaded")
+            return entry
+        except Exception as e:
+            print(f"Upload to Linode Object Storage failed. Error: {e}")
+            with open(linode_errors_file, 'a') as err_file:
+                err_file.write(f"Upload to Linode Object Storage failed for {path}. Error: {e}\n")
+            if ledger:
+                ledger.mark_failed(path, "upload", e)
+            return None
+        finally:
+            remove_quietly(source_file_path)
+
+    stages = [
+        Stage("download", download, workers=args.download_workers),
+        Stage("mp4split", repackage, workers=args.mp4split_workers or os.cpu_count()),
+        Stage("upload", upload, workers=args.upload_workers),
+    ]
+    if args.triage:
+        stages.insert(0, Stage("triage", triage_entry, workers=args.download_workers))
+    pipeline = Pipeline(stages, max_in_flight=args.max_in_flight, scratch_dir=download_dir,
+                        min_free_bytes=args.min_free_gb * 1024 ** 3)
+    pipeline.run(entries)
+
+def record_progress(ledger, names, paths, directory, state):
+    """Mark every file of a batch that made it into directory as having reached state."""
+    for name, path in zip(names, paths):
+        local_path = os.path.join(directory, name)
+        if os.path.exists(local_path):
+            checksum = file_md5(local_path) if state == "repackaged" else None
+            ledger.mark(path, state, output_checksum=checksum)
 
 def clear_directory(directory_path):
     """Delete all files in a specified directory."""
@@ -128,23 +288,67 @@ def clear_directory(directory_path):
         except Exception as e:
             print(f"Failed to delete {file_path}. Reason: {e}")
 
+def make_uploader(args, bucket_name, bucket_prefix):
+    """The in-process uploader for --uploader boto3; with --skip-identical it skips files the bucket already holds."""
+    if args.uploader != "boto3":
+        return None
+    uploader = LinodeUploader(bucket_name, bandwidth_limit=args.bwlimit, max_parallel_files=args.upload_workers)
+    if args.skip_identical:
+        uploader.index = DestinationIndex(uploader.client, bucket_name, db_path=args.ledger)
+        uploader.index.refresh(bucket_prefix)
+    return uploader
+
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description="Process smaller CSVs in a specified range")
     parser.add_argument("--generate-csvs", action="store_true", help="Generate CSVs and exit")
     parser.add_argument("--start", type=int, help="Start index of CSV range")
     parser.add_argument("--end", type=int, help="End index of CSV range")
+    parser.add_argument("--segments", type=int, default=1, help="Parallel range requests per large file")
+    parser.add_argument("--async-downloads", action="store_true", help="Download with the asyncio transfer engine")
+    parser.add_argument("--concurrency", type=int, default=10, help="Concurrent downloads")
+    parser.add_argument("--per-host", type=int, default=50, help="Connection limit per host for --async-downloads")
+    parser.add_argument("--pipeline", action="store_true", help="Stream files through download, mp4split and upload stages")
+    parser.add_argument("--download-workers", type=int, default=10, help="Download workers for --pipeline")
+    parser.add_argument("--mp4split-workers", type=int, help="mp4split processes, by default one per core, fewer while the disk is contended")
+    parser.add_argument("--upload-workers", type=int, default=4, help="Parallel file uploads")
+    parser.add_argument("--max-in-flight", type=int, default=50, help="Files allowed on local disk at once for --pipeline")
+    parser.add_argument("--uploader", choices=["boto3", "rclone"], default="boto3", help="Upload in-process with boto3 or with one rclone per file")
+    parser.add_argument("--bwlimit", default="175M", help="Total upload bandwidth limit for --uploader boto3, e.g. 175M or off")
+    parser.add_argument("--ledger", default=DEFAULT_DB_PATH, help="SQLite job ledger used to skip finished files")
+    parser.add_argument("--shard", help="Only process shard i of n, e.g. 0/4")
+    parser.add_argument("--triage", action="store_true", help="Read the box headers first: skip corrupt files and upload progressive ones without mp4split")
+    parser.add_argument("--skip-identical", action="store_true", help="List the destination once and skip files it already holds with the same size and checksum")
+    parser.add_argument("--manifest", help="Run the pipeline straight from this rclone lsjson listing instead of CSV chunks")
+    parser.add_argument("--from-ledger", action="store_true", help="Run the pipeline over every unfinished MP4 in the ledger instead of CSV chunks")
+    parser.add_argument("--min-free-gb", type=int, default=20, help="Pause downloads below this much free disk for --pipeline")
     args = parser.parse_args()
+    ledger = JobLedger(args.ledger)
+    shard = parse_shard(args.shard)
 
     license_key_path = "/home/admin/scripts/mp4s/usp-license.key"
     linode_remote = "your-repo-prod-chicago:prod-your-repo-usp-content-1/delivery/"
+    bucket_name = "prod-your-repo-usp-content-1"
+    bucket_prefix = "delivery/"
 
     if args.generate_csvs:
         json_file_name = "test_stream_missing.json"
-        create_csv(json_file_name)
         chunk_size = 75
         output_dir = "missing_smaller_csvs"
-        split_csv("missing_flattened_output.csv", output_dir, chunk_size)
+        write_csv_chunks(iter_entries(json_file_name, suffix=".mp4"), output_dir, chunk_size, on_chunk=ledger.discover)
         print("CSV generation and splitting completed.")
+    elif args.from_ledger or args.manifest:
+        base_url = "https://your-host-a.akamaihd.net/delivery/"
+        download_dir = "bad-mp4s"
+        os.makedirs(download_dir, exist_ok=True)
+        error_dir = "errors"
+        os.makedirs(error_dir, exist_ok=True)
+        uploader = make_uploader(args, bucket_name, bucket_prefix)
+        if args.manifest:
+            entries = skip_completed(iter_manifest_entries(args.manifest), ledger, shard)
+        else:
+            entries = iter_ledger_entries(ledger, shard)
+        run_pipeline(base_url, entries, download_dir, "good-mp4s", license_key_path, linode_remote,
+                     error_dir, args, uploader=uploader, bucket_prefix=bucket_prefix, ledger=ledger)
     else:
         if args.start is None or args.end is None:
             print("Error: Both --start and --end arguments are required for processing CSVs.")
@@ -157,9 +361,15 @@ if __name__ == "__main__":
             error_dir = "errors"
             os.makedirs(error_dir, exist_ok=True)
             smaller_csv_files.sort(key=lambda x: int(x.split('_')[-1].split('.')[0]))
+            uploader = make_uploader(args, bucket_name, bucket_prefix)
 
             if args.start < 0 or args.start >= len(smaller_csv_files) or args.end < 0 or args.end >= len(smaller_csv_files):
                 print("Invalid start and/or end index. Please provide valid indices.")
+            elif args.pipeline:
+                csv_file_paths = [os.path.join("missing_smaller_csvs", smaller_csv_files[i]) for i in range(args.start, args.end + 1)]
+                entries = skip_completed(iter_csv_entries(csv_file_paths), ledger, shard)
+                run_pipeline(base_url, entries, download_dir, "good-mp4s", license_key_path, linode_remote, error_dir, args,
+                             uploader=uploader, bucket_prefix=bucket_prefix, ledger=ledger)
             else:
                 for i in range(args.start, args.end + 1):
                     csv_file = smaller_csv_files[i]
@@ -167,10 +377,31 @@ if __name__ == "__main__":
                     csv_file_path = os.path.join("missing_smaller_csvs", csv_file)
                     
                     names, paths = get_details_from_csv(csv_file_path)
+                    pending = list(skip_completed(zip(names, paths), ledger, shard))
+                    copy_names = set()
+                    if args.triage:
+                        pending, copy_names = triage_files(base_url, pending, error_dir, ledger, workers=args.concurrency)
+                    names = [name for name, _ in pending]
+                    paths = [path for _, path in pending]
                     
-                    make_http_requests(base_url, paths, download_dir, error_dir)
-                    run_mp4split(download_dir, "good-mp4s", names, license_key_path, error_dir)
-                    upload_to_linode_object_storage("good-mp4s", linode_remote, error_dir, csv_file_path, names)
+                    if args.async_downloads:
+                        from async_transfer import download_all
+                        download_all(base_url, paths, download_dir, error_dir, concurrency=args.concurrency, per_host=args.per_host)
+                    else:
+                        make_http_requests(base_url, paths, download_dir, error_dir, max_requests=args.concurrency, segments=args.segments)
+                    record_progress(ledger, names, paths, download_dir, "downloaded")
+                    move_unchanged(download_dir, "good-mp4s", copy_names)
+                    run_mp4split(download_dir, "good-mp4s", [name for name in names if name not in copy_names],
+                                 license_key_path, error_dir, max_workers=args.mp4split_workers)
+                    record_progress(ledger, names, paths, "good-mp4s", "repackaged")
+                    if uploader:
+                        failed_keys = set(upload_with_boto3(uploader, "good-mp4s", bucket_prefix, error_dir, names, paths))
+                        failed = {path for name, path in zip(names, paths) if upload_key(bucket_prefix, path, name) in failed_keys}
+                    else:
+                        failed = set(upload_to_linode_object_storage("good-mp4s", linode_remote, error_dir, csv_file_path, names))
+                    for path in paths:
+                        if path not in failed and ledger.is_done(path, "repackaged"):
+                            ledger.mark(path, "uploaded")
 
               # Clearing the bad-mp4s and good-mp4s directories
                 clear_directory("bad-mp4s")
@@ -1,7 +1,5 @@
 #!/bin/bash
 
-# Assuming your input is in 'input.txt'
-sed -n '/\.mp4\"$/{
-        s/\"//g
-        s/_[^_]*\.mp4$/_,4500k,2500k,1000k,750k,400k,.mp4.csmil\/master.m3u8/p
-}' linodePathJson.txt > url-list.txt
+# One playback URL per title, built from the renditions actually in the listing:
+# dir/title_,4500k,1000k,.mp4.csmil/master.m3u8. Extra arguments are passed through, e.g. --base-url https://host/
+python3 "$(dirname "$0")/url_list.py" all_files_linode.json --output url-list.txt "$@"
@@ -0,0 +1,112 @@
+import argparse
+import json
+import os
+
+from manifest_reader import iter_entries
+
+
+def split_rendition(path):
+    """
+    Split an MP4 path into its group key and rendition, e.g. dir/title_4500k.mp4 -> (dir/title, 4500k).
+
+    The key is the directory plus the file name up to its last underscore, so every
+    bitrate of a title shares it and titles in different directories never do. Files
+    without an underscore form a group of their own with an empty rendition.
+    """
+    directory, file_name = os.path.split(path)
+    stem = file_name[:-4] if file_name.endswith(".mp4") else file_name
+    base, separator, rendition = stem.rpartition("_")
+    if not separator:
+        base, rendition = stem, ""
+    return (f"{directory}/{base}" if directory else base), rendition
+
+
+def group_key(path):
+    return split_rendition(path)[0]
+
+
+def ism_path(key):
+    """Path of the .ism manifest for a group, next to its MP4s."""
+    return f"{key}.ism"
+
+
+def ism_filename(path):
+    """File name of the .ism manifest for the group an MP4 belongs to."""
+    return os.path.basename(ism_path(group_key(path)))
+
+
+class GroupIndex:
+    """
+    Hash index from group key to the listing entries of its renditions.
+
+    Built in a single pass over a listing; lookups by key or by any member path are
+    O(1). The index can be saved next to the listing so later runs skip the rebuild.
+    """
+
+    def __init__(self):
+        self.groups = {}
+
+    def add(self, entry):
+        self.groups.setdefault(group_key(entry["Path"]), []).append(entry)
+
+    @classmethod
+    def build(cls, entries):
+        index = cls()
+        for entry in entries:
+            index.add(entry)
+        return index
+
+    def get(self, key):
+        return self.groups.get(key, [])
+
+    def group_of(self, path):
+        return self.get(group_key(path))
+
+    def keys(self):
+        return self.groups.keys()
+
+    def items(self):
+        return self.groups.items()
+
+    def __len__(self):
+        return len(self.groups)
+
+    def __contains__(self, key):
+        return key in self.groups
+
+    def save(self, index_path):
+        tmp_path = index_path + ".tmp"
+        with open(tmp_path, 'w') as file:
+            for key, entries in self.groups.items():
+                file.write(json.dumps({"key": key, "entries": entries}) + "\n")
+        os.replace(tmp_path, index_path)
+
+    @classmethod
+    def load(cls, index_path):
+        index = cls()
+        with open(index_path) as file:
+            for line in file:
+                group = json.loads(line)
+                index.groups[group["key"]] = group["entries"]
+        return index
+
+    @classmethod
+    def from_listing(cls, json_file, index_path=None):
+        """Load the saved index for json_file if it's up to date, otherwise build and save it."""
+        index_path = index_path or json_file + ".groups.jsonl"
+        if os.path.exists(index_path) and os.path.getmtime(index_path) >= os.path.getmtime(json_file):
+            return cls.load(index_path)
+        index = cls.build(iter_entries(json_file, suffix=".mp4"))
+        index.save(index_path)
+        return index
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Build the rendition group index for an rclone lsjson listing")
+    parser.add_argument("listing", help="rclone lsjson listing")
+    parser.add_argument("--output", help="Index file, defaults to <listing>.groups.jsonl")
+    args = parser.parse_args()
+
+    index = GroupIndex.build(iter_entries(args.listing, suffix=".mp4"))
+    index.save(args.output or args.listing + ".groups.jsonl")
+    print(f"Indexed {sum(len(entries) for entries in index.groups.values())} MP4s in {len(index)} groups")
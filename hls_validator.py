@@ -0,0 +1,199 @@
+import argparse
+import asyncio
+import csv
+import json
+import math
+import re
+import time
+from urllib.parse import urljoin, urlparse
+
+import aiohttp
+
+from async_transfer import TransferEngine
+
+# Same Akamai debug pragmas check-usp-urls.sh sent with curl
+PRAGMA = ("akamai-x-get-cache-key, akamai-x-cache-on, akamai-x-cache-remote-on, akamai-x-get-true-cache-key, "
+          "akamai-x-check-cacheable, akamai-x-get-request-id, akamai-x-serial-no, akamai-x-get-ssl-client-session-id, "
+          "X-Akamai-CacheTrack, akamai-x-get-client-ip, akamai-x-feo-trace, akamai-x-tapioca-trace , "
+          "akamai-x-get-extracted-values")
+REQUEST_HEADERS = {"Pragma": PRAGMA}
+# Response headers the pragmas above turn on
+CACHE_HEADER_PREFIXES = ("x-cache", "x-check-cacheable", "x-true-cache-key", "x-akamai", "x-serial", "x-get-")
+CONCURRENCY = 100
+PER_HOST = 100
+PERCENTILES = (50, 90, 99)
+CHUNK_SIZE = 256 * 1024
+
+
+def cache_headers(headers):
+    return {name: value for name, value in headers.items() if name.lower().startswith(CACHE_HEADER_PREFIXES)}
+
+
+def title_of(url):
+    """The title a playback URL belongs to: its path without the manifest and the rendition list."""
+    path = urlparse(url).path.rsplit("/", 1)[0]
+    path = re.sub(r"_,[^/]*\.mp4\.csmil$", "", path)
+    return re.sub(r"\.(ism|mp4)$", "", path)
+
+
+def playlist_uris(text, base_url):
+    """Absolute URIs of a playlist: the non-comment lines and the URI="..." of EXT-X-MEDIA and I-frame playlists."""
+    uris = []
+    for line in text.splitlines():
+        line = line.strip()
+        if not line:
+            continue
+        if line.startswith("#"):
+            if line.startswith(("#EXT-X-MEDIA:", "#EXT-X-I-FRAME-STREAM-INF:")):
+                match = re.search(r'URI="([^"]+)"', line)
+                if match:
+                    uris.append(urljoin(base_url, match.group(1)))
+            continue
+        uris.append(urljoin(base_url, line))
+    return uris
+
+
+def percentile(values, pct):
+    """Nearest-rank percentile of values, None when there are none."""
+    if not values:
+        return None
+    ordered = sorted(values)
+    return ordered[max(0, math.ceil(pct / 100 * len(ordered)) - 1)]
+
+
+async def fetch(engine, url, kind, keep_body):
+    """
+    GET url and return (record, body). The body is only kept for playlists; segments
+    are read to the end and counted so the total latency covers the full transfer.
+    """
+    record = {"kind": kind, "url": url}
+    started = time.monotonic()
+    try:
+        async with engine.session.get(url, headers=REQUEST_HEADERS) as response:
+            record["ttfb"] = round(time.monotonic() - started, 4)
+            record["status"] = response.status
+            record["cache"] = cache_headers(response.headers)
+            body = b""
+            size = 0
+            async for chunk in response.content.iter_chunked(CHUNK_SIZE):
+                size += len(chunk)
+                if keep_body:
+                    body += chunk
+            record["bytes"] = size
+    except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+        record["status"] = None
+        record["error"] = str(e) or type(e).__name__
+        body = b""
+    record["total"] = round(time.monotonic() - started, 4)
+    return record, body.decode("utf-8", errors="replace")
+
+
+async def validate(engine, url):
+    """
+    Fetch the master playlist, every variant playlist and the first segment of each.
+
+    Returns one record for the URL holding every request made.
+    """
+    requests = []
+    master, text = await fetch(engine, url, "master", keep_body=True)
+    requests.append(master)
+    if master.get("status") == 200:
+        variants = playlist_uris(text, url)
+        if not variants:
+            master["error"] = "no variants"
+        results = await asyncio.gather(*(fetch(engine, variant, "variant", keep_body=True) for variant in variants))
+        segments = []
+        for variant, variant_text in results:
+            requests.append(variant)
+            if variant.get("status") == 200:
+                uris = playlist_uris(variant_text, variant["url"])
+                if uris:
+                    segments.append(uris[0])
+                else:
+                    variant["error"] = "no segments"
+        for segment, _ in await asyncio.gather(*(fetch(engine, uri, "segment", keep_body=False) for uri in segments)):
+            requests.append(segment)
+    ok = all(request.get("status") == 200 and "error" not in request for request in requests)
+    return {"url": url, "title": title_of(url), "ok": ok, "requests": requests}
+
+
+def add_to_summary(titles, record):
+    """Fold a validated URL into the per title counts and latency lists; nothing else of the record is kept."""
+    title = titles.setdefault(record["title"], {"urls": 0, "ok": True, "requests": 0, "failed": 0,
+                                                "ttfb": [], "total": []})
+    title["urls"] += 1
+    title["ok"] = title["ok"] and record["ok"]
+    for request in record["requests"]:
+        title["requests"] += 1
+        title["failed"] += request.get("status") != 200
+        for metric in ("ttfb", "total"):
+            if request.get(metric) is not None:
+                title[metric].append(request[metric])
+
+
+def summarize(titles):
+    """One row per title: request counts, failures and TTFB/total latency percentiles."""
+    rows = []
+    for name, title in titles.items():
+        row = {"title": name, "urls": title["urls"], "ok": title["ok"], "requests": title["requests"],
+               "failed": title["failed"]}
+        for metric in ("ttfb", "total"):
+            for pct in PERCENTILES:
+                row[f"{metric}_p{pct}"] = percentile(title[metric], pct)
+        rows.append(row)
+    return rows
+
+
+def iter_urls(urls_file):
+    with open(urls_file) as file:
+        for line in file:
+            url = line.strip()
+            if url and not url.startswith("#"):
+                yield url
+
+
+async def validate_all(urls, results_path, concurrency=CONCURRENCY, per_host=PER_HOST, verify_ssl=False):
+    """
+    Validate every URL, appending a JSON line per URL to results_path. Returns the
+    per title summary built with add_to_summary.
+    """
+    titles = {}
+    async with TransferEngine(max_connections=concurrency * 4, per_host=per_host, verify_ssl=verify_ssl) as engine:
+        with open(results_path, 'w') as results:
+
+            async def validate_and_record(url):
+                record = await validate(engine, url)
+                results.write(json.dumps(record) + "\n")
+                add_to_summary(titles, record)
+                print(f" {url} {record['requests'][0].get('status')} {'OK' if record['ok'] else 'FAILED'}")
+
+            await engine.run(urls, validate_and_record, concurrency=concurrency)
+    return titles
+
+
+def write_summary(rows, summary_path):
+    fields = ["title", "urls", "ok", "requests", "failed"] + \
+        [f"{metric}_p{pct}" for metric in ("ttfb", "total") for pct in PERCENTILES]
+    with open(summary_path, 'w', newline='') as file:
+        writer = csv.DictWriter(file, fieldnames=fields)
+        writer.writeheader()
+        writer.writerows(rows)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Validate HLS playback URLs: master, variant playlists and first segments")
+    parser.add_argument("urls", nargs="?", default="usp_urls.txt", help="File with one master.m3u8 URL per line")
+    parser.add_argument("--concurrency", type=int, default=CONCURRENCY, help="URLs validated at once")
+    parser.add_argument("--per-host", type=int, default=PER_HOST, help="Connection limit per host")
+    parser.add_argument("--results", default="playback_results.jsonl", help="Every request made, one JSON line per URL")
+    parser.add_argument("--summary", default="playback_summary.csv", help="Per title summary with latency percentiles")
+    parser.add_argument("--verify-ssl", action="store_true", help="Check certificates (curl -k didn't)")
+    args = parser.parse_args()
+
+    titles = asyncio.run(validate_all(iter_urls(args.urls), args.results, args.concurrency, args.per_host, args.verify_ssl))
+    write_summary(summarize(titles), args.summary)
+    print(f"Validated {sum(title['urls'] for title in titles.values())} URLs, "
+          f"{sum(not title['ok'] for title in titles.values())} titles failed")
+    for metric in ("ttfb", "total"):
+        values = [value for title in titles.values() for value in title[metric]]
+        print(f"{metric}: " + ", ".join(f"p{pct} {percentile(values, pct)}s" for pct in PERCENTILES))
@@ -1,14 +1,24 @@
+import argparse
+import boto3
+import botocore.exceptions
+import struct
 import subprocess
 import os
 import json
-from xml.etree import ElementTree as ET
 import logging
 import time
-import urllib.parse
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from grouping import GroupIndex, ism_path
+from ism_rewriter import rewrite_ism_file
+from ism_writer import write_ism
+from job_state import BUCKET_KEY_PREFIX, DEFAULT_DB_PATH, JobLedger
+from mp4_boxes import Mp4ParseError
 
 # Set up logging
 logging.basicConfig(filename='ism-generation-errors.log', level=logging.ERROR, format='%(asctime)s - %(levelname)s - %(message)s')
 success_log = open("success.log", "a")
+success_log_lock = threading.Lock()
 
 # Access environment variables
 lregion = os.environ.get('LREGION')
@@ -20,97 +30,88 @@ if not lregion or not s3AccessKey or not s3SecretKey:
     raise ValueError("Please set LREGION, S3_ACCESS_KEY, and S3_SECRET_KEY environment variables.")
 
 OUTPUT_DIR = "/home/admin/scripts/ism/output"
+SOURCE_BUCKET_NAME = "prod-webmd-usp-content-1"
+MAX_WORKERS = 16  # Groups processed at the same time
+MAX_S3_READS = 8  # Groups allowed to read renditions from the bucket at the same time
+GROUP_TIMEOUT = 900  # Seconds before a hung mp4split or rclone child is killed
 
-def decode_and_normalize(filename):
-    """Decode URLs and replace special characters."""
-    decoded_name = urllib.parse.unquote(filename)
-    normalized_name = decoded_name.replace('+', ' ')
-    return normalized_name
+# Bounds the concurrent S3 reads across all group workers, resized from the command line
+s3_reads = threading.BoundedSemaphore(MAX_S3_READS)
+group_timeout = GROUP_TIMEOUT
 
-def get_file_group_key(file_name):
-    """Extracts the grouping key for the filename."""
-    normalized_name = decode_and_normalize(os.path.basename(file_name))
-    underscore_position = normalized_name.rfind('_', 0, normalized_name.rfind('k.mp4'))
-    return normalized_name[:underscore_position] if underscore_position != -1 else normalized_name
+# Used for the ranged moov reads of the native ISM writer
+s3_client = boto3.Session(aws_access_key_id=s3AccessKey, aws_secret_access_key=s3SecretKey).client(
+    's3', region_name=lregion, endpoint_url=f"https://{lregion}.linodeobjects.com")
 
-def crawl_linode_bucket(json_name):
-    with open(json_name) as data:
-        json_data = json.load(data)
-        return json_data
+def log_success(json_entry):
+    with success_log_lock:
+        success_log.write(json.dumps(json_entry) + "\n")
+        success_log.flush()
 
 def generate_manifest(file_group, command_filename, json_entry):
-    url_appended_file_group = [f"https://prod-webmd-usp-content-1.us-ord-1.linodeobjects.com/{file_path}" for file_path in file_group]
+    """
+    Write the manifest for file_group.
+
+    Returns True when it already has relative src paths, False when it came from mp4split
+    and still needs rewriting, and None when generation failed.
+    """
     output_path = os.path.join(OUTPUT_DIR, command_filename)
+    # Manifests are laid out like the bucket so groups from different directories can't clash
+    os.makedirs(os.path.dirname(output_path), exist_ok=True)
+    try:
+        with s3_reads:
+            write_ism(file_group, output_path, s3_client=s3_client, bucket=SOURCE_BUCKET_NAME)
+        log_success(json_entry)
+        return True
+    except (Mp4ParseError, OSError, struct.error, boto3.exceptions.Boto3Error, botocore.exceptions.BotoCoreError,
+            botocore.exceptions.ClientError) as e:
+        logging.info(f"Native ISM generation failed for {command_filename}, using mp4split. Reason: {e}")
+
+    url_appended_file_group = [f"https://prod-webmd-usp-content-1.us-ord-1.linodeobjects.com/{file_path}" for file_path in file_group]
     cmd = ["mp4split", f"--license-key=/home/admin/scripts/mp4s/usp-license.key", f"--s3_access_key={s3AccessKey}", f"--s3_secret_key={s3SecretKey}", f"--s3_region={lregion}", "-o", output_path] + url_appended_file_group
     try:
-        subprocess.run(cmd, check=True)
-        success_log.write(json.dumps(json_entry) + "\n")
+        with s3_reads:
+            subprocess.run(cmd, check=True, timeout=group_timeout)
+        log_success(json_entry)
+        return False
+    except subprocess.TimeoutExpired:
+        logging.error(f"mp4split timed out after {group_timeout}s: {json.dumps(json_entry)}")
     except subprocess.CalledProcessError:
         logging.error(json.dumps(json_entry))
-
-def serialize_without_ns(element):
-    """Serializes the XML element without namespace prefixes."""
-    from xml.etree.ElementTree import tostring
-    from xml.dom.minidom import parseString
-
-    rough_string = tostring(element).decode()
-    reparsed = parseString(rough_string)
-    for node in reparsed.getElementsByTagName('*'):
-        node.tagName = node.tagName.split(':')[-1]
-        node.nodeName = node.nodeName.split(':')[-1]
-    return reparsed.toxml()
-
-def modify_ism_to_relative_path(ism_filename):
-    ism_file_path = os.path.join(OUTPUT_DIR, ism_filename)
-    tree = ET.parse(ism_file_path)
-    root = tree.getroot()
-
-    # Function to update src attribute
-    def update_src(element):
-        src = element.get('src')
-        if src:
-            new_src = os.path.basename(src).replace('%20', ' ')
-            element.set('src', new_src)
-
-    # Find the <audio> and <video> tags and extract the file names
-    for audio in root.findall(".//{http://www.w3.org/2001/SMIL20/Language}audio"):
-        update_src(audio)
-
-    for video in root.findall(".//{http://www.w3.org/2001/SMIL20/Language}video"):
-        update_src(video)
-
-    # Save the modified XML content back to the same .ism file without namespace prefixes
-    with open(ism_file_path, 'w') as f:
-        xml_str = serialize_without_ns(root)
-        f.write(xml_str)
+    return None
 
 def upload_manifest_to_bucket(filename_prefix, mp4_files, bucket_name):
-    command_filename = f"{OUTPUT_DIR}/{filename_prefix}.ism"
-    common_prefix = os.path.commonprefix(mp4_files).rstrip("_")
-    ism_filename = f"{common_prefix}.ism"
+    ism_filename = ism_path(filename_prefix)
+    command_filename = os.path.join(OUTPUT_DIR, ism_filename)
     destination_path = os.path.join(bucket_name, ism_filename)
     ism_cmd = ["rclone", "copyto", "--progress", command_filename, f"webmd-prod-chicago:{destination_path}"]
     
     logging.info(f"Attempting to upload using the command: {' '.join(ism_cmd)}")  # Add this to log the command
     
     try:
-        subprocess.run(ism_cmd, check=True)
+        subprocess.run(ism_cmd, check=True, timeout=group_timeout)
+        ledger.mark(ism_filename, "uploaded")
+    except subprocess.TimeoutExpired:
+        logging.error(f"Upload of {command_filename} to {destination_path} timed out after {group_timeout}s")
     except subprocess.CalledProcessError as e:
         logging.error(f"Error while uploading {command_filename} to {destination_path}. Command: {' '.join(ism_cmd)}. Error: {e.output}")
 
 def process_files_in_parallel(filename_prefix, mp4_files, json_entry):
-    command_filename = f"{filename_prefix}.ism"
+    command_filename = ism_path(filename_prefix)
     try:
-        generate_manifest(mp4_files, command_filename, json_entry)
+        already_relative = generate_manifest(mp4_files, command_filename, json_entry)
     except Exception as e:
         logging.error(f"Error during manifest generation for {filename_prefix}: {str(e)}")
         return  # Exit the function if generate_manifest fails
+    if already_relative is None:
+        return
 
-    try:
-        modify_ism_to_relative_path(command_filename)
-    except Exception as e:
-        logging.error(f"Error during ISM modification for {filename_prefix}: {str(e)}")
-        return  # Exit the function if modify_ism_to_relative_path fails
+    if not already_relative:
+        try:
+            rewrite_ism_file(os.path.join(OUTPUT_DIR, command_filename))
+        except Exception as e:
+            logging.error(f"Error during ISM modification for {filename_prefix}: {str(e)}")
+            return  # Exit the function if the rewrite fails
 
     try:
         upload_manifest_to_bucket(filename_prefix, mp4_files, s3_bucket_name)
@@ -118,23 +119,33 @@ def process_files_in_parallel(filename_prefix, mp4_files, json_entry):
         logging.error(f"Error during manifest upload for {filename_prefix}: {str(e)}")
 
 if __name__ == "__main__":
-    json_file = "minus-modified_new_all_files_linode.json"
+    parser = argparse.ArgumentParser(description="Generate and upload ISM manifests for the MP4 groups in a listing")
+    parser.add_argument("--workers", type=int, default=MAX_WORKERS, help="Groups processed in parallel")
+    parser.add_argument("--max-s3-reads", type=int, default=MAX_S3_READS, help="Groups reading renditions from S3 at once")
+    parser.add_argument("--timeout", type=int, default=GROUP_TIMEOUT, help="Seconds before a hung mp4split/rclone is killed")
+    parser.add_argument("--listing", default="minus-modified_new_all_files_linode.json", help="Listing of the MP4s to group, e.g. the ism_audit.py worklist")
+    parser.add_argument("--force", action="store_true", help="Regenerate manifests the ledger already records as uploaded")
+    parser.add_argument("--ledger", default=DEFAULT_DB_PATH, help="SQLite job ledger recording the uploaded manifests")
+    args = parser.parse_args()
+    # Uploaded manifests are recorded in the migration ledger so reruns skip them. The listing
+    # holds bucket keys, the ledger tracks the NetStorage paths they were copied from.
+    ledger = JobLedger(args.ledger, key_prefix=BUCKET_KEY_PREFIX)
+    s3_reads = threading.BoundedSemaphore(args.max_s3_reads)
+    group_timeout = args.timeout
+
+    json_file = args.listing
     s3_bucket_name = "prod-webmd-usp-content-1"
 
-    all_entries = crawl_linode_bucket(json_file)
-    file_names = [entry['Path'] for entry in all_entries if entry['Path'].endswith(".mp4")]
-
-    file_groups = {}
-    json_entries = {}
-
-    for entry in all_entries:
-        file_name = entry["Path"]
-        if file_name.endswith('.mp4'):
-            filename_prefix = get_file_group_key(file_name)
-            if filename_prefix not in file_groups:
-                file_groups[filename_prefix] = []
-            file_groups[filename_prefix].append(file_name)
-            json_entries[filename_prefix] = entry
-
-    for filename_prefix, mp4_files in file_groups.items():
-        process_files_in_parallel(filename_prefix, mp4_files, json_entries[filename_prefix])
+    # Group the renditions of every title in a single pass over the listing
+    group_index = GroupIndex.from_listing(json_file)
+
+    with ThreadPoolExecutor(max_workers=args.workers) as executor:
+        futures = []
+        for filename_prefix, group_entries in group_index.items():
+            if not args.force and ledger.is_done(ism_path(filename_prefix), "uploaded"):
+                continue
+            mp4_files = [entry["Path"] for entry in group_entries]
+            futures.append(executor.submit(process_files_in_parallel, filename_prefix, mp4_files, group_entries[-1]))
+        for done, future in enumerate(as_completed(futures), 1):
+            if done % 1000 == 0:
+                print(f"Processed {done} of {len(futures)} groups")
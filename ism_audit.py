@@ -0,0 +1,132 @@
+import argparse
+import html
+import json
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+from bucket_diff import ListingWriter
+from grouping import GroupIndex, ism_path
+from ism_rewriter import SRC_PATTERN, src_name
+from manifest_reader import iter_entries
+
+# Manifests are a few KB; one ranged GET of this size almost always gets the whole file
+ISM_READ_SIZE = 256 * 1024
+AUDIT_WORKERS = 64
+
+
+def fetch_ism(client, bucket, key, read_size=ISM_READ_SIZE):
+    """Read an ISM object, with a single ranged GET unless it is larger than read_size."""
+    response = client.get_object(Bucket=bucket, Key=key, Range=f"bytes=0-{read_size - 1}")
+    data = response["Body"].read()
+    total = int(response.get("ContentRange", "/0").rpartition("/")[2] or 0)
+    if total > len(data):
+        response = client.get_object(Bucket=bucket, Key=key, Range=f"bytes={len(data)}-")
+        data += response["Body"].read()
+    return data
+
+
+def ism_sources(data):
+    """The src values of the audio/video elements of a manifest, unescaped."""
+    return [html.unescape(match.group(2)[1:-1].decode("utf-8")) for match in SRC_PATTERN.finditer(data)]
+
+
+def audit_group(data, group_entries):
+    """
+    Cross-check one manifest against the renditions of its group. Returns the list of problems found:
+
+    - absolute_src: a src isn't a bare file name, so playback resolves it against the wrong location
+    - missing_rendition: a src names a file that isn't next to the manifest
+    - unreferenced_rendition: an MP4 of the group isn't in the manifest
+    - no_tracks: no audio/video src could be found
+    """
+    sources = ism_sources(data)
+    if not sources:
+        return [{"problem": "no_tracks"}]
+    problems = []
+    names = {os.path.basename(entry["Path"]) for entry in group_entries}
+    referenced = set()
+    for src in sources:
+        name = src_name(src)
+        referenced.add(name)
+        if name != src:
+            problems.append({"problem": "absolute_src", "src": src})
+        if name not in names:
+            problems.append({"problem": "missing_rendition", "src": src})
+    for name in sorted(names - referenced):
+        problems.append({"problem": "unreferenced_rendition", "file": name})
+    return problems
+
+
+def audit(listing, client, bucket, key_prefix="", workers=AUDIT_WORKERS, group_index=None):
+    """
+    Yield (group key, problems) for every group of the listing whose manifest is missing or broken.
+
+    Manifests present in the listing are fetched in parallel; groups without one are
+    reported as missing_ism without any request.
+    """
+    group_index = group_index or GroupIndex.from_listing(listing)
+    ism_paths = {entry["Path"] for entry in iter_entries(listing, suffix=".ism")}
+
+    def check(key):
+        try:
+            data = fetch_ism(client, bucket, key_prefix + ism_path(key))
+        except Exception as e:
+            return key, [{"problem": "unreadable", "error": str(e)}]
+        return key, audit_group(data, group_index.get(key))
+
+    for key in group_index.keys():
+        if ism_path(key) not in ism_paths:
+            yield key, [{"problem": "missing_ism"}]
+    for path in ism_paths:
+        key = path[:-len(".ism")]
+        if key not in group_index:
+            yield key, [{"problem": "orphan_ism"}]
+
+    present = [key for key in group_index.keys() if ism_path(key) in ism_paths]
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        for key, problems in executor.map(check, present):
+            if problems:
+                yield key, problems
+
+
+def write_audit(listing, client, bucket, report_path, worklist_path, key_prefix="", workers=AUDIT_WORKERS):
+    """
+    Write one JSON line per broken group to report_path, and the MP4 entries of every
+    group that needs a new manifest to worklist_path, a listing the ISM scripts can
+    regenerate from. Worklist paths get key_prefix back, so they are full object keys.
+    Returns the number of groups per problem.
+    """
+    group_index = GroupIndex.from_listing(listing)
+    counts = {}
+    worklist = ListingWriter(worklist_path)
+    try:
+        with open(report_path, 'w') as report:
+            for key, problems in audit(listing, client, bucket, key_prefix, workers, group_index):
+                report.write(json.dumps({"group": key, "ism": ism_path(key), "problems": problems}) + "\n")
+                for problem in {problem["problem"] for problem in problems}:
+                    counts[problem] = counts.get(problem, 0) + 1
+                for entry in group_index.get(key):
+                    # The ISM scripts use the worklist paths as object keys
+                    worklist.write(dict(entry, Path=key_prefix + entry["Path"]))
+    finally:
+        worklist.close()
+    return counts
+
+
+if __name__ == "__main__":
+    from linode_uploader import make_s3_client
+
+    parser = argparse.ArgumentParser(description="Check every ISM of a listing against the MP4s next to it")
+    parser.add_argument("listing", help="rclone lsjson listing of the bucket, e.g. from destination_index.py --output")
+    parser.add_argument("bucket", help="Bucket holding the manifests")
+    parser.add_argument("--key-prefix", default="", help="Prefix of the object keys the listing paths are relative to, e.g. delivery/")
+    parser.add_argument("--workers", type=int, default=AUDIT_WORKERS, help="Manifests fetched in parallel")
+    parser.add_argument("--report", default="ism_audit.jsonl", help="Problems found, one JSON line per group")
+    parser.add_argument("--worklist", default="ism_repair_worklist.json",
+                        help="MP4 entries of the groups to regenerate, for ism-linode-linode.py --listing")
+    args = parser.parse_args()
+
+    client = make_s3_client(max_pool_connections=args.workers)
+    counts = write_audit(args.listing, client, args.bucket, args.report, args.worklist, args.key_prefix, args.workers)
+    for problem, count in sorted(counts.items()):
+        print(f"{problem}: {count} groups")
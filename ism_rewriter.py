@@ -0,0 +1,64 @@
+import argparse
+import html
+import os
+import re
+import urllib.parse
+from concurrent.futures import ProcessPoolExecutor
+from xml.sax.saxutils import quoteattr
+
+# src attribute of an <audio> or <video> element, with or without a namespace prefix
+SRC_PATTERN = re.compile(rb'(<(?:[\w.-]+:)?(?:audio|video)\b[^>]*?\ssrc\s*=\s*)("[^"]*"|\'[^\']*\')', re.S)
+
+
+def src_name(src):
+    """The file name a src points at: no scheme, host, query or directories, URL-decoded."""
+    if re.match(r"[a-zA-Z][a-zA-Z0-9+.-]*://", src):
+        src = urllib.parse.urlparse(src).path
+    return os.path.basename(urllib.parse.unquote(src))
+
+
+def rewrite_ism(data, names=None):
+    """
+    Return the ISM bytes with every audio/video src reduced to a bare file name.
+
+    Only the src values are touched, in a single regex pass over the raw bytes, so the
+    manifest is neither parsed into a tree nor re-serialized. names optionally maps the
+    resulting file name to the one to write instead.
+    """
+    def replace(match):
+        name = src_name(html.unescape(match.group(2)[1:-1].decode("utf-8")))
+        if names:
+            name = names.get(name, name)
+        return match.group(1) + quoteattr(name).encode("utf-8")
+
+    return SRC_PATTERN.sub(replace, data)
+
+
+def rewrite_ism_file(path, names=None):
+    """Rewrite one .ism in place. Returns False when it already had relative src values."""
+    with open(path, 'rb') as file:
+        data = file.read()
+    rewritten = rewrite_ism(data, names)
+    if rewritten == data:
+        return False
+    tmp_path = path + ".tmp"
+    with open(tmp_path, 'wb') as file:
+        file.write(rewritten)
+    os.replace(tmp_path, path)
+    return True
+
+
+def rewrite_ism_dir(directory, workers=None):
+    """Rewrite every .ism under directory using a pool of processes. Returns the number of files changed."""
+    paths = [os.path.join(root, name) for root, _, names in os.walk(directory) for name in names
+             if name.endswith(".ism")]
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        return sum(executor.map(rewrite_ism_file, paths, chunksize=64))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Make the audio/video src of every .ism in a directory relative")
+    parser.add_argument("directory", help="Directory searched recursively for .ism files")
+    parser.add_argument("--workers", type=int, help="Worker processes, defaults to the number of cores")
+    args = parser.parse_args()
+    print(f"Rewrote {rewrite_ism_dir(args.directory, args.workers)} manifests")
@@ -0,0 +1,162 @@
+import os
+import struct
+import urllib.parse
+from xml.etree import ElementTree as ET
+
+from mp4_boxes import Mp4ParseError, find_box, find_boxes, iter_boxes, open_source, read_moov
+
+SMIL_NS = "http://www.w3.org/2001/SMIL20/Language"
+TRACK_TYPES = {b"vide": "video", b"soun": "audio"}
+# FourCC values the USP server manifest uses for the common sample entries
+FOURCC = {"avc1": "AVC1", "avc3": "AVC1", "hvc1": "HVC1", "hev1": "HEV1", "mp4a": "AACL", "ac-3": "AC-3", "ec-3": "EC-3"}
+
+ET.register_namespace("", SMIL_NS)
+
+
+def full_box_version(data, start):
+    return data[start]
+
+
+def parse_language(packed):
+    """Decode the ISO-639-2 code packed into three 5-bit letters in mdhd."""
+    if not packed:
+        return "und"
+    return "".join(chr(((packed >> shift) & 0x1F) + 0x60) for shift in (10, 5, 0))
+
+
+def parse_mdhd(data, start):
+    if full_box_version(data, start) == 1:
+        timescale, duration = struct.unpack_from(">IQ", data, start + 20)
+        language = struct.unpack_from(">H", data, start + 32)[0]
+    else:
+        timescale, duration = struct.unpack_from(">II", data, start + 12)
+        language = struct.unpack_from(">H", data, start + 20)[0]
+    return timescale, duration, parse_language(language)
+
+
+def parse_tkhd_track_id(data, start):
+    offset = start + 20 if full_box_version(data, start) == 1 else start + 12
+    return struct.unpack_from(">I", data, offset)[0]
+
+
+def sum_sample_sizes(data, start):
+    sample_size, sample_count = struct.unpack_from(">II", data, start + 4)
+    if sample_size:
+        return sample_size * sample_count
+    return sum(size for (size,) in struct.iter_unpack(">I", data[start + 12:start + 12 + 4 * sample_count]))
+
+
+def parse_sample_entry(data, start, end, track_type):
+    """Read codec, dimensions/audio format and btrt bitrate from the first stsd entry."""
+    entries = list(iter_boxes(data, start + 8, end))
+    if not entries:
+        raise Mp4ParseError("Empty stsd box")
+    entry_type, entry_start, entry_end = entries[0]
+    info = {"codec": entry_type.decode("latin-1")}
+    if track_type == "video":
+        info["width"], info["height"] = struct.unpack_from(">HH", data, entry_start + 24)
+        children_start = entry_start + 78
+    else:
+        info["channels"] = struct.unpack_from(">H", data, entry_start + 16)[0]
+        info["sampling_rate"] = struct.unpack_from(">I", data, entry_start + 24)[0] >> 16
+        children_start = entry_start + 28
+    for child_type, child_start, child_end in iter_boxes(data, children_start, entry_end):
+        if child_type == b"btrt":
+            info["bitrate"] = struct.unpack_from(">I", data, child_start + 8)[0] or None
+        elif child_type == b"sinf":
+            # Encrypted entries (encv/enca) keep the real codec in sinf/frma
+            frma = find_box(data, [b"frma"], child_start, child_end)
+            if frma:
+                info["codec"] = data[frma[0]:frma[0] + 4].decode("latin-1")
+    return info
+
+
+def parse_tracks(moov):
+    """Return the audio and video tracks described by a moov payload."""
+    tracks = []
+    for trak_start, trak_end in find_boxes(moov, b"trak"):
+        hdlr = find_box(moov, [b"mdia", b"hdlr"], trak_start, trak_end)
+        track_type = TRACK_TYPES.get(moov[hdlr[0] + 8:hdlr[0] + 12]) if hdlr else None
+        if track_type is None:
+            continue
+        tkhd = find_box(moov, [b"tkhd"], trak_start, trak_end)
+        mdhd = find_box(moov, [b"mdia", b"mdhd"], trak_start, trak_end)
+        stbl = find_box(moov, [b"mdia", b"minf", b"stbl"], trak_start, trak_end)
+        if not (tkhd and mdhd and stbl):
+            raise Mp4ParseError("Track is missing tkhd, mdhd or stbl")
+        timescale, duration, language = parse_mdhd(moov, mdhd[0])
+        stsd = find_box(moov, [b"stsd"], *stbl)
+        if not stsd:
+            raise Mp4ParseError("Track has no stsd box")
+        track = {"type": track_type, "track_id": parse_tkhd_track_id(moov, tkhd[0]), "timescale": timescale,
+                 "language": language}
+        track.update(parse_sample_entry(moov, stsd[0], stsd[1], track_type))
+        if not track.get("bitrate"):
+            stsz = find_box(moov, [b"stsz"], *stbl)
+            total = sum_sample_sizes(moov, stsz[0]) if stsz else 0
+            if not total or not duration or not timescale:
+                # Fragmented files keep their samples in moof boxes; let mp4split measure them
+                raise Mp4ParseError("Can't determine the track bitrate")
+            track["bitrate"] = int(total * 8 * timescale / duration)
+        tracks.append(track)
+    if not tracks:
+        raise Mp4ParseError("No audio or video tracks")
+    return tracks
+
+
+def read_tracks(location, s3_client=None, bucket=None):
+    """Read the tracks of a local file, URL or S3 key, fetching only box headers and the moov box."""
+    source = open_source(location, s3_client=s3_client, bucket=bucket)
+    try:
+        return parse_tracks(read_moov(source))
+    finally:
+        source.close()
+
+
+def relative_src(location):
+    """The src value the manifests use: the decoded file name without any directory."""
+    return os.path.basename(urllib.parse.unquote(urllib.parse.urlparse(location).path))
+
+
+def add_param(element, name, value):
+    ET.SubElement(element, f"{{{SMIL_NS}}}param", {"name": name, "value": str(value), "valuetype": "data"})
+
+
+def build_ism(tracks_by_src, ism_filename):
+    """Serialize the server manifest for [(src, tracks), ...] with relative src values."""
+    smil = ET.Element(f"{{{SMIL_NS}}}smil")
+    head = ET.SubElement(smil, f"{{{SMIL_NS}}}head")
+    ET.SubElement(head, f"{{{SMIL_NS}}}meta",
+                  {"name": "clientManifestRelativePath", "content": os.path.splitext(ism_filename)[0] + ".ismc"})
+    switch = ET.SubElement(ET.SubElement(smil, f"{{{SMIL_NS}}}body"), f"{{{SMIL_NS}}}switch")
+    for src, tracks in tracks_by_src:
+        for track in tracks:
+            element = ET.SubElement(switch, f"{{{SMIL_NS}}}{track['type']}",
+                                    {"src": src, "systemBitrate": str(track["bitrate"]),
+                                     "systemLanguage": track["language"]})
+            add_param(element, "trackID", track["track_id"])
+            add_param(element, "trackName", track["type"])
+            add_param(element, "timescale", track["timescale"])
+            add_param(element, "trackType", track["type"])
+            add_param(element, "FourCC", FOURCC.get(track["codec"], track["codec"].upper()))
+            if track["type"] == "video":
+                add_param(element, "MaxWidth", track["width"])
+                add_param(element, "MaxHeight", track["height"])
+            else:
+                add_param(element, "SamplingRate", track["sampling_rate"])
+                add_param(element, "Channels", track["channels"])
+    ET.indent(smil)
+    return ET.tostring(smil, encoding="utf-8", xml_declaration=True)
+
+
+def write_ism(locations, output_path, s3_client=None, bucket=None):
+    """
+    Write the .ism for a group of MP4s straight from their moov boxes.
+
+    Raises Mp4ParseError (or an I/O error) when any file can't be read, so the caller
+    can fall back to mp4split.
+    """
+    tracks_by_src = [(relative_src(location), read_tracks(location, s3_client=s3_client, bucket=bucket))
+                     for location in locations]
+    with open(output_path, 'wb') as file:
+        file.write(build_ism(tracks_by_src, os.path.basename(output_path)))
@@ -0,0 +1,200 @@
+import hashlib
+import sqlite3
+import threading
+import time
+import zlib
+
+DEFAULT_DB_PATH = "migration_state.db"
+# Prefix of the destination bucket keys; the same file is delivery/dir/name.mp4 there and dir/name.mp4 on NetStorage
+BUCKET_KEY_PREFIX = "delivery/"
+
+# Lifecycle of an object, in order. Reaching a state implies all the earlier ones.
+STATES = ("discovered", "downloaded", "repackaged", "uploaded", "verified")
+STATE_RANK = {state: rank for rank, state in enumerate(STATES)}
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS objects (
+    path TEXT PRIMARY KEY,
+    size INTEGER,
+    mod_time TEXT,
+    shard_hash INTEGER NOT NULL,
+    state_rank INTEGER NOT NULL DEFAULT 0,
+    source_checksum TEXT,
+    output_checksum TEXT,
+    discovered_at REAL,
+    downloaded_at REAL,
+    repackaged_at REAL,
+    uploaded_at REAL,
+    verified_at REAL,
+    failed_stage TEXT,
+    error TEXT
+);
+CREATE INDEX IF NOT EXISTS objects_state ON objects (state_rank);
+"""
+
+
+def file_md5(path, chunk_size=8 * 1024 * 1024):
+    """MD5 of a local file, the same value S3 reports as ETag for single part uploads."""
+    digest = hashlib.md5()
+    with open(path, 'rb') as file:
+        for chunk in iter(lambda: file.read(chunk_size), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def ledger_key(path, key_prefix=""):
+    """
+    The key the ledger tracks a file under: its path relative to /delivery/ on NetStorage.
+
+    Scripts working from bucket keys pass key_prefix (BUCKET_KEY_PREFIX), so a file has
+    one row whichever script records it.
+    """
+    path = path.lstrip("/")
+    if key_prefix and path.startswith(key_prefix):
+        path = path[len(key_prefix):]
+    return path
+
+
+def parse_shard(value):
+    """Parse a --shard argument such as 3/8 into (3, 8)."""
+    if not value:
+        return None
+    index, count = (int(part) for part in value.split("/"))
+    if not 0 <= index < count:
+        raise ValueError(f"Shard index must be between 0 and {count - 1}: {value}")
+    return index, count
+
+
+def in_shard(path, shard):
+    if shard is None:
+        return True
+    index, count = shard
+    return zlib.crc32(path.encode()) % count == index
+
+
+class JobLedger:
+    """
+    SQLite ledger recording how far every object of the migration has progressed.
+
+    Each object is keyed by its source Path, so checking whether a file still needs
+    work is a primary key lookup. Objects are assigned to shards by a stable hash of
+    the path, which lets several boxes split a run with --shard i/n and no CSV indices.
+    Paths are turned into keys with ledger_key; open the ledger with key_prefix when
+    passing bucket keys.
+    """
+
+    def __init__(self, db_path=DEFAULT_DB_PATH, key_prefix=""):
+        self.db_path = db_path
+        self.key_prefix = key_prefix
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(db_path, check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.executescript(SCHEMA)
+
+    def close(self):
+        self.conn.close()
+
+    def key(self, path):
+        return ledger_key(path, self.key_prefix)
+
+    def discover(self, entries):
+        """Add rclone lsjson style entries (Path, Size, ModTime); already known paths keep their state."""
+        now = time.time()
+        keys = ((self.key(entry["Path"]), entry) for entry in entries)
+        rows = ((key, entry.get("Size"), entry.get("ModTime"), zlib.crc32(key.encode()), now) for key, entry in keys)
+        with self.lock, self.conn:
+            self.conn.executemany(
+                "INSERT OR IGNORE INTO objects (path, size, mod_time, shard_hash, discovered_at) VALUES (?, ?, ?, ?, ?)",
+                rows)
+
+    def mark(self, path, state, source_checksum=None, output_checksum=None):
+        """Record that path reached state. Never moves an object backwards."""
+        rank = STATE_RANK[state]
+        now = time.time()
+        path = self.key(path)
+        with self.lock, self.conn:
+            self.conn.execute(
+                "INSERT OR IGNORE INTO objects (path, shard_hash, discovered_at) VALUES (?, ?, ?)",
+                (path, zlib.crc32(path.encode()), now))
+            self.conn.execute(
+                f"UPDATE objects SET state_rank = MAX(state_rank, ?), {state}_at = ?, "
+                "source_checksum = COALESCE(?, source_checksum), output_checksum = COALESCE(?, output_checksum), "
+                "failed_stage = NULL, error = NULL WHERE path = ?",
+                (rank, now, source_checksum, output_checksum, path))
+
+    def mark_many(self, paths, state):
+        """mark() for a batch of paths in a single transaction."""
+        rank = STATE_RANK[state]
+        now = time.time()
+        paths = [self.key(path) for path in paths]
+        with self.lock, self.conn:
+            self.conn.executemany(
+                "INSERT OR IGNORE INTO objects (path, shard_hash, discovered_at) VALUES (?, ?, ?)",
+                [(path, zlib.crc32(path.encode()), now) for path in paths])
+            self.conn.executemany(
+                f"UPDATE objects SET state_rank = MAX(state_rank, ?), {state}_at = ?, "
+                "failed_stage = NULL, error = NULL WHERE path = ?",
+                [(rank, now, path) for path in paths])
+
+    def mark_failed(self, path, stage, error):
+        with self.lock, self.conn:
+            self.conn.execute("UPDATE objects SET failed_stage = ?, error = ? WHERE path = ?",
+                              (stage, str(error), self.key(path)))
+
+    def state_of(self, path):
+        with self.lock:
+            row = self.conn.execute("SELECT state_rank FROM objects WHERE path = ?", (self.key(path),)).fetchone()
+        return STATES[row[0]] if row else None
+
+    def is_done(self, path, state):
+        with self.lock:
+            row = self.conn.execute("SELECT state_rank FROM objects WHERE path = ?", (self.key(path),)).fetchone()
+        return row is not None and row[0] >= STATE_RANK[state]
+
+    def get(self, path):
+        with self.lock:
+            cursor = self.conn.execute("SELECT * FROM objects WHERE path = ?", (self.key(path),))
+            row = cursor.fetchone()
+            columns = [column[0] for column in cursor.description]
+        return dict(zip(columns, row)) if row else None
+
+    def pending(self, state, shard=None, suffix=None, batch_size=1000):
+        """Yield the keys (source paths) that haven't reached state yet, optionally limited to one shard and file suffix."""
+        rank = STATE_RANK[state]
+        query = "SELECT path FROM objects WHERE state_rank < ? AND path > ?"
+        params = [rank]
+        if shard is not None:
+            query += " AND shard_hash % ? = ?"
+            params += [shard[1], shard[0]]
+        if suffix:
+            query += " AND path LIKE ?"
+            params.append(f"%{suffix}")
+        query += " ORDER BY path LIMIT ?"
+        last = ""
+        while True:
+            with self.lock:
+                rows = self.conn.execute(query, [params[0], last] + params[1:] + [batch_size]).fetchall()
+            if not rows:
+                return
+            for (path,) in rows:
+                yield path
+            last = rows[-1][0]
+
+    def summary(self):
+        with self.lock:
+            rows = self.conn.execute("SELECT state_rank, COUNT(*) FROM objects GROUP BY state_rank").fetchall()
+            failed = self.conn.execute("SELECT COUNT(*) FROM objects WHERE failed_stage IS NOT NULL").fetchone()[0]
+        counts = {STATES[rank]: count for rank, count in rows}
+        counts["failed"] = failed
+        return counts
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Show the progress recorded in the migration ledger")
+    parser.add_argument("--db", default=DEFAULT_DB_PATH, help="Path of the ledger database")
+    args = parser.parse_args()
+    for state, count in JobLedger(args.db).summary().items():
+        print(f"{state}: {count}")
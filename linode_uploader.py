@@ -0,0 +1,150 @@
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import boto3
+from boto3.s3.transfer import TransferConfig
+from botocore.config import Config
+
+LINODE_REGION = "us-ord-1"
+LINODE_ENDPOINT_URL = "https://us-ord-1.linodeobjects.com"
+UPLOAD_ACL = "authenticated-read"
+# Same cap the rclone uploads used (--bwlimit 175M)
+UPLOAD_BANDWIDTH_LIMIT = "175M"
+MAX_PARALLEL_FILES = 8
+
+MB = 1024 * 1024
+# Files above the threshold are sent as parallel multipart uploads; small files go in a single PUT
+TRANSFER_CONFIG = TransferConfig(
+    multipart_threshold=64 * MB,
+    multipart_chunksize=64 * MB,
+    max_concurrency=8,
+    use_threads=True,
+)
+# Server-side copies move no data through this box, so large objects use fewer, bigger UploadPartCopy parts
+COPY_TRANSFER_CONFIG = TransferConfig(
+    multipart_threshold=512 * MB,
+    multipart_chunksize=512 * MB,
+    max_concurrency=8,
+    use_threads=True,
+)
+
+
+def parse_bandwidth(limit):
+    """Convert an rclone style limit such as 175M or 1.5G (bytes per second) to bytes per second."""
+    if not limit or str(limit).lower() == "off":
+        return None
+    units = {"k": 1024, "m": 1024 ** 2, "g": 1024 ** 3}
+    limit = str(limit).strip()
+    suffix = limit[-1].lower()
+    if suffix in units:
+        return int(float(limit[:-1]) * units[suffix])
+    return int(float(limit))
+
+
+class BandwidthLimiter:
+    """Token bucket shared by every upload thread to cap the total throughput of the process."""
+
+    def __init__(self, bytes_per_second):
+        self.rate = bytes_per_second
+        self.tokens = bytes_per_second
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def consume(self, amount):
+        # Called by boto3 after each chunk is sent, so sleeping here throttles the sending thread
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.rate, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            self.tokens -= amount
+            wait = -self.tokens / self.rate if self.tokens < 0 else 0
+        if wait:
+            time.sleep(wait)
+
+
+def make_s3_client(max_pool_connections=MAX_PARALLEL_FILES * TRANSFER_CONFIG.max_request_concurrency):
+    session = boto3.Session(
+        aws_access_key_id=os.environ['S3_ACCESS_KEY'],
+        aws_secret_access_key=os.environ['S3_SECRET_KEY']
+    )
+    return session.client('s3', region_name=LINODE_REGION, endpoint_url=LINODE_ENDPOINT_URL,
+                          config=Config(max_pool_connections=max_pool_connections))
+
+
+class LinodeUploader:
+    """
+    In-process uploader for Linode Object Storage.
+
+    Uploads several files at once, each of them as a multipart upload when it is large
+    enough, all drawing from one bandwidth limit. A failing file is logged and skipped
+    without stopping the rest of the batch. With a DestinationIndex of the bucket,
+    files the bucket already holds byte for byte are skipped.
+    """
+
+    def __init__(self, bucket, client=None, bandwidth_limit=UPLOAD_BANDWIDTH_LIMIT, transfer_config=TRANSFER_CONFIG,
+                 max_parallel_files=MAX_PARALLEL_FILES, acl=UPLOAD_ACL, index=None):
+        self.bucket = bucket
+        self.index = index
+        self.client = client or make_s3_client()
+        rate = parse_bandwidth(bandwidth_limit)
+        self.limiter = BandwidthLimiter(rate) if rate else None
+        self.transfer_config = transfer_config
+        self.max_parallel_files = max_parallel_files
+        self.extra_args = {'ACL': acl} if acl else {}
+
+    def upload_file(self, local_path, key):
+        """Upload one file, raising on failure."""
+        if self.index and self.index.has_file(key, local_path):
+            print(f"Skipping {key}, identical object already in {self.bucket}")
+            return
+        callback = self.limiter.consume if self.limiter else None
+        self.client.upload_file(local_path, self.bucket, key, ExtraArgs=self.extra_args,
+                                Config=self.transfer_config, Callback=callback)
+
+    def copy_object(self, source_bucket, source_key, key, transfer_config=COPY_TRANSFER_CONFIG):
+        """
+        Copy one object inside the object store, raising on failure.
+
+        boto3's managed copy sends a single CopyObject for small objects and parallel
+        UploadPartCopy requests above the multipart threshold, so the bytes never leave
+        the object store and the bandwidth limit doesn't apply.
+        """
+        self.client.copy({'Bucket': source_bucket, 'Key': source_key}, self.bucket, key,
+                         ExtraArgs=self.extra_args, Config=transfer_config)
+
+    def run_many(self, action, items, errors_file=None, operation="Upload"):
+        """
+        Call action(source, key) for every (source, key) pair, isolating failures per file.
+
+        Returns the list of keys that failed. Failures are also appended to errors_file.
+        """
+        failed = []
+        lock = threading.Lock()
+
+        def run_one(item):
+            source, key = item
+            try:
+                action(source, key)
+                print(f"{operation} to Linode Object Storage successful for: {key}")
+            except Exception as e:
+                print(f"{operation} to Linode Object Storage failed for {key}. Error: {e}")
+                with lock:
+                    failed.append(key)
+                    if errors_file:
+                        with open(errors_file, 'a') as err_file:
+                            err_file.write(f"{operation} to Linode Object Storage failed for {key}. Error: {e}\n")
+
+        with ThreadPoolExecutor(max_workers=self.max_parallel_files) as executor:
+            list(executor.map(run_one, items))
+        return failed
+
+    def upload_many(self, uploads, errors_file=None):
+        """Upload every (local_path, key) pair and return the keys that failed."""
+        return self.run_many(self.upload_file, uploads, errors_file)
+
+    def copy_many(self, source_bucket, copies, errors_file=None):
+        """Server-side copy every (source_key, key) pair from source_bucket and return the keys that failed."""
+        return self.run_many(lambda source_key, key: self.copy_object(source_bucket, source_key, key),
+                             copies, errors_file, operation="Copy")
@@ -0,0 +1,130 @@
+import csv
+import json
+import os
+
+try:
+    import ijson
+except ImportError:
+    ijson = None
+
+READ_SIZE = 1024 * 1024
+
+
+def iter_json_array(file):
+    """
+    Yield the items of a top level JSON array one at a time without loading the whole file.
+
+    Used when ijson isn't installed. Only the item being decoded is kept in memory,
+    which is all a listing of small rclone lsjson entries needs.
+    """
+    decoder = json.JSONDecoder()
+    buffer = ""
+    position = 0
+    started = False
+    eof = False
+    while True:
+        # Skip the separators between items
+        while position < len(buffer) and buffer[position] in " \t\r\n,[]":
+            if buffer[position] == "[":
+                started = True
+            position += 1
+        if position < len(buffer) and started:
+            try:
+                item, end = decoder.raw_decode(buffer, position)
+            except json.JSONDecodeError:
+                if eof:
+                    raise
+            else:
+                yield item
+                position = end
+                continue
+        if eof:
+            return
+        chunk = file.read(READ_SIZE)
+        eof = not chunk
+        buffer = buffer[position:] + chunk
+        position = 0
+
+
+def iter_json_lines(file):
+    for line in file:
+        line = line.strip().rstrip(",")
+        if line:
+            yield json.loads(line)
+
+
+def iter_raw_entries(json_file):
+    """Yield every entry of an rclone lsjson listing, either a JSON array or one object per line."""
+    with open(json_file, 'rb' if ijson else 'r') as file:
+        first = file.read(1)
+        while first and first.isspace():
+            first = file.read(1)
+        file.seek(0)
+        if first in ("[", b"["):
+            if ijson:
+                yield from ijson.items(file, "item", use_float=True)
+            else:
+                yield from iter_json_array(file)
+        elif ijson:
+            yield from ijson.items(file, "", multiple_values=True, use_float=True)
+        else:
+            yield from iter_json_lines(file)
+
+
+def iter_entries(json_file, suffix=".mp4", exclude=False):
+    """
+    Lazily yield listing entries whose Name ends with suffix (or doesn't, with exclude=True).
+
+    Directories are skipped. The filter runs while parsing, so the full listing is never
+    held in memory.
+    """
+    for entry in iter_raw_entries(json_file):
+        if entry.get("IsDir"):
+            continue
+        if suffix and entry.get("Name", "").endswith(suffix) == exclude:
+            continue
+        yield entry
+
+
+def flatten(entry, prefix=""):
+    """Flatten nested dicts the way pd.json_normalize names its columns (Hashes.md5)."""
+    flat = {}
+    for key, value in entry.items():
+        if isinstance(value, dict):
+            flat.update(flatten(value, f"{prefix}{key}."))
+        else:
+            flat[f"{prefix}{key}"] = value
+    return flat
+
+
+def write_csv_chunks(entries, output_dir, chunk_size, on_chunk=None):
+    """
+    Write entries to output_dir/output_N.csv files of chunk_size rows in a single pass.
+
+    on_chunk, when given, is called with the entries of every chunk, e.g. to register
+    them in the job ledger. Returns the number of chunk files written.
+    """
+    os.makedirs(output_dir, exist_ok=True)
+    chunk = []
+    count = 0
+    for entry in entries:
+        chunk.append(entry)
+        if len(chunk) == chunk_size:
+            write_chunk(chunk, os.path.join(output_dir, f"output_{count}.csv"), on_chunk)
+            chunk = []
+            count += 1
+    if chunk:
+        write_chunk(chunk, os.path.join(output_dir, f"output_{count}.csv"), on_chunk)
+        count += 1
+    return count
+
+
+def write_chunk(chunk, csv_path, on_chunk):
+    rows = [flatten(entry) for entry in chunk]
+    fieldnames = list(dict.fromkeys(key for row in rows for key in row))
+    with open(csv_path, 'w', newline='') as file:
+        writer = csv.DictWriter(file, fieldnames=fieldnames)
+        writer.writeheader()
+        writer.writerows(rows)
+    if on_chunk:
+        on_chunk(chunk)
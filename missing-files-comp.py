@@ -1,27 +1,17 @@
-import json
-
-def read_json(filename):
-    with open(filename, 'r') as file:
-        data = json.load(file)
-    records = {record['Name']: record for record in data}
-    print(f"Loaded {len(records)} unique records from {filename}.")
-    return records
-
-def write_json(filename, data):
-    with open(filename, 'w') as file:
-        json.dump(list(data.values()), file, indent=4)
+from bucket_diff import write_diff
 
 source_file = "all_files_ns.json"
 target_file = "all_files_linode.json"
 output_file = "missing_files_linode.json"
 
-source_data = read_json(source_file)
-target_data = read_json(target_file)
-
-missing_keys = set(source_data.keys()) - set(target_data.keys())
-
-print(f"Number of missing keys: {len(missing_keys)}")
+# NetStorage paths are relative to /delivery/ while the Linode listing holds bucket keys (delivery/...),
+# which check-linode-urls.py uses as they are; the bucket prefix is dropped only for matching
+target_prefix = "delivery/"
 
-missing_data = {key: source_data[key] for key in missing_keys}
+# Matches by full path and streams both listings, so same-named files in different
+# directories no longer collide and the listings don't have to fit in memory
+counts = write_diff(source_file, target_file, output_file, changed_output="changed_files_linode.json",
+                    strip_target_prefix=target_prefix)
 
-write_json(output_file, missing_data)
+print(f"Number of missing keys: {counts['missing']}")
+print(f"Number of changed files: {counts['changed']}")
@@ -0,0 +1,166 @@
+import os
+import struct
+
+import requests
+
+# Boxes whose payload is made of child boxes, as far as the readers in this repo need to descend
+CONTAINER_BOXES = {b"moov", b"trak", b"mdia", b"minf", b"stbl", b"mvex", b"edts", b"dinf", b"sinf", b"schi", b"udta"}
+
+
+class Mp4ParseError(Exception):
+    """The MP4 box structure couldn't be read."""
+
+
+class RangeReadError(Mp4ParseError):
+    """A ranged read of a remote file failed, which says nothing about the file itself."""
+
+
+class FileSource:
+    """Random access reads on a local file."""
+
+    def __init__(self, path):
+        self.path = path
+        self.name = os.path.basename(path)
+        self.size = os.path.getsize(path)
+        self.file = open(path, 'rb')
+
+    def read(self, offset, length):
+        self.file.seek(offset)
+        return self.file.read(length)
+
+    def close(self):
+        self.file.close()
+
+
+class HttpSource:
+    """Random access reads on a URL using Range requests."""
+
+    def __init__(self, url, session=None, timeout=60):
+        self.url = url
+        self.name = os.path.basename(requests.utils.unquote(url.split("?", 1)[0]))
+        self.session = session or requests.Session()
+        self.timeout = timeout
+        self.size = None
+        self.read(0, 1)
+
+    def read(self, offset, length):
+        if self.size is not None:
+            length = min(length, self.size - offset)
+            if length <= 0:
+                return b""
+        headers = {"Range": f"bytes={offset}-{offset + length - 1}"}
+        # Streamed so a server ignoring the range (or a large error page) is never read into memory
+        with self.session.get(self.url, headers=headers, timeout=self.timeout, stream=True) as response:
+            if response.status_code != 206:
+                raise RangeReadError(f"Range read of {self.url} returned {response.status_code}")
+            self.size = int(response.headers["Content-Range"].rpartition("/")[2])
+            data = b""
+            for chunk in response.iter_content(chunk_size=min(length, 1024 * 1024)):
+                data += chunk[:length - len(data)]
+                if len(data) >= length:
+                    break
+            return data
+
+    def close(self):
+        pass
+
+
+class S3Source:
+    """Random access reads on an object through a boto3 S3 client."""
+
+    def __init__(self, client, bucket, key):
+        self.client = client
+        self.bucket = bucket
+        self.key = key
+        self.name = os.path.basename(key)
+        self.size = client.head_object(Bucket=bucket, Key=key)["ContentLength"]
+
+    def read(self, offset, length):
+        length = min(length, self.size - offset)
+        if length <= 0:
+            return b""
+        response = self.client.get_object(Bucket=self.bucket, Key=self.key, Range=f"bytes={offset}-{offset + length - 1}")
+        return response["Body"].read()
+
+    def close(self):
+        pass
+
+
+def open_source(location, s3_client=None, bucket=None):
+    """Pick the reader for a local path, an http(s) URL or, with an S3 client, an object key."""
+    if location.startswith(("http://", "https://")):
+        return HttpSource(location)
+    if s3_client is not None:
+        return S3Source(s3_client, bucket, location)
+    return FileSource(location)
+
+
+def iter_top_level_boxes(source):
+    """
+    Yield (type, offset, header_size, size) for every top level box of the source.
+
+    Only the box headers are read, so walking past a multi-GB mdat costs one small read.
+    """
+    offset = 0
+    while offset < source.size:
+        header = source.read(offset, 16)
+        if len(header) < 8:
+            raise Mp4ParseError(f"Truncated box header at offset {offset}")
+        size, box_type = struct.unpack(">I4s", header[:8])
+        header_size = 8
+        if size == 1:
+            if len(header) < 16:
+                raise Mp4ParseError(f"Truncated 64-bit box header at offset {offset}")
+            size = struct.unpack(">Q", header[8:16])[0]
+            header_size = 16
+        elif size == 0:
+            size = source.size - offset
+        if size < header_size:
+            raise Mp4ParseError(f"Invalid size {size} for box {box_type!r} at offset {offset}")
+        yield box_type, offset, header_size, size
+        offset += size
+
+
+def iter_boxes(data, start=0, end=None):
+    """Yield (type, payload_start, payload_end) for the boxes in data[start:end]."""
+    end = len(data) if end is None else end
+    offset = start
+    while offset + 8 <= end:
+        size, box_type = struct.unpack_from(">I4s", data, offset)
+        header_size = 8
+        if size == 1:
+            size = struct.unpack_from(">Q", data, offset + 8)[0]
+            header_size = 16
+        elif size == 0:
+            size = end - offset
+        if size < header_size or offset + size > end:
+            raise Mp4ParseError(f"Invalid size {size} for box {box_type!r} at offset {offset}")
+        yield box_type, offset + header_size, offset + size
+        offset += size
+
+
+def find_box(data, path, start=0, end=None):
+    """Return (payload_start, payload_end) of the first box matching path, e.g. [b"mdia", b"hdlr"]."""
+    for box_type, payload_start, payload_end in iter_boxes(data, start, end):
+        if box_type == path[0]:
+            if len(path) == 1:
+                return payload_start, payload_end
+            return find_box(data, path[1:], payload_start, payload_end)
+    return None
+
+
+def find_boxes(data, box_type, start=0, end=None):
+    """Return (payload_start, payload_end) of every direct child of the given type."""
+    return [(payload_start, payload_end) for child_type, payload_start, payload_end in iter_boxes(data, start, end)
+            if child_type == box_type]
+
+
+def read_moov(source):
+    """Return the bytes of the moov box payload, reading nothing else but box headers."""
+    for box_type, offset, header_size, size in iter_top_level_boxes(source):
+        if box_type == b"moov":
+            data = source.read(offset + header_size, size - header_size)
+            if len(data) != size - header_size:
+                raise Mp4ParseError("Truncated moov box")
+            return data
+    raise Mp4ParseError(f"No moov box in {source.name}")
@@ -0,0 +1,116 @@
+import argparse
+import json
+import struct
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+
+from mp4_boxes import FileSource, HttpSource, Mp4ParseError, RangeReadError, find_box, find_boxes, iter_top_level_boxes
+
+REPACKAGE = "repackage"
+COPY = "copy"
+CORRUPT = "corrupt"
+# Major brands of plain ISO BMFF files the origin serves as they are
+PROGRESSIVE_BRANDS = {b"isom", b"iso2", b"iso4", b"iso5", b"iso6", b"mp41", b"mp42", b"avc1", b"M4V ", b"M4A "}
+TRIAGE_WORKERS = 32
+
+
+def inspect(source):
+    """
+    Walk the top level boxes of source and read its moov.
+
+    Returns the layout: major brand, box order, whether it is fragmented and the
+    number of audio/video tracks. Raises Mp4ParseError when the structure is broken.
+    The walk stops once the moov has been read from a fragmented file: the verdict
+    can't change, and a long file has thousands of moof boxes, one read each.
+    """
+    layout = {"brand": None, "boxes": [], "fragmented": False, "tracks": 0}
+    moov = None
+    for box_type, offset, header_size, size in iter_top_level_boxes(source):
+        if moov is not None and layout["fragmented"]:
+            break
+        if offset + size > source.size:
+            raise Mp4ParseError(f"Box {box_type!r} at offset {offset} runs past the end of the file")
+        layout["boxes"].append(box_type.decode("latin-1"))
+        if box_type == b"ftyp":
+            layout["brand"] = source.read(offset + header_size, 4)
+        elif box_type == b"moof":
+            layout["fragmented"] = True
+        elif box_type == b"moov" and moov is None:
+            moov = source.read(offset + header_size, size - header_size)
+            if find_box(moov, [b"mvex"]):
+                layout["fragmented"] = True
+    if moov is None:
+        raise Mp4ParseError("No moov box")
+    layout["tracks"] = len(find_boxes(moov, b"trak"))
+    return layout
+
+
+def classify(layout):
+    """(verdict, reason) for a layout returned by inspect."""
+    boxes = layout["boxes"]
+    if not layout["tracks"]:
+        return CORRUPT, "no tracks"
+    if "mdat" not in boxes and not layout["fragmented"]:
+        return CORRUPT, "no mdat"
+    if layout["fragmented"]:
+        return REPACKAGE, "fragmented"
+    if boxes.index("moov") > boxes.index("mdat"):
+        return REPACKAGE, "moov after mdat"
+    if boxes.count("mdat") > 1:
+        return REPACKAGE, "several mdat boxes"
+    if layout["brand"] not in PROGRESSIVE_BRANDS:
+        brand = layout["brand"].decode("latin-1") if layout["brand"] else "no ftyp"
+        return REPACKAGE, f"brand {brand}"
+    return COPY, "progressive"
+
+
+def triage(location, session=None):
+    """
+    Classify a local file or URL as needing mp4split, fine to copy as it is, or corrupt.
+
+    Only box headers and the moov box are read, with Range requests for URLs, so a
+    file can be triaged before anything else is downloaded. Returns (verdict, reason).
+    """
+    try:
+        if location.startswith(("http://", "https://")):
+            source = HttpSource(location, session=session)
+        else:
+            source = FileSource(location)
+    except (Mp4ParseError, requests.exceptions.RequestException, OSError) as e:
+        # Unreachable or not serving ranges: leave the decision to the full download and mp4split
+        return REPACKAGE, f"not inspected: {e}"
+    try:
+        return classify(inspect(source))
+    except (RangeReadError, requests.exceptions.RequestException, OSError) as e:
+        return REPACKAGE, f"not inspected: {e}"
+    except (Mp4ParseError, struct.error) as e:
+        return CORRUPT, str(e)
+    finally:
+        source.close()
+
+
+def make_session(pool_size=TRIAGE_WORKERS):
+    """A requests session keeping up to pool_size connections to the origin alive between triages."""
+    session = requests.Session()
+    adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    return session
+
+
+def triage_many(locations, workers=TRIAGE_WORKERS, session=None):
+    """Triage locations in parallel and return {location: (verdict, reason)}."""
+    if session is None:
+        session = make_session(workers)
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        return dict(zip(locations, executor.map(lambda location: triage(location, session), locations)))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Classify MP4 files or URLs as repackage, copy or corrupt from their box headers")
+    parser.add_argument("locations", nargs="+", help="Local paths or http(s) URLs")
+    parser.add_argument("--workers", type=int, default=TRIAGE_WORKERS, help="Files inspected in parallel")
+    args = parser.parse_args()
+    for location, (verdict, reason) in triage_many(args.locations, args.workers).items():
+        print(json.dumps({"location": location, "verdict": verdict, "reason": reason}))
@@ -0,0 +1,95 @@
+import json
+import os
+import subprocess
+import time
+
+POLL_SECONDS = 0.1
+# Completed jobs between two concurrency adjustments
+ADJUST_EVERY = 4
+
+
+def available_cores():
+    try:
+        return len(os.sched_getaffinity(0))
+    except AttributeError:
+        return os.cpu_count() or 1
+
+
+class Mp4splitScheduler:
+    """
+    Runs mp4split as direct child processes, without intermediate Python workers.
+
+    Jobs are started largest file first so the longest runs don't end up as stragglers
+    at the tail. An explicit max_workers is used as given. By default the batch starts
+    with one child per core; one is dropped when the aggregate byte rate falls, a sign
+    the disk or CPU is contended, and added back once the rate recovers.
+    """
+
+    def __init__(self, license_key_path, output_dir, max_workers=None, results_path=None):
+        self.license_key_path = license_key_path
+        self.output_dir = output_dir
+        self.results_path = results_path
+        os.makedirs(output_dir, exist_ok=True)
+        self.max_slots = max_workers or available_cores()
+        self.slots = self.max_slots
+        self.adaptive = max_workers is None
+        self.last_rate = None
+
+    def command(self, input_file_path, output_file_path):
+        return ["mp4split", f"--license-key={self.license_key_path}", "-o", output_file_path, input_file_path]
+
+    def adjust(self, completed_bytes, elapsed):
+        if not self.adaptive:
+            return
+        rate = completed_bytes / max(elapsed, 1e-6)
+        if self.last_rate is not None:
+            if rate > self.last_rate * 1.05 and self.slots < self.max_slots:
+                self.slots += 1
+            elif rate < self.last_rate * 0.9 and self.slots > 1:
+                self.slots -= 1
+        self.last_rate = rate
+
+    def run(self, input_paths):
+        """
+        Repackage every input into output_dir under the same name.
+
+        Returns one record per file with its size, exit code and wall time, in
+        completion order; the records are also appended to results_path as JSON lines.
+        """
+        pending = sorted(input_paths, key=os.path.getsize)
+        running = {}
+        results = []
+        window_bytes = 0
+        window_started = time.monotonic()
+        print(f"Running mp4split with {self.slots} of at most {self.max_slots} processes")
+
+        while pending or running:
+            while pending and len(running) < self.slots:
+                input_file_path = pending.pop()
+                output_file_path = os.path.join(self.output_dir, os.path.basename(input_file_path))
+                process = subprocess.Popen(self.command(input_file_path, output_file_path))
+                running[process] = (input_file_path, os.path.getsize(input_file_path), time.monotonic())
+
+            time.sleep(POLL_SECONDS)
+            for process in [process for process in running if process.poll() is not None]:
+                input_file_path, size, started = running.pop(process)
+                result = {"file": os.path.basename(input_file_path), "size": size,
+                          "exit_code": process.returncode, "wall_time": round(time.monotonic() - started, 3)}
+                results.append(result)
+                self.record(result)
+                if process.returncode == 0:
+                    print(f"mp4split successful for: {result['file']} in {result['wall_time']}s")
+                    window_bytes += size
+                else:
+                    print(f"mp4split failed for: {result['file']}, exit code {process.returncode}")
+
+                if len(results) % ADJUST_EVERY == 0:
+                    now = time.monotonic()
+                    self.adjust(window_bytes, now - window_started)
+                    window_bytes, window_started = 0, now
+        return results
+
+    def record(self, result):
+        if self.results_path:
+            with open(self.results_path, 'a') as file:
+                file.write(json.dumps(result) + "\n")
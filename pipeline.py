@@ -0,0 +1,124 @@
+import queue
+import shutil
+import threading
+import time
+
+# Sentinel passed down the queues to tell a stage's workers to exit
+STOP = object()
+DISK_POLL_SECONDS = 5
+
+
+class Stage:
+    """
+    One step of a Pipeline.
+
+    func(item) does the work for a single item and returns the item to hand to the
+    next stage, or None when the item failed and should leave the pipeline.
+    """
+
+    def __init__(self, name, func, workers=1):
+        self.name = name
+        self.func = func
+        self.workers = workers
+        self.processed = 0
+        self.failed = 0
+        self.busy_seconds = 0.0
+
+
+class Pipeline:
+    """
+    Thread-based pipeline moving items through stages connected by bounded queues.
+
+    Every item flows through the stages on its own, so downloads keep running while
+    earlier files are being repackaged or uploaded. At most max_in_flight items are
+    between the first and the last stage at once, and when scratch_dir is given no new
+    item is admitted while the filesystem holding it has less than min_free_bytes free.
+    """
+
+    def __init__(self, stages, max_in_flight=50, queue_size=None, scratch_dir=None, min_free_bytes=0):
+        self.stages = stages
+        self.max_in_flight = max_in_flight
+        self.queue_size = queue_size or max_in_flight
+        self.scratch_dir = scratch_dir
+        self.min_free_bytes = min_free_bytes
+        self.slots = threading.BoundedSemaphore(max_in_flight)
+        self.in_flight = 0
+        self.lock = threading.Lock()
+
+    def has_disk_space(self):
+        if not self.scratch_dir or not self.min_free_bytes:
+            return True
+        return shutil.disk_usage(self.scratch_dir).free >= self.min_free_bytes
+
+    def admit(self):
+        self.slots.acquire()
+        # An empty pipeline always admits one item so a full disk can't deadlock the run
+        while not self.has_disk_space() and self.in_flight > 0:
+            time.sleep(DISK_POLL_SECONDS)
+        with self.lock:
+            self.in_flight += 1
+
+    def release(self):
+        with self.lock:
+            self.in_flight -= 1
+        self.slots.release()
+
+    def run_stage(self, index, inbox, outbox, remaining):
+        stage = self.stages[index]
+        while True:
+            item = inbox.get()
+            if item is STOP:
+                break
+            started = time.monotonic()
+            try:
+                result = stage.func(item)
+            except Exception as e:
+                print(f"{stage.name} failed for {item}: {e}")
+                result = None
+            with self.lock:
+                stage.busy_seconds += time.monotonic() - started
+                if result is None:
+                    stage.failed += 1
+                else:
+                    stage.processed += 1
+            if result is None or outbox is None:
+                self.release()
+            else:
+                outbox.put(result)
+
+        # The last worker of a stage to exit forwards the shutdown to the next stage
+        with self.lock:
+            remaining[index] -= 1
+            last = remaining[index] == 0
+        if last and outbox is not None:
+            for _ in range(self.stages[index + 1].workers):
+                outbox.put(STOP)
+
+    def run(self, items):
+        """Push every item through all stages and block until the pipeline is drained."""
+        queues = [queue.Queue(maxsize=self.queue_size) for _ in self.stages]
+        remaining = [stage.workers for stage in self.stages]
+        threads = []
+        for index, stage in enumerate(self.stages):
+            outbox = queues[index + 1] if index + 1 < len(self.stages) else None
+            for _ in range(stage.workers):
+                thread = threading.Thread(target=self.run_stage, args=(index, queues[index], outbox, remaining),
+                                          name=f"{stage.name}-worker", daemon=True)
+                thread.start()
+                threads.append(thread)
+
+        started = time.monotonic()
+        for item in items:
+            self.admit()
+            queues[0].put(item)
+        for _ in range(self.stages[0].workers):
+            queues[0].put(STOP)
+        for thread in threads:
+            thread.join()
+        self.print_summary(time.monotonic() - started)
+
+    def print_summary(self, elapsed):
+        print(f"Pipeline finished in {elapsed:.1f}s")
+        for stage in self.stages:
+            print(f"  {stage.name}: {stage.processed} ok, {stage.failed} failed, "
+                  f"{stage.busy_seconds:.1f}s busy across {stage.workers} workers")
@@ -1,39 +1,22 @@
 import json
 
-# Load the JSON data
-with open('your_json_data.json', 'r') as json_file:
-    data = json.load(json_file)
+from grouping import GroupIndex, ism_path
+from manifest_reader import iter_entries
 
-# Create a dictionary to store groups
-groups = {}
+listing_file = 'your_json_data.json'
 
-# Iterate through the data
-for item in data:
-    path = item['Path']
-    # Extract the group key by finding the last "/"
-    group_key = path.rsplit('/', 1)[0] + '/'
-
-    # Initialize the group if it doesn't exist
-    if group_key not in groups:
-        groups[group_key] = {'mp4': [], 'ism': None, 'json_line': []}
-
-    # Store the entire JSON line in the group
-    groups[group_key]['json_line'].append(item)
-
-    # Check if the file is an mp4 or ism and store it accordingly
-    if path.endswith('.mp4'):
-        groups[group_key]['mp4'].append(path)
-    elif path.endswith('.ism'):
-        groups[group_key]['ism'] = path
+# Group the MP4 renditions of every title and collect the manifests present in the listing
+group_index = GroupIndex.from_listing(listing_file)
+ism_paths = {entry['Path'] for entry in iter_entries(listing_file, suffix='.ism')}
 
 # Create a list to store missing ism mp4 pairs
 missing_pairs = []
 
 # Check for missing ism files
-for group_key, group_data in groups.items():
-    if group_data['ism'] is None:
-        # If there is no ism file in the group, consider all JSON lines as missing
-        missing_pairs.extend(group_data['json_line'])
+for group_key, group_entries in group_index.items():
+    if ism_path(group_key) not in ism_paths:
+        # If the group has no ism file next to it, consider all its JSON lines as missing
+        missing_pairs.extend(group_entries)
 
 # Write missing pairs to another JSON file without formatting
 with open('missing_pairs.json', 'w') as missing_file:
@@ -1,14 +1,16 @@
-import pandas as pd
 import os
-import json
 import boto3
 import logging
 import subprocess
-from xml.etree import ElementTree as ET
 import urllib.parse
 import argparse
-import urllib.parse
-import re
+import struct
+import botocore.exceptions
+import grouping
+from grouping import GroupIndex
+from ism_rewriter import rewrite_ism_file, src_name
+from ism_writer import relative_src, write_ism
+from mp4_boxes import Mp4ParseError
 
 # Logging configuration
 logging.basicConfig(filename='process_logs.log', level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
@@ -19,13 +21,15 @@ ISM_OUTPUT_DIR = "/home/admin/scripts/ism/output"
 LICENSE_KEY_PATH = "/home/admin/scripts/mp4s/usp-license.key"
 UPLOAD_BUCKET_NAME = "prod-your-bucket-usp-content-1"
 DOWNLOAD_BUCKET_NAME = "prod-your-bucket-usp-content-1"
+S3_ENDPOINT_URL = "https://us-ord-1.linodeobjects.com"
+S3_REGION = "us-ord-1"
 
 # Configure boto3 for Linode Object Storage
 download_session = boto3.Session(
     aws_access_key_id=os.environ['S3_ACCESS_KEY'],
     aws_secret_access_key=os.environ['S3_SECRET_KEY']
 )
-download_client = download_session.client('s3', region_name='us-ord-1', endpoint_url='https://us-ord-1.linodeobjects.com')
+download_client = download_session.client('s3', region_name=S3_REGION, endpoint_url=S3_ENDPOINT_URL)
 
 # The function is repeated in case it is being downloaded from one bucket, and then upload to a different one.
 # Remember to updat the variables for both buckets.
@@ -48,15 +52,6 @@ def decode_and_reencode_filename(url):
     # Return the new URL with the directory and re-encoded filename
     return os.path.join(directory, encoded_filename)
 
-def create_csv_from_json(json_file):
-    with open(json_file, 'r') as f:
-        data = json.load(f)
-        filtered_data = [entry for entry in data if entry.get("Name", "").endswith(".mp4")]
-        df = pd.json_normalize(filtered_data)
-        csv_path = "output.csv"
-        df.to_csv(csv_path, index=False)
-        return csv_path
-
 def download_from_linode(file_key, local_path):
     # Use the decode and reencode function to process URL
     encoded_file_key = decode_and_reencode_filename(file_key)
@@ -67,20 +62,20 @@ def download_from_linode(file_key, local_path):
         logging.error(f"Error downloading {file_key} {encoded_file_key} {DOWNLOAD_BUCKET_NAME}. Reason: {e}")
 
 
-def generate_ism_filename_from_mp4(mp4_filename):
-    # Use regex to match everything up to the last underscore
-    match = re.match(r"^(.*)_.*\.mp4$", mp4_filename)
-    if match:
-        base_name = match.group(1)
-        return f"{base_name}.ism"
-    return None
-
 def generate_ism(mp4_local_paths):
     # Extract the ISM filename from the first MP4 name
-    ism_filename = generate_ism_filename_from_mp4(os.path.basename(mp4_local_paths[0]))
+    ism_filename = grouping.ism_filename(mp4_local_paths[0])
     if not ism_filename:
         logging.error(f"Couldn't generate ISM filename for {mp4_local_paths[0]}")
         return False
+
+    # Build the manifest from the moov boxes; mp4split is only needed when they can't be parsed
+    try:
+        write_ism(mp4_local_paths, os.path.join(ISM_OUTPUT_DIR, ism_filename))
+        return True
+    except (Mp4ParseError, OSError, struct.error) as e:
+        logging.info(f"Native ISM generation failed for {mp4_local_paths[0]}, using mp4split. Reason: {e}")
+
     cmd = [
         "mp4split",
         f"--license-key={LICENSE_KEY_PATH}",
@@ -95,34 +90,45 @@ def generate_ism(mp4_local_paths):
         logging.error(f"ISM generation failed for {mp4_local_paths[0]}")
         return False
 
-def modify_ism_to_relative_path(ism_filename):
-    ism_file_path = os.path.join(ISM_OUTPUT_DIR, ism_filename)
-    tree = ET.parse(ism_file_path)
-    root = tree.getroot()
-
-    # Remove the namespaces from the XML file
-    for elem in root.iter():
-        if not hasattr(elem.tag, 'find'): continue  # Skip if it's not an element (like a comment)
-        i = elem.tag.find('}')
-        if i >= 0:
-            elem.tag = elem.tag[i+1:]
+def generate_ism_from_bucket(group_entries, ism_filename):
+    """
+    Generate the ISM for a group straight from the objects in the download bucket.
 
-    for audio in root.findall(".//audio"):
-        src = audio.get('src')
-        if src:
-            # Decoding the URL to make it human-readable
-            decoded_src = urllib.parse.unquote(src)
-            audio.set('src', os.path.basename(decoded_src))
+    The native writer reads only the box headers and moov of each MP4 with ranged GETs;
+    the mp4split fallback gets the object URLs and the S3 credentials, so it streams
+    the renditions itself. Nothing is staged on local disk either way, so groups larger
+    than the disk work. Both write the same src values, the decoded file names.
+    Returns True when the ISM was written.
+    """
+    keys = [decode_and_reencode_filename(row['Path']) for row in group_entries]
+    output_path = os.path.join(ISM_OUTPUT_DIR, ism_filename)
+    try:
+        write_ism(keys, output_path, s3_client=download_client, bucket=DOWNLOAD_BUCKET_NAME)
+        return True
+    except (Mp4ParseError, struct.error, OSError, boto3.exceptions.Boto3Error, botocore.exceptions.BotoCoreError,
+            botocore.exceptions.ClientError) as e:
+        logging.info(f"Native ISM generation failed for {keys[0]}, using mp4split. Reason: {e}")
 
-    for video in root.findall(".//video"):
-        src = video.get('src')
-        if src:
-            # Decoding the URL to make it human-readable
-            decoded_src = urllib.parse.unquote(src)
-            video.set('src', os.path.basename(decoded_src))
+    object_urls = [f"{S3_ENDPOINT_URL}/{DOWNLOAD_BUCKET_NAME}/{urllib.parse.quote(key)}" for key in keys]
+    cmd = [
+        "mp4split",
+        f"--license-key={LICENSE_KEY_PATH}",
+        f"--s3_access_key={os.environ['S3_ACCESS_KEY']}",
+        f"--s3_secret_key={os.environ['S3_SECRET_KEY']}",
+        f"--s3_region={S3_REGION}",
+        "-o",
+        output_path
+    ] + object_urls
 
-    tree.write(ism_file_path, xml_declaration=True)
+    try:
+        subprocess.run(cmd, check=True)
+    except (subprocess.CalledProcessError, OSError) as e:
+        logging.error(f"ISM generation failed for {keys[0]}. Reason: {e}")
+        return False
 
+    # mp4split wrote the object URLs, reduce them to the src values the native writer uses
+    rewrite_ism_file(output_path, {src_name(url): relative_src(key) for url, key in zip(object_urls, keys)})
+    return True
 
 def generate_upload_path(mp4_path, ism_filename):
     dir_path = os.path.dirname(mp4_path)
@@ -143,20 +149,13 @@ def clean_directory(directory_path):
         os.remove(os.path.join(directory_path, filename))
 
 
-def get_key_from_mp4_path(path):
-    """
-    Derive the key from the mp4 path by stripping everything after the last underscore
-    """
-    return re.sub(r"_.*\.mp4$", "", path)
-
-
-def process_single_key_group(group_df):
+def process_single_key_group(group_entries):
     """
-    Process a group of rows from the CSV that share the same key.
+    Process the listing entries of one rendition group.
     """
     # 1. Download all MP4s listed in the group.
     mp4_local_paths = []
-    for _, row in group_df.iterrows():
+    for row in group_entries:
         local_path = os.path.join(MP4_DIR, os.path.basename(row['Path']))
         download_from_linode(row['Path'], local_path)
         mp4_local_paths.append(local_path)
@@ -166,7 +165,7 @@ def process_single_key_group(group_df):
 
     if ism_generated:
         # Get the correct ISM filename from the first downloaded MP4.
-        ism_filename = generate_ism_filename_from_mp4(os.path.basename(mp4_local_paths[0]))
+        ism_filename = grouping.ism_filename(mp4_local_paths[0])
 
         # Ensure we have the filename, else skip the iteration.
         if not ism_filename:
@@ -174,29 +173,47 @@ def process_single_key_group(group_df):
             return
 
         # Modify the ISM to set relative paths.
-        modify_ism_to_relative_path(ism_filename)
+        rewrite_ism_file(os.path.join(ISM_OUTPUT_DIR, ism_filename))
 
         # 3. Upload the ISM file
-        first_mp4_path = group_df.iloc[0]['Path']  # Get the path of the first mp4 from the dataframe
+        first_mp4_path = group_entries[0]['Path']  # Get the path of the first mp4 of the group
         upload_path = generate_upload_path(first_mp4_path, ism_filename)  # Derive the upload path
         upload_to_linode(upload_path, os.path.join(ISM_OUTPUT_DIR, ism_filename))
 
     # Cleanup
     clean_directory(MP4_DIR)
 
-def main():
-    json_file = "partial_special_characters.json"
-    csv_path = create_csv_from_json(json_file)
+def process_group_from_bucket(group_entries):
+    """
+    Process one rendition group without downloading it.
+    """
+    first_mp4_path = group_entries[0]['Path']
+    ism_filename = grouping.ism_filename(first_mp4_path)
+    if not generate_ism_from_bucket(group_entries, ism_filename):
+        return
 
-    df = pd.read_csv(csv_path)
+    upload_path = generate_upload_path(first_mp4_path, ism_filename)
+    upload_to_linode(upload_path, os.path.join(ISM_OUTPUT_DIR, ism_filename))
 
-    # Get unique keys from the paths
-    df['key'] = df['Path'].apply(get_key_from_mp4_path)
-    unique_keys = df['key'].unique()
+def main():
+    parser = argparse.ArgumentParser(description="Regenerate the ISMs of the groups in partial_special_characters.json")
+    parser.add_argument("--stream", action="store_true",
+                        help="Read the MP4s straight from the bucket instead of downloading them to " + MP4_DIR)
+    args = parser.parse_args()
+    json_file = "partial_special_characters.json"
 
-    for key in unique_keys:
-        group_df = df[df['key'] == key]
-        process_single_key_group(group_df)
+    # Group the renditions of every title in a single pass over the listing
+    group_index = GroupIndex.from_listing(json_file)
+
+    for key, group_entries in group_index.items():
+        try:
+            if args.stream:
+                process_group_from_bucket(group_entries)
+            else:
+                process_single_key_group(group_entries)
+        except Exception as e:
+            # One failing group shouldn't stop the rest of the run
+            logging.error(f"Processing failed for group {key}. Reason: {e}")
 
 if __name__ == "__main__":
     main()
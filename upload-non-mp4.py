@@ -1,6 +1,5 @@
 import argparse
 import pandas as pd
-import json
 import os
 import requests
 import subprocess
@@ -8,26 +7,11 @@ from concurrent.futures import ThreadPoolExecutor
 from urllib.parse import quote
 import gc
 import shutil
-
-
-def create_csv(json_file):
-    with open(json_file) as data:
-        json_data = json.load(data)
-        filtered_data = [entry for entry in json_data if not entry.get("Name", "").endswith(".mp4")]
-        df = pd.json_normalize(filtered_data)
-        print("Printing JSON to CSV")
-        print(df)
-        df.to_csv("missing_flattened_output.csv", index=False)
-        del df
-        gc.collect()
-        return "missing_flattened_output.csv"
-
-def split_csv(input_csv, output_dir, chunk_size):
-    os.makedirs(output_dir, exist_ok=True)
-    for i, chunk in enumerate(pd.read_csv(input_csv, chunksize=chunk_size)):
-        chunk.to_csv(os.path.join(output_dir, f"output_{i}.csv"), index=False)
-        del chunk
-        gc.collect()
+from download_utils import resumable_download
+from destination_index import DestinationIndex
+from job_state import DEFAULT_DB_PATH, JobLedger, in_shard, parse_shard
+from linode_uploader import COPY_TRANSFER_CONFIG, LinodeUploader, make_s3_client
+from manifest_reader import iter_entries, write_csv_chunks
 
 
 def get_details_from_csv(csv_file):
@@ -38,24 +22,20 @@ def get_details_from_csv(csv_file):
     return names, paths
 
 
-def download_file(base_url, path, download_dir, error_dir):
+def download_file(base_url, path, download_dir, error_dir, segments=1, session=None):
     download_errors_file = os.path.join(error_dir, "download_errors")
-    session = requests.Session()
     file_name = os.path.basename(path)
     encoded_path = os.path.join(os.path.dirname(path), quote(file_name))  # encoding only the file name
     full_url = f"{base_url}/{encoded_path}"
+    download_path = os.path.join(download_dir, file_name)
     try:
-        response = session.get(full_url)
-        if response.status_code == 200:
-            print(f"Successfully downloaded: {file_name}")
-            download_path = os.path.join(download_dir, file_name)
-            with open(download_path, 'wb') as file:
-                file.write(response.content)
+        status_code = resumable_download(full_url, download_path, session=session, segments=segments)
+        if status_code == 200:
             print(f"Saved {file_name} to {download_path}")
         else:
-            print(f"Failed to download: {file_name}, Status code: {response.status_code}")
+            print(f"Failed to download: {file_name}, Status code: {status_code}")
             with open(download_errors_file, 'a') as err_file:
-                err_file.write(f"Failed to download: {file_name}, Status code: {response.status_code}\n")
+                err_file.write(f"Failed to download: {file_name}, Status code: {status_code}\n")
         return True
     except requests.exceptions.RequestException as e:
         print(f"Request for {file_name} failed: {e}")
@@ -64,29 +44,82 @@ def download_file(base_url, path, download_dir, error_dir):
         return False
 
 
-def make_http_requests(base_url, paths, download_dir, error_dir, max_requests=10):
+def make_http_requests(base_url, paths, download_dir, error_dir, max_requests=10, segments=1):
+    # One pooled session for all workers so connections to the origin are reused
+    session = requests.Session()
+    adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=max_requests)
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
     with ThreadPoolExecutor(max_workers=max_requests) as executor:
         results = list(executor.map(download_file, [base_url] * len(paths), paths, [download_dir] * len(paths),
-                                    [error_dir] * len(paths)))
+                                    [error_dir] * len(paths), [segments] * len(paths), [session] * len(paths)))
 
 
 
 def upload_to_linode_object_storage(source_dir, linode_remote, error_dir, csv_file, names):
     linode_errors_file = os.path.join(error_dir, "linode_errors")
-    try:
-        for name, path in zip(names, paths):
-            if not name.endswith(".mp4"):
+    failed = []
+    for name, path in zip(names, paths):
+        if not name.endswith(".mp4"):
+            try:
                 source_file_path = os.path.join(source_dir, name)
                 remote_file_path = os.path.join(path)
                 upload_path = os.path.dirname(remote_file_path)
-                upload_command = ["rclone", "copy", "--progress", "--bwlimit", "150M", "--s3-acl", "authenticated-read",
+                upload_command = ["rclone", "copy", "--progress", "--checksum", "--bwlimit", "150M", "--s3-acl", "authenticated-read",
                                   source_file_path, f"{linode_remote}{upload_path}"]
                 subprocess.run(upload_command, check=True)
                 print(f"Upload to Linode Object Storage successful for: {name} {upload_path} {linode_remote}")
-    except subprocess.CalledProcessError as e:
-        print(f"Upload to Linode Object Storage failed. Error: {e}")
-        with open(linode_errors_file, 'a') as err_file:
-            err_file.write(f"Upload to Linode Object Storage failed. Error: {e}\n")
+            except subprocess.CalledProcessError as e:
+                print(f"Upload to Linode Object Storage failed. Error: {e}")
+                with open(linode_errors_file, 'a') as err_file:
+                    err_file.write(f"Upload to Linode Object Storage failed for {path}. Error: {e}\n")
+                failed.append(path)
+    return failed
+
+
+def upload_with_boto3(uploader, source_dir, bucket_prefix, error_dir, names, paths):
+    """Upload the batch with the in-process uploader and return the paths that failed."""
+    linode_errors_file = os.path.join(error_dir, "linode_errors")
+    keys = {os.path.join(bucket_prefix, os.path.dirname(path), name): path
+            for name, path in zip(names, paths) if not name.endswith(".mp4")}
+    uploads = [(os.path.join(source_dir, os.path.basename(key)), key) for key in keys]
+    return [keys[key] for key in uploader.upload_many(uploads, linode_errors_file)]
+
+
+def copy_with_boto3(uploader, source_bucket, source_prefix, bucket_prefix, error_dir, names, paths):
+    """Server-side copy the batch from source_bucket/source_prefix and return the paths that failed."""
+    linode_errors_file = os.path.join(error_dir, "linode_errors")
+    keys = {os.path.join(bucket_prefix, path): path for name, path in zip(names, paths) if not name.endswith(".mp4")}
+    copies = [(os.path.join(source_prefix, path), key) for key, path in keys.items()]
+    return [keys[key] for key in uploader.copy_many(source_bucket, copies, linode_errors_file)]
+
+
+def source_checksums(csv_file):
+    """{Path: (Size, MD5)} from a CSV chunk, when the listing it was cut from had hashes (rclone lsjson --hash)."""
+    df = pd.read_csv(csv_file)
+    if "Size" not in df or "Hashes.md5" not in df:
+        return {}
+    return {path: (int(size), md5) for path, size, md5 in zip(df["Path"], df["Size"], df["Hashes.md5"])
+            if isinstance(md5, str)}
+
+
+def skip_identical(pending, csv_file, index, bucket_prefix, ledger):
+    """Drop the (name, path) pairs the destination already holds with the same size and MD5, before downloading them."""
+    checksums = source_checksums(csv_file)
+    remaining = []
+    for name, path in pending:
+        if path in checksums and index.has_object(os.path.join(bucket_prefix, path), *checksums[path]):
+            print(f"Skipping {path}, identical object already in {index.bucket}")
+            ledger.mark(path, "uploaded")
+        else:
+            remaining.append((name, path))
+    return remaining
+
+
+def parse_bucket_path(value):
+    """Split a --copy-from value such as old-bucket/delivery/ into (bucket, prefix)."""
+    bucket, _, prefix = value.partition("/")
+    return bucket, prefix
 
 
 if __name__ == "__main__":
@@ -94,17 +127,32 @@ if __name__ == "__main__":
     parser.add_argument("--generate-csvs", action="store_true", help="Generate CSVs and exit")
     parser.add_argument("--start", type=int, help="Start index of CSV range")
     parser.add_argument("--end", type=int, help="End index of CSV range")
+    parser.add_argument("--segments", type=int, default=1, help="Parallel range requests per large file")
+    parser.add_argument("--async-downloads", action="store_true", help="Download with the asyncio transfer engine")
+    parser.add_argument("--concurrency", type=int, default=10, help="Concurrent downloads")
+    parser.add_argument("--per-host", type=int, default=50, help="Connection limit per host for --async-downloads")
+    parser.add_argument("--uploader", choices=["boto3", "rclone"], default="boto3", help="Upload in-process with boto3 or with one rclone per file")
+    parser.add_argument("--upload-workers", type=int, default=8, help="Parallel file uploads")
+    parser.add_argument("--bwlimit", default="150M", help="Total upload bandwidth limit for --uploader boto3, e.g. 150M or off")
+    parser.add_argument("--ledger", default=DEFAULT_DB_PATH, help="SQLite job ledger used to skip finished files")
+    parser.add_argument("--shard", help="Only process shard i of n, e.g. 0/4")
+    parser.add_argument("--skip-identical", action="store_true", help="List the destination once and skip files it already holds with the same size and checksum")
+    parser.add_argument("--copy-from", help="Copy server-side from this Linode bucket[/prefix] instead of downloading from Akamai")
+    parser.add_argument("--copy-workers", type=int, default=32, help="Parallel object copies for --copy-from")
     args = parser.parse_args()
+    ledger = JobLedger(args.ledger)
+    shard = parse_shard(args.shard)
 
     license_key_path = "/home/admin/scripts/mp4s/usp-license.key"
     linode_remote = "your-bucket-prod-chicago:prod-your-bucket-usp-content-1/delivery/"
+    bucket_name = "prod-your-bucket-usp-content-1"
+    bucket_prefix = "delivery/"
 
     if args.generate_csvs:
         json_file_name = "missing_files_linode.json"
-        create_csv(json_file_name)
         chunk_size = 75
         output_dir = "missing_smaller_csvs"
-        split_csv("missing_flattened_output.csv", output_dir, chunk_size)
+        write_csv_chunks(iter_entries(json_file_name, suffix=".mp4", exclude=True), output_dir, chunk_size, on_chunk=ledger.discover)
         print("CSV generation and splitting completed.")
     else:
         if args.start is None or args.end is None:
@@ -117,6 +165,20 @@ if __name__ == "__main__":
             error_dir = "errors"
             os.makedirs(error_dir, exist_ok=True)
             smaller_csv_files.sort(key=lambda x: int(x.split('_')[-1].split('.')[0]))
+            uploader = None
+            if args.copy_from:
+                source_bucket, source_prefix = parse_bucket_path(args.copy_from)
+                client = make_s3_client(max_pool_connections=args.copy_workers * COPY_TRANSFER_CONFIG.max_request_concurrency)
+                uploader = LinodeUploader(bucket_name, client=client, max_parallel_files=args.copy_workers)
+            elif args.uploader == "boto3":
+                uploader = LinodeUploader(bucket_name, bandwidth_limit=args.bwlimit, max_parallel_files=args.upload_workers)
+            index = None
+            if args.skip_identical:
+                client = uploader.client if uploader else make_s3_client()
+                index = DestinationIndex(client, bucket_name, db_path=args.ledger)
+                index.refresh(bucket_prefix)
+                if uploader:
+                    uploader.index = index
 
             if args.start < 0 or args.start >= len(smaller_csv_files) or args.end < 0 or args.end >= len(smaller_csv_files):
                 print("Invalid start and/or end index. Please provide valid indices.")
@@ -127,11 +189,38 @@ if __name__ == "__main__":
                     csv_file_path = os.path.join("missing_smaller_csvs", csv_file)
 
                     names, paths = get_details_from_csv(csv_file_path)
-
-                    make_http_requests(base_url, paths, download_dir, error_dir)
+                    pending = [(name, path) for name, path in zip(names, paths)
+                               if in_shard(path, shard) and not ledger.is_done(path, "uploaded")]
+                    if index:
+                        pending = skip_identical(pending, csv_file_path, index, bucket_prefix, ledger)
+                    names = [name for name, _ in pending]
+                    paths = [path for _, path in pending]
+
+                    if args.copy_from:
+                        # Each CSV chunk is one batch of copies; the objects never leave the object store
+                        failed = set(copy_with_boto3(uploader, source_bucket, source_prefix, bucket_prefix, error_dir, names, paths))
+                        for path in paths:
+                            if path not in failed:
+                                ledger.mark(path, "uploaded")
+                        continue
+
+                    if args.async_downloads:
+                        from async_transfer import download_all
+                        download_all(base_url, paths, download_dir, error_dir, concurrency=args.concurrency, per_host=args.per_host)
+                    else:
+                        make_http_requests(base_url, paths, download_dir, error_dir, max_requests=args.concurrency, segments=args.segments)
                     # Assuming you still want to run the mp4split function, though it's not provided in the recent code snippet.
                     # run_mp4split(download_dir, "good-mp4s", names, license_key_path, error_dir)
-                    upload_to_linode_object_storage("bad-mp4s", linode_remote, error_dir, csv_file_path, names)
+                    for name, path in pending:
+                        if os.path.exists(os.path.join(download_dir, name)):
+                            ledger.mark(path, "downloaded")
+                    if uploader:
+                        failed = set(upload_with_boto3(uploader, "bad-mp4s", bucket_prefix, error_dir, names, paths))
+                    else:
+                        failed = set(upload_to_linode_object_storage("bad-mp4s", linode_remote, error_dir, csv_file_path, names))
+                    for path in paths:
+                        if path not in failed and ledger.is_done(path, "downloaded"):
+                            ledger.mark(path, "uploaded")
 
                 # Clearing the bad-mp4s and good-mp4s directories
                 #clear_directory("bad-mp4s")
@@ -0,0 +1,60 @@
+import argparse
+import re
+
+from grouping import split_rendition
+from manifest_reader import iter_entries
+
+MANIFEST = "master.m3u8"
+
+
+def rendition_order(rendition):
+    """Sort key putting the highest bitrate first, e.g. 4500k before 400k, and non-numeric renditions last."""
+    match = re.match(r"(\d+)", rendition)
+    return (0, -int(match.group(1)), rendition) if match else (1, 0, rendition)
+
+
+def master_path(key, renditions, manifest=MANIFEST):
+    """
+    Playback path of a group: the multi-bitrate set URL over its actual renditions,
+    e.g. dir/title_,4500k,1000k,.mp4.csmil/master.m3u8, or dir/title.mp4/master.m3u8
+    for a single file without a rendition suffix.
+    """
+    renditions = sorted((rendition for rendition in renditions if rendition), key=rendition_order)
+    if not renditions:
+        return f"{key}.mp4/{manifest}"
+    return f"{key}_,{','.join(renditions)},.mp4.csmil/{manifest}"
+
+
+def iter_master_urls(entries, base_url="", manifest=MANIFEST):
+    """
+    Yield one playback URL per group of MP4 entries, in the order the groups first appear.
+
+    A single pass over the entries keeps only the rendition names of each group, so
+    titles listed several times or in pieces still come out once, with every rendition.
+    """
+    groups = {}
+    for entry in entries:
+        key, rendition = split_rendition(entry["Path"])
+        groups.setdefault(key, {})[rendition] = None
+    for key, renditions in groups.items():
+        yield base_url + master_path(key, renditions, manifest)
+
+
+def write_url_list(listing, output_path, base_url="", manifest=MANIFEST):
+    """Write one playback URL per group of the listing to output_path. Returns the number written."""
+    count = 0
+    with open(output_path, 'w') as file:
+        for url in iter_master_urls(iter_entries(listing, suffix=".mp4"), base_url, manifest):
+            file.write(url + "\n")
+            count += 1
+    return count
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Write one playback URL per title from the renditions of a listing")
+    parser.add_argument("listing", nargs="?", default="all_files_linode.json", help="rclone lsjson listing")
+    parser.add_argument("--output", default="url-list.txt", help="URL list, one per line, e.g. usp_urls.txt")
+    parser.add_argument("--base-url", default="", help="Prepended to every path, e.g. https://host/")
+    parser.add_argument("--manifest", default=MANIFEST, help="Manifest requested under every set URL")
+    args = parser.parse_args()
+    print(f"Wrote {write_url_list(args.listing, args.output, args.base_url, args.manifest)} URLs to {args.output}")
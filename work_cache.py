@@ -0,0 +1,104 @@
+import hashlib
+import os
+import shutil
+import sqlite3
+import threading
+import time
+
+from job_state import DEFAULT_DB_PATH, file_md5
+
+DEFAULT_CACHE_DIR = "/home/admin/scripts/mp4s/cache"
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS renditions (
+    fingerprint TEXT PRIMARY KEY,
+    path TEXT NOT NULL,
+    output_checksum TEXT NOT NULL,
+    created_at REAL
+);
+"""
+
+
+def source_fingerprint(entry):
+    """Identity of a source object as listed: its Path, Size and ModTime."""
+    key = "\0".join(str(entry.get(field) or "") for field in ("Path", "Size", "ModTime"))
+    return hashlib.sha1(key.encode()).hexdigest()
+
+
+def link_or_copy(source, dest):
+    """Hard link source to dest, copying when both aren't on the same filesystem."""
+    if os.path.exists(dest):
+        os.remove(dest)
+    try:
+        os.link(source, dest)
+    except OSError:
+        shutil.copyfile(source, dest)
+
+
+class WorkCache:
+    """
+    Content addressed store for repackaged MP4s.
+
+    A source object is identified by its fingerprint (Path, Size, ModTime), which maps
+    to the MD5 of its mp4split output. The output itself is kept under that MD5, so a
+    file is downloaded and repackaged at most once while it stays unchanged at the
+    source. The mapping outlives the stored file: once an output has been uploaded it
+    can be evicted, and reruns still know which checksum the destination should hold.
+    """
+
+    def __init__(self, cache_dir=DEFAULT_CACHE_DIR, db_path=DEFAULT_DB_PATH):
+        self.cache_dir = cache_dir
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(db_path, check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.executescript(SCHEMA)
+        os.makedirs(cache_dir, exist_ok=True)
+
+    def close(self):
+        self.conn.close()
+
+    def scratch_path(self, entry):
+        """Where mp4split should write the output for entry before it's stored."""
+        scratch_dir = os.path.join(self.cache_dir, "tmp")
+        os.makedirs(scratch_dir, exist_ok=True)
+        return os.path.join(scratch_dir, os.path.basename(entry["Path"]))
+
+    def object_path(self, checksum):
+        return os.path.join(self.cache_dir, checksum[:2], checksum + ".mp4")
+
+    def checksum_of(self, entry):
+        """MD5 of the output previously produced for this exact source object, or None."""
+        with self.lock:
+            row = self.conn.execute("SELECT output_checksum FROM renditions WHERE fingerprint = ?",
+                                    (source_fingerprint(entry),)).fetchone()
+        return row[0] if row else None
+
+    def lookup(self, entry):
+        """Path of the cached output for entry, or None if it has to be produced (again)."""
+        checksum = self.checksum_of(entry)
+        if checksum is None:
+            return None
+        object_path = self.object_path(checksum)
+        return object_path if os.path.exists(object_path) else None
+
+    def store(self, entry, output_path):
+        """Move a freshly repackaged file into the cache and return (checksum, cached path)."""
+        checksum = file_md5(output_path)
+        object_path = self.object_path(checksum)
+        os.makedirs(os.path.dirname(object_path), exist_ok=True)
+        if os.path.exists(object_path):
+            os.remove(output_path)
+        else:
+            os.replace(output_path, object_path)
+        with self.lock, self.conn:
+            self.conn.execute(
+                "INSERT OR REPLACE INTO renditions (fingerprint, path, output_checksum, created_at) VALUES (?, ?, ?, ?)",
+                (source_fingerprint(entry), entry["Path"], checksum, time.time()))
+        return checksum, object_path
+
+    def evict(self, checksum):
+        """Drop the stored output, keeping the fingerprint -> checksum record."""
+        try:
+            os.remove(self.object_path(checksum))
+        except FileNotFoundError:
+            pass